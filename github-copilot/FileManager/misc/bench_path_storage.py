@@ -0,0 +1,138 @@
+"""
+Compare the database size and query times of the schema version 2 layout, with a full
+path in every files row, against the directory-normalized layout of version 3.
+
+A synthetic version 2 database is built, copied, and the copy upgraded in place with
+initialize_db. Both are vacuumed before they are measured.
+
+    python misc/bench_path_storage.py --files 1000000
+"""
+import argparse
+import hashlib
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from src.db import initialize_db, FILE_BY_PATH, _split_path  # noqa: E402
+
+ROOT = '/srv/archive/photos/2021'
+
+
+def synthetic_paths(num_files, files_per_dir, fanout):
+    """Yield num_files paths spread over a directory tree under ROOT."""
+    for i in range(num_files):
+        d = i // files_per_dir
+        parts = []
+        while True:
+            parts.append(f"dir-{d % fanout:03d}")
+            d //= fanout
+            if not d:
+                break
+        yield os.path.join(ROOT, *reversed(parts), f"IMG_{i:08d}.jpg")
+
+
+def build_v2(db_path, paths):
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+        CREATE TABLE files (
+            id INTEGER PRIMARY KEY, md5sum BLOB, size INTEGER, last_modified INTEGER,
+            path TEXT UNIQUE, partial_md5 BLOB, st_dev INTEGER, st_ino INTEGER
+        )
+    ''')
+    conn.executemany(
+        "INSERT INTO files (md5sum, size, last_modified, path, st_dev, st_ino) VALUES (?, ?, ?, ?, 1, ?)",
+        ((hashlib.md5(str(i % (len(paths) // 2)).encode()).digest(), 4096 + i % 1000, 1600000000000 + i, path, i)
+         for i, path in enumerate(paths)))
+    for sql in ("CREATE INDEX idx_files_inode ON files (st_dev, st_ino)",
+                "CREATE INDEX idx_files_md5sum ON files (md5sum)",
+                "CREATE INDEX idx_files_size ON files (size)",
+                "PRAGMA user_version = 2"):
+        conn.execute(sql)
+    conn.commit()
+    conn.close()
+
+
+def vacuum(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute("VACUUM")
+    conn.close()
+
+
+def timed(label, func, repeat=3):
+    best = min(_time_once(func) for _ in range(repeat))
+    print(f"  {label:<28} {best * 1000:10.1f} ms")
+
+
+def _time_once(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def run_queries(db_path, lookups, prefix, normalized):
+    conn = sqlite3.connect(db_path)
+    table = 'file_paths' if normalized else 'files'
+
+    def lookup():
+        for path in lookups:
+            if normalized:
+                conn.execute(f"SELECT size, last_modified FROM files WHERE {FILE_BY_PATH}", _split_path(path)).fetchone()
+            else:
+                conn.execute("SELECT size, last_modified FROM files WHERE path = ?", (path,)).fetchone()
+
+    def subtree():
+        low, high = prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        if normalized:
+            sql = '''SELECT directories.path || files.name, size, last_modified
+                     FROM directories JOIN files ON files.dir_id = directories.id
+                     WHERE directories.path >= ? AND directories.path < ?'''
+        else:
+            sql = "SELECT path, size, last_modified FROM files WHERE path >= ? AND path < ?"
+        conn.execute(sql, (low, high)).fetchall()
+
+    timed(f"{len(lookups)} path lookups", lookup)
+    timed("subtree scan", subtree)
+    timed("prefix count (LIKE)",
+          lambda: conn.execute(f"SELECT COUNT(*) FROM {table} WHERE path LIKE ?", (prefix + '%',)).fetchone())
+    timed("duplicate groups",
+          lambda: conn.execute(f'''SELECT md5sum, GROUP_CONCAT(path) FROM {table}
+                                   GROUP BY md5sum HAVING COUNT(*) > 1''').fetchall())
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=200000)
+    parser.add_argument('--files-per-dir', type=int, default=50)
+    parser.add_argument('--fanout', type=int, default=20)
+    parser.add_argument('--lookups', type=int, default=10000)
+    args = parser.parse_args()
+
+    paths = list(synthetic_paths(args.files, args.files_per_dir, args.fanout))
+    lookups = random.Random(0).sample(paths, min(args.lookups, len(paths)))
+    prefix = os.path.join(ROOT, 'dir-001', '')
+
+    tmp = tempfile.mkdtemp()
+    try:
+        before, after = os.path.join(tmp, 'v2.db'), os.path.join(tmp, 'v3.db')
+        build_v2(before, paths)
+        shutil.copy(before, after)
+        start = time.perf_counter()
+        initialize_db(after)
+        print(f"Upgraded {len(paths)} rows in {time.perf_counter() - start:.1f} s")
+        for label, db_path, normalized in (("before (v2)", before, False), ("after (v3)", after, True)):
+            vacuum(db_path)
+            print(f"{label}: {os.path.getsize(db_path) / 1024 ** 2:.1f} MB")
+            run_queries(db_path, lookups, prefix, normalized)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
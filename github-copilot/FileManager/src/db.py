@@ -1,37 +1,1090 @@
 # src/db.py
 import logging
+import math
 import os
 import re
 import sqlite3
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import weakref
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+from queue import Queue, Empty
 
-from src.utils import get_file_mtime_in_ms
+from src.md5sum import compute_md5
+from src.metrics import COUNT, timed
+from src.utils import (
+    get_stat_mtime_in_ms, iter_batches, run_batches_in_processes, run_batches_in_threads, RateLimiter
+)
 
 MAX_RETRIES = 10  # Define a global variable for the number of retries
 RETRY_DELAY = 0.1  # Delay between retries in seconds
 
+WRITE_BATCH_SIZE = 1000  # Maximum number of writes committed in one transaction
+WRITE_BATCH_LATENCY = 0.5  # Maximum seconds a queued write waits before it is committed
+BUSY_TIMEOUT_MS = 30000  # How long SQLite waits for a lock held by another connection
+MMAP_SIZE = 256 * 1024 * 1024  # Bytes of the database file each connection reads through a memory map
+CACHE_SIZE_KIB = 64 * 1024  # Page cache size of each connection
+DELETE_CHUNK_SIZE = 1000  # Rows deleted per transaction when removing files by pattern
+AUDIT_BATCH_SIZE = 500  # Rows stat'ed or files rehashed per task by audit_db
 
-def initialize_db(db_path):
+# Selects the files row for a path, given its directory (ending in a separator) and base name
+FILE_BY_PATH = "dir_id = (SELECT id FROM directories WHERE path = ?) AND name = ?"
+
+UPSERT_FILE_SQL = '''
+    INSERT INTO files (dir_id, name, md5sum, size, last_modified, st_dev, st_ino) VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(dir_id, name) DO UPDATE SET md5sum=excluded.md5sum, size=excluded.size,
+        last_modified=excluded.last_modified, st_dev=excluded.st_dev, st_ino=excluded.st_ino, partial_md5=NULL
+'''
+DELETE_FILE_SQL = f"DELETE FROM files WHERE {FILE_BY_PATH}"
+UPDATE_STAGED_HASHES_SQL = f'''
+    UPDATE files SET partial_md5 = COALESCE(?, partial_md5), md5sum = COALESCE(?, md5sum)
+    WHERE {FILE_BY_PATH}
+'''
+
+# Identifies the storage behind a row: hardlinks share it, rows without inode data never do
+INODE_KEY = "COALESCE(st_dev || ':' || st_ino, 'file:' || id)"
+
+_SEPARATORS = tuple(sep for sep in (os.sep, os.altsep) if sep)
+_REGEX_SPECIAL = frozenset('.^$*+?{}[]\\|()')
+
+# The ids of the files whose path matches a REGEXP pattern, restricted by a condition
+MATCHING_FILES_SQL = '''
+    SELECT files.id FROM directories JOIN files ON files.dir_id = directories.id
+    WHERE {condition} AND directories.path || files.name REGEXP ?
+'''
+
+
+SCHEMA_VERSION = 8  # Stored in PRAGMA user_version; databases created before versioning read as 0
+
+# Each directory is stored once with its full path, ending in a separator, so a file's path
+# is its directory's path followed by its name and path prefixes can be range scanned
+DIRECTORIES_TABLE_SQL = '''
+    CREATE TABLE directories (
+        id INTEGER PRIMARY KEY,
+        parent_id INTEGER REFERENCES directories (id),
+        name TEXT,
+        path TEXT UNIQUE
+    )
+'''
+FILES_TABLE_SQL = '''
+    CREATE TABLE {table} (
+        id INTEGER PRIMARY KEY,
+        dir_id INTEGER NOT NULL REFERENCES directories (id),
+        name TEXT NOT NULL,
+        md5sum BLOB,
+        size INTEGER,
+        last_modified INTEGER,
+        partial_md5 BLOB,
+        st_dev INTEGER,
+        st_ino INTEGER,
+        last_verified INTEGER NOT NULL DEFAULT 0,
+        content_verified INTEGER NOT NULL DEFAULT 0,
+        scan_generation INTEGER NOT NULL DEFAULT 0,
+        UNIQUE (dir_id, name)
+    )
+'''
+# One row per directory scan. Its generation is stamped on every file the scan sees, so
+# the files under its root left with an older generation are gone from disk.
+SCANS_TABLE_SQL = '''
+    CREATE TABLE scans (
+        generation INTEGER PRIMARY KEY,
+        root TEXT NOT NULL,
+        started INTEGER NOT NULL,
+        finished INTEGER
+    )
+'''
+# The directories whose whole subtree an unfinished scan has processed. Once a directory
+# is recorded, the rows of its subdirectories are dropped, so the journal only holds the
+# frontier of the walk and a resumed scan prunes the walk there.
+SCAN_CHECKPOINTS_TABLE_SQL = '''
+    CREATE TABLE scan_checkpoints (
+        generation INTEGER NOT NULL REFERENCES scans (generation),
+        path TEXT NOT NULL,
+        PRIMARY KEY (generation, path)
+    ) WITHOUT ROWID
+'''
+# The files table with the full path of each file, in the column order used before version 3
+FILE_PATHS_VIEW_SQL = '''
+    CREATE VIEW IF NOT EXISTS file_paths AS
+    SELECT files.id, md5sum, size, last_modified, directories.path || files.name AS path,
+           partial_md5, st_dev, st_ino
+    FROM files JOIN directories ON directories.id = files.dir_id
+'''
+# One row per checksum stored in files, kept up to date by the triggers below, so the
+# duplicate reports read only the groups instead of grouping every file. inode_count counts
+# distinct inodes, since hardlinks to one inode take no extra space.
+DUP_GROUPS_TABLE_SQL = '''
+    CREATE TABLE dup_groups (
+        md5sum BLOB PRIMARY KEY,
+        size INTEGER,
+        member_count INTEGER NOT NULL,
+        inode_count INTEGER NOT NULL,
+        wasted_bytes INTEGER GENERATED ALWAYS AS ((inode_count - 1) * size) VIRTUAL
+    )
+'''
+# Whether no row other than the one being changed holds the same checksum on the same inode
+_FIRST_LINK_SQL = '''
+    NOT EXISTS (
+        SELECT 1 FROM files
+        WHERE st_dev = {row}.st_dev AND st_ino = {row}.st_ino AND md5sum = {row}.md5sum AND id != {row}.id
+    )
+'''
+_ADD_TO_GROUP_SQL = f'''
+    INSERT INTO dup_groups (md5sum, size, member_count, inode_count) VALUES (NEW.md5sum, NEW.size, 1, 1)
+    ON CONFLICT(md5sum) DO UPDATE SET member_count = member_count + 1,
+        inode_count = inode_count + {_FIRST_LINK_SQL.format(row='NEW')};
+'''
+_REMOVE_FROM_GROUP_SQL = f'''
+    UPDATE dup_groups SET member_count = member_count - 1,
+        inode_count = inode_count - {_FIRST_LINK_SQL.format(row='OLD')}
+    WHERE md5sum = OLD.md5sum;
+    DELETE FROM dup_groups WHERE md5sum = OLD.md5sum AND member_count = 0;
+'''
+DUP_GROUPS_TRIGGERS_SQL = (
+    f'''
+    CREATE TRIGGER IF NOT EXISTS files_dup_groups_insert AFTER INSERT ON files
+    WHEN NEW.md5sum IS NOT NULL BEGIN {_ADD_TO_GROUP_SQL} END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS files_dup_groups_delete AFTER DELETE ON files
+    WHEN OLD.md5sum IS NOT NULL BEGIN {_REMOVE_FROM_GROUP_SQL} END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS files_dup_groups_update_old AFTER UPDATE OF md5sum, size, st_dev, st_ino ON files
+    WHEN OLD.md5sum IS NOT NULL BEGIN {_REMOVE_FROM_GROUP_SQL} END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS files_dup_groups_update_new AFTER UPDATE OF md5sum, size, st_dev, st_ino ON files
+    WHEN NEW.md5sum IS NOT NULL BEGIN {_ADD_TO_GROUP_SQL} END
+    ''',
+)
+SCHEMA_INDEXES_SQL = (
+    "CREATE INDEX IF NOT EXISTS idx_directories_parent ON directories (parent_id)",
+    "CREATE INDEX IF NOT EXISTS idx_files_inode ON files (st_dev, st_ino)",
+    "CREATE INDEX IF NOT EXISTS idx_files_md5sum ON files (md5sum)",
+    "CREATE INDEX IF NOT EXISTS idx_files_size ON files (size)",
+    "CREATE INDEX IF NOT EXISTS idx_files_last_verified ON files (last_verified)",
+    "CREATE INDEX IF NOT EXISTS idx_files_content_verified ON files (content_verified)",
+    # Let the reports visit only checksums shared by several files
+    "CREATE INDEX IF NOT EXISTS idx_dup_groups_md5sum ON dup_groups (md5sum) WHERE member_count > 1",
+    "CREATE INDEX IF NOT EXISTS idx_dup_groups_wasted ON dup_groups (wasted_bytes) WHERE member_count > 1",
+)
+
+
+def _digest_to_blob(digest):
+    """Convert a hexadecimal MD5 checksum to the 16 bytes stored in the database."""
+    return None if digest is None else bytes.fromhex(digest)
+
+
+def _blob_to_digest(blob):
+    """Convert a stored MD5 checksum back to a hexadecimal string."""
+    return None if blob is None else blob.hex()
+
+
+def _hex_digest_to_blob(value):
+    """Convert a checksum stored as hex text by schema version 1, or None if it is not one."""
+    try:
+        blob = bytes.fromhex(value)
+    except (TypeError, ValueError):
+        return None
+    return blob if len(blob) == 16 else None
+
+
+def _migrate_to_v1(conn):
+    """Add the columns introduced before the schema was versioned."""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(files)")]
+    for column, column_type in (('partial_md5', 'TEXT'), ('st_dev', 'INTEGER'), ('st_ino', 'INTEGER')):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE files ADD COLUMN {column} {column_type}")
+
+
+def _migrate_to_v2(conn):
     """
-    Initialize the database by creating the necessary tables if they do not exist.
+    Rebuild the files table with checksums stored as 16-byte BLOBs instead of hex text.
 
-    Args:
-        db_path (str): The path to the database file.
+    A row whose stored checksum is not a valid MD5 digest loses both its checksum and
+    its last modified time, so the next scan hashes the file again.
     """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS files (
+    conn.create_function('hex_digest_to_blob', 1, _hex_digest_to_blob, deterministic=True)
+    conn.execute('''
+        CREATE TABLE files_v2 (
             id INTEGER PRIMARY KEY,
-            md5sum TEXT,
+            md5sum BLOB,
             size INTEGER,
             last_modified INTEGER,
-            path TEXT UNIQUE
+            path TEXT UNIQUE,
+            partial_md5 BLOB,
+            st_dev INTEGER,
+            st_ino INTEGER
         )
     ''')
-    conn.commit()
-    conn.close()
+    conn.execute('''
+        INSERT INTO files_v2 (id, md5sum, size, last_modified, path, partial_md5, st_dev, st_ino)
+        SELECT id, hex_digest_to_blob(md5sum), size,
+               CASE WHEN md5sum IS NOT NULL AND hex_digest_to_blob(md5sum) IS NULL THEN NULL
+                    ELSE last_modified END,
+               path, hex_digest_to_blob(partial_md5), st_dev, st_ino
+        FROM files
+    ''')
+    conn.execute("DROP TABLE files")
+    conn.execute("ALTER TABLE files_v2 RENAME TO files")
+
+
+def _migrate_to_v3(conn, fetch_size=10000):
+    """Move the directory part of every path into the directories table."""
+    conn.execute(DIRECTORIES_TABLE_SQL)
+    conn.execute(FILES_TABLE_SQL.format(table='files_v3'))
+    directory_ids = {}
+    cursor = conn.execute('''
+        SELECT id, path, md5sum, size, last_modified, partial_md5, st_dev, st_ino FROM files
+        WHERE path IS NOT NULL
+    ''')
+    for rows in iter(lambda: cursor.fetchmany(fetch_size), []):
+        file_rows = []
+        for file_id, path, *values in rows:
+            dir_path, name = _split_path(path)
+            if dir_path not in directory_ids:
+                directory_ids[dir_path] = _directory_id(conn, dir_path)
+            file_rows.append((file_id, directory_ids[dir_path], name, *values))
+        conn.executemany('''
+            INSERT INTO files_v3 (id, dir_id, name, md5sum, size, last_modified, partial_md5, st_dev, st_ino)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', file_rows)
+    conn.execute("DROP TABLE files")
+    conn.execute("ALTER TABLE files_v3 RENAME TO files")
+
+
+def _migrate_to_v4(conn):
+    """Add the dup_groups table, filled from the files already stored."""
+    conn.execute(DUP_GROUPS_TABLE_SQL)
+    conn.execute(f'''
+        INSERT INTO dup_groups (md5sum, size, member_count, inode_count)
+        SELECT md5sum, MAX(size), COUNT(*), COUNT(DISTINCT {INODE_KEY}) FROM files
+        WHERE md5sum IS NOT NULL
+        GROUP BY md5sum
+    ''')
+
+
+def _migrate_to_v5(conn):
+    """Add the last_verified column, with every file not yet verified."""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(files)")]
+    if 'last_verified' not in columns:  # Already there if the table was rebuilt by _migrate_to_v3
+        conn.execute("ALTER TABLE files ADD COLUMN last_verified INTEGER NOT NULL DEFAULT 0")
+
+
+def _migrate_to_v6(conn):
+    """Add the content_verified column, with no file's content verified yet."""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(files)")]
+    if 'content_verified' not in columns:
+        conn.execute("ALTER TABLE files ADD COLUMN content_verified INTEGER NOT NULL DEFAULT 0")
+
+
+def _migrate_to_v7(conn):
+    """Add the scans table and the scan_generation column."""
+    conn.execute(SCANS_TABLE_SQL)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(files)")]
+    if 'scan_generation' not in columns:
+        conn.execute("ALTER TABLE files ADD COLUMN scan_generation INTEGER NOT NULL DEFAULT 0")
+
+
+def _migrate_to_v8(conn):
+    """Add the scan_checkpoints table."""
+    conn.execute(SCAN_CHECKPOINTS_TABLE_SQL)
+
+
+# Migrations indexed by the version they upgrade from
+MIGRATIONS = (
+    _migrate_to_v1, _migrate_to_v2, _migrate_to_v3, _migrate_to_v4, _migrate_to_v5, _migrate_to_v6,
+    _migrate_to_v7, _migrate_to_v8,
+)
+
+
+def initialize_db(db_path):
+    """
+    Initialize the database, creating the tables or upgrading an older schema in place.
+
+    The schema version is kept in PRAGMA user_version. Every migration needed to bring
+    an existing database up to SCHEMA_VERSION runs in a single transaction, so an
+    interrupted upgrade leaves the database as it was.
+
+    Args:
+        db_path (str): The path to the database file.
+    """
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            exists = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'files'"
+            ).fetchone()
+            if version > SCHEMA_VERSION:
+                raise Exception(f"Database {db_path} has schema version {version}, "
+                                f"newer than the supported version {SCHEMA_VERSION}")
+            if not exists:
+                conn.execute(DIRECTORIES_TABLE_SQL)
+                conn.execute(FILES_TABLE_SQL.format(table='files'))
+                conn.execute(DUP_GROUPS_TABLE_SQL)
+                conn.execute(SCANS_TABLE_SQL)
+                conn.execute(SCAN_CHECKPOINTS_TABLE_SQL)
+            else:
+                for from_version in range(version, SCHEMA_VERSION):
+                    logging.info(f"Upgrading database schema from version {from_version} to {from_version + 1}")
+                    MIGRATIONS[from_version](conn)
+            for sql in SCHEMA_INDEXES_SQL + DUP_GROUPS_TRIGGERS_SQL:
+                conn.execute(sql)
+            conn.execute(FILE_PATHS_VIEW_SQL)
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+
+def _split_path(path):
+    """
+    Split a path into its directory and base name.
+
+    Returns:
+        tuple: The directory, ending in a separator (or empty for a bare file name), and
+        the base name. Concatenating them gives back the original path.
+    """
+    i = max(path.rfind(sep) for sep in _SEPARATORS) + 1
+    return path[:i], path[i:]
+
+
+def _directory_id(conn, dir_path):
+    """
+    Return the id of a directory in the directories table, adding it and any missing
+    ancestors.
+
+    Args:
+        conn (sqlite3.Connection): The connection to use, inside a write transaction.
+        dir_path (str): The directory, as returned by _split_path.
+    """
+    row = conn.execute("SELECT id FROM directories WHERE path = ?", (dir_path,)).fetchone()
+    if row:
+        return row[0]
+    parent_id, name = None, ''
+    if dir_path[:-1]:  # Neither empty nor a root separator
+        parent_path, name = _split_path(dir_path[:-1])
+        parent_id = _directory_id(conn, parent_path)
+    # Another connection may have added the directory since it was looked up
+    conn.execute("INSERT INTO directories (parent_id, name, path) VALUES (?, ?, ?) ON CONFLICT(path) DO NOTHING",
+                 (parent_id, name, dir_path))
+    return conn.execute("SELECT id FROM directories WHERE path = ?", (dir_path,)).fetchone()[0]
+
+
+def path_prefix_bounds(prefix):
+    """
+    Turn a path prefix into bounds for a range scan on the path index.
+
+    Args:
+        prefix (str): The path prefix.
+
+    Returns:
+        tuple: The inclusive lower and exclusive upper bound of the paths that start
+        with the prefix.
+    """
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _path_prefix_conditions(prefix):
+    """
+    Build the conditions selecting the files whose path starts with a prefix.
+
+    Returns:
+        list: (condition, params) pairs over the directories and files tables, each a
+        range scan on the directory path or file name index. A file matches the prefix
+        if it meets any of them.
+    """
+    dir_path, name = _split_path(prefix)
+    conditions = [("directories.path >= ? AND directories.path < ?", path_prefix_bounds(prefix))]
+    if name:
+        conditions.append(("directories.path = ? AND files.name >= ? AND files.name < ?",
+                           (dir_path, *path_prefix_bounds(name))))
+    return conditions
+
+
+def _prefix_filter(prefix):
+    """Combine _path_prefix_conditions into one (condition, params) pair, true for every file without a prefix."""
+    if not prefix:
+        return "1", ()
+    conditions = _path_prefix_conditions(prefix)
+    return (' OR '.join(f"({condition})" for condition, _ in conditions),
+            tuple(param for _, params in conditions for param in params))
+
+
+def regex_literal_prefix(pattern):
+    """
+    Find the literal text that every path matched by a regex pattern must start with.
+
+    Only patterns anchored with ^ or \\A have one. The scan stops at the first construct
+    it is not sure about, so the prefix may be shorter than it could be but is never
+    wrong.
+
+    Args:
+        pattern (str): The regex pattern.
+
+    Returns:
+        str: The literal prefix, or an empty string if there is none.
+    """
+    if pattern.startswith('^'):
+        i = 1
+    elif pattern.startswith('\\A'):
+        i = 2
+    else:
+        return ''
+    if '|' in pattern:  # An alternative may start with anything
+        return ''
+    prefix = []
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            if i + 1 == len(pattern) or pattern[i + 1].isalnum():
+                break  # A class, anchor or back reference rather than an escaped character
+            literal, i = pattern[i + 1], i + 2
+        elif c in _REGEX_SPECIAL:
+            break
+        else:
+            literal, i = c, i + 1
+        quantifier = pattern[i:i + 1]
+        if quantifier in ('*', '?', '{'):
+            break  # The character is optional
+        prefix.append(literal)
+        if quantifier == '+':
+            break
+    return ''.join(prefix)
+
+
+@lru_cache(maxsize=256)
+def _compile_regex(pattern):
+    return re.compile(pattern)
+
+
+def _regexp(pattern, value):
+    """The REGEXP SQL function: whether the pattern matches anywhere in the value."""
+    return value is not None and _compile_regex(pattern).search(value) is not None
+
+
+def _file_fingerprint(path, size, last_modified):
+    if size is None or last_modified is None:
+        return None
+    return hash((path, size, int(float(last_modified))))
+
+
+class KnownFiles:
+    """
+    A compact snapshot of the size and last modified time stored for every file under a
+    scan root, used to skip unchanged files without querying the database per file.
+
+    Each row is reduced to a 64-bit fingerprint of its path, size and last modified time,
+    kept in a sorted array, so the snapshot costs 8 bytes per file. The fingerprints use
+    Python's string hashing, so a snapshot is only valid in the process that loaded it.
+    """
+
+    def __init__(self, fingerprints=None):
+        self._fingerprints = fingerprints if fingerprints is not None else array('q')
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    @classmethod
+    def load(cls, db_path, root, fetch_size=10000, hashed_only=False):
+        """
+        Load the rows stored under a directory. See FileIndex.known_files.
+
+        Args:
+            db_path (str): The path to the database file.
+            root (str): The path to the directory being scanned.
+            fetch_size (int): The number of rows fetched from SQLite at a time.
+            hashed_only (bool): Leave out the rows without a checksum, such as those a
+                staged scan recorded, so that a full scan hashes them.
+
+        Returns:
+            KnownFiles: The snapshot.
+        """
+        with open_index(db_path) as index:
+            return index.known_files(root, fetch_size, hashed_only)
+
+    def is_unchanged(self, path, size, last_modified):
+        """
+        Check whether a file was stored with this size and last modified time.
+
+        Returns:
+            bool: True if the file is in the snapshot and has not changed.
+        """
+        fingerprint = _file_fingerprint(path, size, last_modified)
+        i = bisect_left(self._fingerprints, fingerprint)
+        return i < len(self._fingerprints) and self._fingerprints[i] == fingerprint
+
+
+class DuplicateGroup(namedtuple('DuplicateGroup', 'md5sum size paths inodes')):
+    """
+    Files with the same MD5 checksum: the checksum, the size of each file, a tuple of
+    their paths and the number of distinct inodes among them.
+    """
+
+    __slots__ = ()
+
+    @property
+    def wasted_bytes(self):
+        """The space that removing all but one copy would free; hardlinks cost nothing."""
+        return (self.inodes - 1) * self.size
+
+
+def _duplicate_group(md5sum, rows):
+    """Build a DuplicateGroup from (md5sum, size, path, inode key) rows."""
+    paths, inodes, size = [], set(), 0
+    for _, size, path, inode in rows:
+        paths.append(path)
+        inodes.add(inode)
+    return DuplicateGroup(_blob_to_digest(md5sum), size, tuple(paths), len(inodes))
+
+
+def _file_row(path, md5sum, size, last_modified, st_dev, st_ino):
+    """Build the parameters of UPSERT_FILE_SQL, stat'ing the file once for any missing value."""
+    if None in (size, last_modified, st_dev, st_ino):
+        st = os.stat(path)
+        size = st.st_size if size is None else size
+        last_modified = get_stat_mtime_in_ms(st) if last_modified is None else last_modified
+        st_dev = st.st_dev if st_dev is None else st_dev
+        st_ino = st.st_ino if st_ino is None else st_ino
+    return path, _digest_to_blob(md5sum), size, last_modified, st_dev, st_ino
+
+def _staged_hashes_row(path, partial_md5, md5sum):
+    """Build the parameters of UPDATE_STAGED_HASHES_SQL."""
+    return _digest_to_blob(partial_md5), _digest_to_blob(md5sum), path
+
+
+def _upsert_file(conn, row):
+    """Apply UPSERT_FILE_SQL for a row built by _file_row."""
+    path, *values = row
+    dir_path, name = _split_path(path)
+    conn.execute(UPSERT_FILE_SQL, (_directory_id(conn, dir_path), name, *values))
+
+
+def _delete_file(conn, path):
+    """Apply DELETE_FILE_SQL for a path."""
+    conn.execute(DELETE_FILE_SQL, _split_path(path))
+
+
+def _verified_column(content):
+    """Return the column recording when a file's content, or only its metadata, was verified."""
+    return 'content_verified' if content else 'last_verified'
+
+
+def _mark_verified(conn, row):
+    """Set the verification time of the paths in a (timestamp, paths, content) row."""
+    timestamp, paths, content = row
+    conn.executemany(f"UPDATE files SET {_verified_column(content)} = ? WHERE {FILE_BY_PATH}",
+                     ((timestamp, *_split_path(path)) for path in paths))
+
+
+def _mark_seen(conn, row):
+    """Stamp the file in a (generation, path) row with the generation of the scan that saw it."""
+    generation, path = row
+    conn.execute(f"UPDATE files SET scan_generation = ? WHERE {FILE_BY_PATH}", (generation, *_split_path(path)))
+
+
+def _record_checkpoint(conn, row):
+    """Record a completed directory from a (generation, directory) row in place of its subdirectories."""
+    generation, directory = row
+    conn.execute("DELETE FROM scan_checkpoints WHERE generation = ? AND path >= ? AND path < ?",
+                 (generation, *path_prefix_bounds(os.path.join(directory, ''))))
+    conn.execute("INSERT OR IGNORE INTO scan_checkpoints (generation, path) VALUES (?, ?)", (generation, directory))
+
+
+def _update_staged_hashes(conn, row):
+    """Apply UPDATE_STAGED_HASHES_SQL for a row built by _staged_hashes_row."""
+    partial_md5, md5sum, path = row
+    conn.execute(UPDATE_STAGED_HASHES_SQL, (partial_md5, md5sum, *_split_path(path)))
+
+
+def _connect(db_path):
+    """Open a connection with the performance pragmas used by every long-lived connection."""
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")  # Safe in WAL mode; syncs at checkpoints only
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KIB}")
+    conn.create_function('regexp', 2, _regexp, deterministic=True)
+    return conn
+
+
+_open_indexes = {}  # The FileIndex currently open with a with statement for each database path
+_open_indexes_lock = threading.Lock()
+
+
+class _ThreadConnection:
+    """A thread's connection, held in thread-local storage so that it is released when the thread exits."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+
+class FileIndex:
+    """
+    The file database, accessed through one persistent connection per thread.
+
+    Connections are opened on first use in each thread with the pragmas set by _connect,
+    and kept until the thread exits or the index is closed, so repeated calls share a
+    warm page cache instead of each paying for a new connection, and the threads of
+    short-lived pools don't leave theirs open. Queries returning several rows return iterators
+    that stream them from SQLite.
+
+    While an index is open as a context manager, the module-level functions called with
+    the same database path use it instead of opening a connection of their own.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with _open_indexes_lock:
+            _open_indexes.setdefault(self.db_path, self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the connections opened by every thread."""
+        with _open_indexes_lock:
+            if _open_indexes.get(self.db_path) is self:
+                del _open_indexes[self.db_path]
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+
+    def connection(self):
+        """Return the calling thread's connection, opening it if needed."""
+        owner = getattr(self._local, 'owner', None)
+        if owner is None:
+            conn = _connect(self.db_path)
+            with self._lock:
+                self._connections.append(conn)
+            owner = self._local.owner = _ThreadConnection(conn)
+            weakref.finalize(owner, self._release, conn)  # Once the thread's locals are cleared
+        return owner.conn
+
+    def _release(self, conn):
+        with self._lock:
+            if conn not in self._connections:
+                return  # Already closed with the index
+            self._connections.remove(conn)
+        conn.close()
+
+    def initialize(self):
+        """Create or upgrade the schema, as initialize_db."""
+        initialize_db(self.db_path)
+
+    def _write(self, write, params, description):
+        delay = RETRY_DELAY
+        conn = self.connection()
+        for attempt in range(MAX_RETRIES):
+            try:
+                with conn:
+                    write(conn, params)
+                return
+            except sqlite3.OperationalError as e:
+                if "database is locked" not in str(e):
+                    raise
+                time.sleep(delay)
+                delay *= 2
+        raise Exception(f"Failed to {description} after {MAX_RETRIES} retries due to database lock")
+
+    def _iterate(self, sql, params=(), fetch_size=1000):
+        cursor = self.connection().execute(sql, params)
+        for rows in iter(lambda: cursor.fetchmany(fetch_size), []):
+            yield from rows
+
+    def get_file_info(self, file_path):
+        """Return the stored size and last modified time of a file, or None."""
+        return self.connection().execute(
+            f"SELECT size, last_modified FROM files WHERE {FILE_BY_PATH}", _split_path(file_path)
+        ).fetchone()
+
+    def get_all_files_info(self, fetch_size=1000):
+        """Iterate over the path, size and last modified time of every file."""
+        return self._iterate("SELECT path, size, last_modified FROM file_paths", fetch_size=fetch_size)
+
+    def files_in_path_order(self, batch_size=1000):
+        """
+        Yield batches of the path, size and last modified time of every file, sorted by
+        directory path and file name.
+
+        The rows walk the directory path and (dir_id, name) indexes, so files in the same
+        directory are visited together without a sort. As in least_recently_verified,
+        each batch is read with a query of its own that continues after the last path of
+        the previous one, so no cursor is held open while a batch is used.
+        """
+        key = ('', '')
+        while True:
+            # CROSS JOIN keeps directories as the outer loop; ordering by id as well lets
+            # SQLite see that the names of each directory already come sorted from the index
+            rows = self.connection().execute('''
+                SELECT directories.path, files.name, size, last_modified
+                FROM directories CROSS JOIN files ON files.dir_id = directories.id
+                WHERE directories.path >= ? AND (directories.path > ? OR files.name > ?)
+                ORDER BY directories.path, directories.id, files.name LIMIT ?
+            ''', (key[0], *key, batch_size)).fetchall()
+            if not rows:
+                return
+            key = rows[-1][:2]
+            yield [(dir_path + name, size, last_modified) for dir_path, name, size, last_modified in rows]
+
+    def count_files(self, prefix=None):
+        """Return the number of files, or of those whose path starts with prefix."""
+        condition, params = _prefix_filter(prefix)
+        return self.connection().execute(f'''
+            SELECT COUNT(*) FROM files JOIN directories ON directories.id = files.dir_id WHERE {condition}
+        ''', params).fetchone()[0]
+
+    def least_recently_verified(self, verified_before, prefix=None, limit=None, batch_size=1000, content=False):
+        """
+        Yield batches of the path, size and last modified time of the files last verified
+        before a time, the least recently verified first.
+
+        Each batch is read with a query of its own that continues from the last row of
+        the previous one through the verification time index, so no cursor is held open
+        between batches and the rows may be marked as verified as the batches are used.
+
+        Args:
+            verified_before (int): Only files with an older verification time, in
+                milliseconds since the epoch, are returned.
+            prefix (str): Only return files whose path starts with this prefix.
+            limit (int): The maximum number of files to return, or None for no limit.
+            batch_size (int): The number of files in a batch.
+            content (bool): Order by content_verified instead of last_verified, return
+                only files with a checksum, and add the checksum to each row.
+        """
+        column = f"files.{_verified_column(content)}"
+        condition, params = _prefix_filter(prefix)
+        if content:
+            condition = f"md5sum IS NOT NULL AND ({condition})"
+        key = (-1, 0)
+        while limit is None or limit > 0:
+            rows = self.connection().execute(f'''
+                SELECT {column}, files.id, directories.path || files.name, size, last_modified, md5sum
+                FROM files JOIN directories ON directories.id = files.dir_id
+                WHERE {column} < ? AND ({column}, files.id) > (?, ?) AND ({condition})
+                ORDER BY {column}, files.id LIMIT ?
+            ''', (verified_before, *key, *params, batch_size if limit is None else min(batch_size, limit))
+            ).fetchall()
+            if not rows:
+                return
+            key = rows[-1][:2]
+            if limit is not None:
+                limit -= len(rows)
+            if content:
+                yield [(path, size, last_modified, _blob_to_digest(md5sum))
+                       for _, _, path, size, last_modified, md5sum in rows]
+            else:
+                yield [row[2:5] for row in rows]
+
+    def known_files(self, root, fetch_size=10000, hashed_only=False):
+        """
+        Load a KnownFiles snapshot of the rows stored under a directory, or only of those
+        with a checksum if hashed_only is true.
+
+        The rows are selected with a range scan on the directory path index and streamed from
+        SQLite already sorted by fingerprint, so SQLite does the sorting within its own
+        bounded cache and nothing but the final array is held in memory.
+        """
+        low, high = path_prefix_bounds(os.path.join(root, ''))
+        conn = self.connection()
+        conn.create_function('file_fingerprint', 3, _file_fingerprint, deterministic=True)
+        fingerprints = array('q')
+        rows = self._iterate('''
+            SELECT fingerprint FROM (
+                SELECT file_fingerprint(directories.path || files.name, size, last_modified) AS fingerprint
+                FROM directories JOIN files ON files.dir_id = directories.id
+                WHERE directories.path >= ? AND directories.path < ? AND (? = 0 OR md5sum IS NOT NULL)
+            )
+            WHERE fingerprint IS NOT NULL ORDER BY fingerprint
+        ''', (low, high, hashed_only), fetch_size)
+        fingerprints.extend(row[0] for row in rows)
+        logging.debug(f"Loaded {len(fingerprints)} known files under {root}")
+        return KnownFiles(fingerprints)
+
+    def store_file_info(self, path, md5sum, size=None, last_modified=None, st_dev=None, st_ino=None):
+        """Store or update a file, as store_file_info."""
+        self._write(_upsert_file, _file_row(path, md5sum, size, last_modified, st_dev, st_ino),
+                    f"store file info for {path}")
+
+    def store_files(self, rows, chunk_size=WRITE_BATCH_SIZE):
+        """
+        Store or update many files, committing chunk_size of them per transaction.
+
+        Args:
+            rows (iterable): Tuples of the path, MD5 checksum, size, last modified time,
+                device and inode of each file, as passed to store_file_info.
+
+        Returns:
+            int: The number of files stored.
+        """
+        def upsert_rows(conn, chunk):
+            for row in chunk:
+                _upsert_file(conn, row)
+
+        count = 0
+        for chunk in iter_batches((_file_row(*row) for row in rows), chunk_size):
+            self._write(upsert_rows, chunk, f"store file info for {len(chunk)} files")
+            count += len(chunk)
+        return count
+
+    def store_staged_hashes(self, path, partial_md5=None, md5sum=None):
+        """Record staged hashing checksums, as store_staged_hashes."""
+        self._write(_update_staged_hashes, _staged_hashes_row(path, partial_md5, md5sum),
+                    f"store staged hashes for {path}")
+
+    def get_partial_hash_candidates(self):
+        """Iterate over the path and size of the files that need a partial checksum."""
+        return self._iterate(f'''
+            SELECT path, size FROM file_paths
+            WHERE partial_md5 IS NULL AND size IN (
+                SELECT size FROM files
+                GROUP BY size HAVING COUNT(DISTINCT {INODE_KEY}) > 1 AND SUM(md5sum IS NULL) > 0
+            )
+        ''')
+
+    def get_full_hash_candidates(self):
+        """Iterate over the path and size of the files that need a full checksum."""
+        return self._iterate(f'''
+            SELECT path, size FROM file_paths
+            WHERE md5sum IS NULL AND (size, partial_md5) IN (
+                SELECT size, partial_md5 FROM files
+                WHERE partial_md5 IS NOT NULL
+                GROUP BY size, partial_md5 HAVING COUNT(DISTINCT {INODE_KEY}) > 1
+            )
+        ''')
+
+    def remove_file_info(self, file_path):
+        """Remove a file."""
+        self._write(_delete_file, file_path, f"remove file info for {file_path}")
+
+    def remove_files(self, paths, chunk_size=DELETE_CHUNK_SIZE):
+        """
+        Remove many files, deleting chunk_size of them per transaction.
+
+        Returns:
+            int: The number of paths processed.
+        """
+        def delete_paths(conn, chunk):
+            conn.executemany(DELETE_FILE_SQL, (_split_path(path) for path in chunk))
+
+        count = 0
+        for chunk in iter_batches(paths, chunk_size):
+            self._write(delete_paths, chunk, f"remove file info for {len(chunk)} files")
+            count += len(chunk)
+        return count
+
+    def remove_files_by_regex(self, regex_pattern, chunk_size=DELETE_CHUNK_SIZE):
+        """
+        Remove every file whose path the regex pattern matches, anywhere in the path.
+
+        The pattern is evaluated inside SQLite by the REGEXP function. If it is anchored
+        with a literal prefix, only the rows under that prefix are read, through range
+        scans on the directory path and file name indexes. The matching ids are
+        collected first and then deleted chunk_size rows per transaction, so the write
+        lock is never held for long.
+
+        Returns:
+            int: The number of files removed.
+        """
+        prefix = regex_literal_prefix(regex_pattern)
+        queries = _path_prefix_conditions(prefix) if prefix else [("1", ())]
+        ids = array('q')
+        for condition, params in queries:
+            rows = self._iterate(MATCHING_FILES_SQL.format(condition=condition), (*params, regex_pattern))
+            ids.extend(row[0] for row in rows)
+
+        def delete_ids(conn, chunk):
+            conn.executemany("DELETE FROM files WHERE id = ?", ((file_id,) for file_id in chunk))
+
+        for start in range(0, len(ids), chunk_size):
+            self._write(delete_ids, ids[start:start + chunk_size],
+                        f"remove file info matching pattern '{regex_pattern}'")
+        return len(ids)
+
+    def begin_scan(self, root, resume=False):
+        """
+        Record the start of a scan of a directory and return its generation number.
+
+        With resume, the generation of the latest unfinished scan of the same directory
+        is returned instead, if there is one. Otherwise the checkpoints of earlier
+        unfinished scans of the directory are discarded.
+        """
+        conn = self.connection()
+        with conn:
+            if resume:
+                row = conn.execute(
+                    "SELECT MAX(generation) FROM scans WHERE root = ? AND finished IS NULL", (root,)
+                ).fetchone()
+                if row[0] is not None:
+                    return row[0]
+            conn.execute('''
+                DELETE FROM scan_checkpoints WHERE generation IN (
+                    SELECT generation FROM scans WHERE root = ? AND finished IS NULL
+                )
+            ''', (root,))
+            cursor = conn.execute("INSERT INTO scans (root, started) VALUES (?, ?)",
+                                  (root, int(time.time() * 1000)))
+        return cursor.lastrowid
+
+    def scan_checkpoints(self, generation):
+        """Return the set of directories whose subtree the scan has recorded as complete."""
+        return {path for (path,) in self._iterate(
+            "SELECT path FROM scan_checkpoints WHERE generation = ?", (generation,))}
+
+    def finish_scan(self, generation, root, unreadable=()):
+        """
+        Remove the files under a scanned directory that the scan did not see.
+
+        Every file under root that was not stamped with the scan's generation is deleted
+        with one range delete over the directory path index. The paths that could not be
+        read are stamped first, along with everything under them, so they are kept.
+
+        Args:
+            generation (int): The generation returned by begin_scan.
+            root (str): The directory that was scanned.
+            unreadable (iterable): The directories under root that could not be listed
+                and the entries that could not be read.
+
+        Returns:
+            int: The number of files removed.
+        """
+        def sweep(conn, params):
+            for path in unreadable:
+                # Either a file or a directory, as the entry could not be stat'ed
+                conn.execute(f"UPDATE files SET scan_generation = ? WHERE {FILE_BY_PATH}",
+                             (generation, *_split_path(path)))
+                conn.execute('''
+                    UPDATE files SET scan_generation = ? WHERE dir_id IN (
+                        SELECT id FROM directories WHERE path >= ? AND path < ?
+                    )
+                ''', (generation, *path_prefix_bounds(os.path.join(path, ''))))
+            cursor = conn.execute('''
+                DELETE FROM files WHERE scan_generation < ? AND dir_id IN (
+                    SELECT id FROM directories WHERE path >= ? AND path < ?
+                )
+            ''', (generation, *path_prefix_bounds(os.path.join(root, ''))))
+            removed.append(cursor.rowcount)
+            conn.execute("UPDATE scans SET finished = ? WHERE generation = ?", (int(time.time() * 1000), generation))
+            conn.execute("DELETE FROM scan_checkpoints WHERE generation = ?", (generation,))
+
+        removed = []
+        self._write(sweep, None, f"remove the files no longer under {root}")
+        return removed[-1]
+
+    def get_md5_by_path(self, file_path):
+        """Return the stored MD5 checksum of a file, or None."""
+        row = self.connection().execute(
+            f"SELECT md5sum FROM files WHERE {FILE_BY_PATH}", _split_path(file_path)
+        ).fetchone()
+        return _blob_to_digest(row[0]) if row else None
+
+    def get_md5_by_inode(self, st_dev, st_ino, size, last_modified):
+        """Return the MD5 checksum stored for another path to the same unchanged inode, or None."""
+        row = self.connection().execute('''
+            SELECT md5sum FROM files
+            WHERE st_dev = ? AND st_ino = ? AND size = ? AND last_modified = ? AND md5sum IS NOT NULL
+            LIMIT 1
+        ''', (st_dev, st_ino, size, last_modified)).fetchone()
+        return _blob_to_digest(row[0]) if row else None
+
+    def check_for_duplicates(self, md5sum):
+        """Iterate over (path,) tuples of the files with an MD5 checksum."""
+        return self._iterate("SELECT path FROM file_paths WHERE md5sum = ?", (_digest_to_blob(md5sum),))
+
+    def find_duplicates_with_min_count(self, min_count=1):
+        """Iterate over (md5sum, paths) pairs of checksums shared by more than min_count files."""
+        for group in self.iter_duplicate_groups(min_count):
+            yield group.md5sum, list(group.paths)
+
+    def iter_duplicate_groups(self, min_count=1, order_by='hash'):
+        """
+        Iterate over the DuplicateGroups of more than min_count files.
+
+        The checksums shared by several files are read from dup_groups. With
+        order_by='hash' the groups are streamed in checksum order through the md5sum
+        index, so only one group is held in memory at a time. With order_by='wasted' the
+        groups wasting the most space come first, and the paths of each group are looked
+        up through the index.
+        """
+        if order_by == 'hash':
+            rows = self._iterate(f'''
+                SELECT md5sum, size, path, {INODE_KEY} FROM file_paths
+                WHERE md5sum IN (
+                    SELECT md5sum FROM dup_groups WHERE member_count > 1 AND member_count > ?
+                )
+                ORDER BY md5sum
+            ''', (min_count,))
+            for md5sum, group_rows in groupby(rows, key=itemgetter(0)):
+                yield _duplicate_group(md5sum, group_rows)
+        elif order_by == 'wasted':
+            ranked = self._iterate('''
+                SELECT md5sum FROM dup_groups WHERE member_count > 1 AND member_count > ?
+                ORDER BY wasted_bytes DESC
+            ''', (min_count,))
+            for (md5sum,) in ranked:
+                rows = self.connection().execute(f'''
+                    SELECT md5sum, size, path, {INODE_KEY} FROM file_paths WHERE md5sum = ?
+                ''', (md5sum,))
+                yield _duplicate_group(md5sum, rows)
+        else:
+            raise ValueError(f"Invalid duplicate group order: {order_by}")
+
+
+@contextmanager
+def open_index(db_path):
+    """
+    Use the FileIndex open for a database, or a temporary one closed on exit.
+
+    Args:
+        db_path (str): The path to the database file.
+
+    Yields:
+        FileIndex: The index.
+    """
+    with _open_indexes_lock:
+        index = _open_indexes.get(db_path)
+    if index is not None:
+        yield index
+        return
+    index = FileIndex(db_path)
+    try:
+        yield index
+    finally:
+        index.close()
+
+
+def open_worker_index(db_path):
+    """
+    Open a FileIndex for the rest of the process, so that the module-level functions
+    called in a worker process share one connection instead of opening one per call.
+    Pass it as the initializer of run_batches_in_processes; the connection is closed
+    when the worker exits.
+
+    Args:
+        db_path (str): The path to the database file.
+    """
+    with _open_indexes_lock:
+        _open_indexes.setdefault(db_path, FileIndex(db_path))
+
 
 def get_file_info(db_path, file_path):
     """
@@ -44,14 +1097,8 @@ def get_file_info(db_path, file_path):
     Returns:
         tuple: A tuple containing the size and last modified time of the file, or None if the file is not found.
     """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT size, last_modified FROM files WHERE path = ?
-    ''', (file_path,))
-    result = cursor.fetchone()
-    conn.close()
-    return result
+    with open_index(db_path) as index:
+        return index.get_file_info(file_path)
 
 def get_all_files_info(db_path):
     """
@@ -63,47 +1110,71 @@ def get_all_files_info(db_path):
     Returns:
         list: A list of tuples, each containing the file path, size, and last modified time.
     """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute("SELECT path, size, last_modified FROM files")
-    files_info = cursor.fetchall()
-    conn.close()
-    return files_info
+    with open_index(db_path) as index:
+        return list(index.get_all_files_info())
 
-def store_file_info(db_path, path, md5sum):
+def store_file_info(db_path, path, md5sum, size=None, last_modified=None, st_dev=None, st_ino=None):
     """
     Store or update the information of a file in the database.
 
+    Any partial checksum stored for the file is cleared, since it may no longer match
+    the file's contents.
+
     Args:
         db_path (str): The path to the database file.
         path (str): The path to the file.
-        md5sum (str): The MD5 checksum of the file.
+        md5sum (str): The MD5 checksum of the file, or None to record only its size and
+            last modified time for staged hashing.
+        size (int): The size of the file, if already known.
+        last_modified (int): The last modified time of the file in milliseconds, if
+            already known.
+        st_dev (int): The device the file resides on, if already known.
+        st_ino (int): The inode number of the file, if already known.
     """
-    size = os.path.getsize(path)
-    last_modified = get_file_mtime_in_ms(path)  # Use the utility function
-    retries = MAX_RETRIES
-    while retries > 0:
-        try:
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO files (path, md5sum, size, last_modified) VALUES (?, ?, ?, ?)
-                ON CONFLICT(path) DO UPDATE SET md5sum=excluded.md5sum, size=excluded.size, last_modified=excluded.last_modified
-            ''', (path, md5sum, size, last_modified))
-            conn.commit()
-            conn.close()
-            break
-        except sqlite3.OperationalError as e:
-            if "database is locked" in str(e):
-                retries -= 1
-                time.sleep(0.1)  # Wait for 100ms before retrying
-            else:
-                raise
-        finally:
-            if conn:
-                conn.close()
-    if retries == 0:
-        raise Exception(f"Failed to store file info for {path} after {MAX_RETRIES} retries due to database lock")
+    with open_index(db_path) as index:
+        index.store_file_info(path, md5sum, size=size, last_modified=last_modified, st_dev=st_dev, st_ino=st_ino)
+
+def store_staged_hashes(db_path, path, partial_md5=None, md5sum=None):
+    """
+    Record the partial and/or full MD5 checksum computed for a file by staged hashing.
+
+    Args:
+        db_path (str): The path to the database file.
+        path (str): The path to the file.
+        partial_md5 (str): The partial MD5 checksum, or None to leave it unchanged.
+        md5sum (str): The full MD5 checksum, or None to leave it unchanged.
+    """
+    with open_index(db_path) as index:
+        index.store_staged_hashes(path, partial_md5=partial_md5, md5sum=md5sum)
+
+def get_partial_hash_candidates(db_path):
+    """
+    Find files that need a partial checksum because their size matches another file
+    and at least one file of that size has not been fully hashed. Hardlinks to the
+    same inode do not count as a match.
+
+    Args:
+        db_path (str): The path to the database file.
+
+    Returns:
+        list: A list of tuples, each containing the file path and size.
+    """
+    with open_index(db_path) as index:
+        return list(index.get_partial_hash_candidates())
+
+def get_full_hash_candidates(db_path):
+    """
+    Find files that need a full checksum because their size and partial checksum both
+    match another file that is not a hardlink to the same inode.
+
+    Args:
+        db_path (str): The path to the database file.
+
+    Returns:
+        list: A list of tuples, each containing the file path and size.
+    """
+    with open_index(db_path) as index:
+        return list(index.get_full_hash_candidates())
 
 def remove_file_info(db_path, file_path):
     """
@@ -113,59 +1184,75 @@ def remove_file_info(db_path, file_path):
         db_path (str): The path to the database file.
         file_path (str): The path to the file.
     """
-    retries = MAX_RETRIES
-    while retries > 0:
-        try:
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM files WHERE path = ?", (file_path,))
-            conn.commit()
-            conn.close()
-            break
-        except sqlite3.OperationalError as e:
-            if "database is locked" in str(e):
-                retries -= 1
-                time.sleep(0.1)  # Wait for 100ms before retrying
-            else:
-                raise
-        finally:
-            if conn:
-                conn.close()
-    if retries == 0:
-        raise Exception(f"Failed to remove file info for {file_path} after {MAX_RETRIES} retries due to database lock")
+    with open_index(db_path) as index:
+        index.remove_file_info(file_path)
 
 def remove_files_by_regex(db_path, regex_pattern):
     """
     Remove records associated with files matching the regex pattern from the database.
 
+    The pattern may match anywhere in a path; anchor it with ^ to match from the start,
+    which also lets a literal prefix be looked up through the path index.
+
     Args:
         db_path (str): The path to the database file.
         regex_pattern (str): The regex pattern to match file paths.
+
+    Returns:
+        int: The number of records removed.
     """
-    retries = MAX_RETRIES
-    while retries > 0:
-        try:
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            cursor.execute("SELECT path FROM files")
-            all_paths = cursor.fetchall()
-            matching_paths = [path[0] for path in all_paths if re.match(regex_pattern, path[0])]
-            if matching_paths:
-                cursor.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in matching_paths])
-                conn.commit()
-            conn.close()
-            break
-        except sqlite3.OperationalError as e:
-            if "database is locked" in str(e):
-                retries -= 1
-                time.sleep(0.1)  # Wait for 100ms before retrying
-            else:
-                raise
-        finally:
-            if conn:
-                conn.close()
-    if retries == 0:
-        raise Exception(f"Failed to remove file info matching pattern '{regex_pattern}' after {MAX_RETRIES} retries due to database lock")
+    with open_index(db_path) as index:
+        return index.remove_files_by_regex(regex_pattern)
+
+
+def begin_scan(db_path, root, resume=False):
+    """
+    Record the start of a scan of a directory.
+
+    Args:
+        db_path (str): The path to the database file.
+        root (str): The directory being scanned.
+        resume (bool): Continue the latest unfinished scan of the directory, if any.
+
+    Returns:
+        int: The scan's generation number, to stamp on the files it sees.
+    """
+    with open_index(db_path) as index:
+        return index.begin_scan(root, resume)
+
+
+def get_scan_checkpoints(db_path, generation):
+    """
+    Get the directories whose whole subtree a scan has processed.
+
+    Args:
+        db_path (str): The path to the database file.
+        generation (int): The generation of the scan.
+
+    Returns:
+        set: The paths of the directories.
+    """
+    with open_index(db_path) as index:
+        return index.scan_checkpoints(generation)
+
+
+def finish_scan(db_path, generation, root, unreadable=()):
+    """
+    Remove the files under a scanned directory that the scan did not see.
+
+    Args:
+        db_path (str): The path to the database file.
+        generation (int): The generation returned by begin_scan.
+        root (str): The directory that was scanned.
+        unreadable (iterable): The directories under root that could not be listed and
+            the entries that could not be read, whose files are kept.
+
+    Returns:
+        int: The number of files removed.
+    """
+    with open_index(db_path) as index:
+        return index.finish_scan(generation, root, unreadable)
+
 
 def get_md5_by_path(db_path, file_path):
     """
@@ -178,14 +1265,26 @@ def get_md5_by_path(db_path, file_path):
     Returns:
         str: The MD5 checksum of the file, or None if the file is not found.
     """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT md5sum FROM files WHERE path = ?
-    ''', (file_path,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else None
+    with open_index(db_path) as index:
+        return index.get_md5_by_path(file_path)
+
+def get_md5_by_inode(db_path, st_dev, st_ino, size, last_modified):
+    """
+    Retrieve the MD5 checksum already stored for another path to the same inode.
+
+    Args:
+        db_path (str): The path to the database file.
+        st_dev (int): The device the file resides on.
+        st_ino (int): The inode number of the file.
+        size (int): The size of the file.
+        last_modified (int): The last modified time of the file in milliseconds.
+
+    Returns:
+        str: The MD5 checksum, or None if no hashed path with a matching inode, size and
+        last modified time is found.
+    """
+    with open_index(db_path) as index:
+        return index.get_md5_by_inode(st_dev, st_ino, size, last_modified)
 
 def check_for_duplicates(db_path, md5sum):
     """
@@ -198,14 +1297,8 @@ def check_for_duplicates(db_path, md5sum):
     Returns:
         list: A list of file paths that have the same MD5 checksum.
     """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT path FROM files WHERE md5sum = ?
-    ''', (md5sum,))
-    duplicates = cursor.fetchall()
-    conn.close()
-    return duplicates
+    with open_index(db_path) as index:
+        return list(index.check_for_duplicates(md5sum))
 
 def find_duplicates_with_min_count(db_path, min_count=1):
     """
@@ -218,90 +1311,616 @@ def find_duplicates_with_min_count(db_path, min_count=1):
     Returns:
         dict: A dictionary where the keys are MD5 checksums and the values are lists of file paths that have the same MD5 checksum.
     """
-    def fetch_in_chunks(cursor, chunk_size=1000):
-        while True:
-            rows = cursor.fetchmany(chunk_size)
-            if not rows:
-                break
-            for row in rows:
-                yield row
+    with open_index(db_path) as index:
+        return dict(index.find_duplicates_with_min_count(min_count))
 
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT md5sum, GROUP_CONCAT(path) FROM files
-        GROUP BY md5sum HAVING COUNT(*) > ?
-    ''', (min_count,))
+def iter_duplicate_groups(db_path, min_count=1, order_by='hash'):
+    """
+    Stream the groups of duplicate files in the database one at a time.
 
-    duplicates = {}
-    for row in fetch_in_chunks(cursor):
-        md5sum, paths = row
-        duplicates[md5sum] = paths.split(',')
+    Args:
+        db_path (str): The path to the database file.
+        min_count (int): Only groups of more than this many files are returned.
+        order_by (str): 'hash' to stream the groups in checksum order, or 'wasted' to
+            return the groups wasting the most space first.
 
-    conn.close()
-    return duplicates
+    Yields:
+        DuplicateGroup: The checksum, file size, paths and inode count of each group.
+    """
+    with open_index(db_path) as index:
+        yield from index.iter_duplicate_groups(min_count, order_by)
 
 
-def audit_db(db_path, num_threads, process_file):
+class DatabaseWriter:
     """
-    Audit the database for file changes and reprocess files if necessary.
+    A single thread that owns a persistent connection and applies all writes queued by
+    other threads, committing them in batches.
 
-    Args:
-        db_path (str): The path to the database file.
-        num_threads (int): The number of threads to use for concurrent operations.
-        process_file (function): The function to process a file.
-    """
-    batch_size = 100  # Adjust the batch size as needed
-    processed_files_count = 0  # Initialize the counter
-
-    def process_file_info(file_info):
-        nonlocal processed_files_count
-        file_path, db_size, db_last_modified = file_info
-        if not os.path.exists(file_path):
-            logging.info(f"REMOVED: {file_path} (File no longer exists)")
-            remove_file_info(db_path, file_path)
-        else:
-            size = os.path.getsize(file_path)
-            last_modified = get_file_mtime_in_ms(file_path)
-            if size != db_size or last_modified != db_last_modified:
-                logging.info(f"REPROCESSING: {file_path} (Size or last modified time changed)")
-                process_file(file_path, db_path)
-        processed_files_count += 1  # Increment the counter
+    A batch is committed once it holds batch_size writes or its oldest write has waited
+    max_latency seconds, whichever comes first. The connection runs in WAL mode with a
+    busy timeout, so readers are not blocked and lock contention is handled by SQLite
+    rather than by retry loops in every caller.
+
+    Each write is applied under its own savepoint, so a write that fails, such as a
+    path that cannot be encoded, is rolled back and counted in errors without losing
+    the rest of its batch. If the writer itself fails, for instance because the
+    database cannot be opened or a commit fails, it discards any further writes, and
+    flush() and close() raise. Callers that rely on every write having been committed
+    check failed once the writer is flushed or closed.
+
+    If metrics are given, the time of each commit is recorded as the write stage, the
+    rows in each batch as write_batch_rows, each retry on a locked database in the
+    lock_retries counter and each failed write in the write_errors counter.
+
+    Use it as a context manager, or call start() and close().
+    """
+
+    _FLUSH = object()
+    _STOP = object()
+
+    def __init__(self, db_path, batch_size=WRITE_BATCH_SIZE, max_latency=WRITE_BATCH_LATENCY, metrics=None):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.metrics = metrics
+        self.rows_written = 0
+        self.batches_committed = 0
+        self.lock_retries = 0
+        self.errors = 0  # Writes that failed and were rolled back
+        self.error = None  # The exception that stopped the writer, if any
+        self._queue = Queue()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop()
+        if exc_type is None:  # Don't hide the exception that ended the with block
+            self._check()
+
+    @property
+    def failed(self):
+        """Whether any write queued so far was not committed."""
+        return self.error is not None or self.errors > 0
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        """Commit all queued writes and stop the writer thread, raising if the writer failed."""
+        self._stop()
+        self._check()
+
+    def flush(self):
+        """Block until every write queued so far has been committed, raising if the writer failed."""
+        done = threading.Event()
+        self._queue.put((self._FLUSH, done))
+        done.wait()
+        self._check()
+
+    def _stop(self):
+        self._queue.put(self._STOP)
+        self._thread.join()
+        logging.debug(f"Writer committed {self.rows_written} rows in {self.batches_committed} batches "
+                      f"with {self.errors} errors")
+
+    def _check(self):
+        if self.error is not None:
+            raise Exception(f"Database writer for {self.db_path} failed: {self.error}") from self.error
+
+    def store_file_info(self, path, md5sum, size=None, last_modified=None, st_dev=None, st_ino=None):
+        """Queue the equivalent of store_file_info."""
+        self._queue.put((_upsert_file, _file_row(path, md5sum, size, last_modified, st_dev, st_ino)))
+
+    def remove_file_info(self, file_path):
+        """Queue the equivalent of remove_file_info."""
+        self._queue.put((_delete_file, file_path))
+
+    def mark_seen(self, path, generation):
+        """Queue stamping a file with the generation of the scan that saw it."""
+        self._queue.put((_mark_seen, (generation, path)))
 
-    retries = MAX_RETRIES
-    while retries > 0:
+    def record_checkpoint(self, generation, directory):
+        """
+        Queue recording that a scan has processed the whole subtree of a directory.
+
+        Queue it after the writes of the subtree's files. It is dropped if any write
+        before it failed, so a resumed scan never skips a file whose row was not stored.
+        """
+        self._queue.put((_record_checkpoint, (generation, directory)))
+
+    def mark_verified(self, paths, timestamp, content=False):
+        """
+        Queue setting the last_verified time of some files, in milliseconds since the
+        epoch, or their content_verified time if content is true.
+        """
+        self._queue.put((_mark_verified, (timestamp, paths, content)))
+
+    def store_staged_hashes(self, path, partial_md5=None, md5sum=None):
+        """Queue the equivalent of store_staged_hashes."""
+        self._queue.put((_update_staged_hashes, _staged_hashes_row(path, partial_md5, md5sum)))
+
+    def _run(self):
+        waiters = []
         try:
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            cursor.execute("PRAGMA journal_mode=WAL")  # Enable WAL mode
-            cursor.execute("SELECT path, size, last_modified FROM files")
-
-            with ThreadPoolExecutor(max_workers=num_threads) as executor:
-                while True:
-                    batch = cursor.fetchmany(batch_size)
-                    if not batch:
-                        break
-                    futures = [executor.submit(process_file_info, file_info) for file_info in batch]
-                    for future in as_completed(futures):
-                        try:
-                            future.result()
-                        except Exception as e:
-                            logging.error(f"Error processing file info: {e}")
+            conn = _connect(self.db_path)
+            try:
+                self._write_batches(conn, waiters)
+            finally:
+                conn.close()
+        except Exception as e:
+            logging.error(f"Database writer failed, discarding further writes: {e}")
+            self.error = e
+            for done in waiters:
+                done.set()
+            self._discard()
 
-            conn.close()
-            break
+    def _write_batches(self, conn, waiters):
+        batch, deadline = [], None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except Empty:
+                item = None
+            stop = item is self._STOP
+            if item is not None and not stop:
+                if item[0] is self._FLUSH:
+                    waiters.append(item[1])
+                else:
+                    batch.append(item)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.max_latency
+            expired = deadline is not None and time.monotonic() >= deadline
+            if stop or waiters or expired or len(batch) >= self.batch_size:
+                self._commit(conn, batch)
+                for done in waiters:
+                    done.set()
+                batch, deadline = [], None
+                waiters.clear()
+            if stop:
+                return
+
+    def _discard(self):
+        """Drop queued writes until the writer is stopped, waking any flush() calls."""
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                return
+            if item[0] is self._FLUSH:
+                item[1].set()
+
+    def _commit(self, conn, batch):
+        if not batch:
+            return
+        with timed(self.metrics, 'write'):
+            self._commit_batch(conn, batch)
+
+    def _commit_batch(self, conn, batch):
+        delay = RETRY_DELAY
+        for attempt in range(MAX_RETRIES):
+            try:
+                written = errors = 0
+                with conn:
+                    conn.execute("BEGIN")
+                    for write, params in batch:
+                        if write is _record_checkpoint and (self.errors or errors):
+                            continue  # The failed write may belong to the subtree
+                        if self._apply(conn, write, params):
+                            written += 1
+                        else:
+                            errors += 1
+                self.rows_written += written
+                self.errors += errors
+                self.batches_committed += 1
+                if self.metrics is not None:
+                    self.metrics.observe('write_batch_rows', len(batch), unit=COUNT)
+                    if errors:
+                        self.metrics.count('write_errors', errors)
+                return
+            except sqlite3.OperationalError as e:
+                if "database is locked" not in str(e):
+                    raise
+                logging.warning(f"Database is locked, retrying... ({attempt + 1}/{MAX_RETRIES})")
+                self.lock_retries += 1
+                if self.metrics is not None:
+                    self.metrics.count('lock_retries')
+                time.sleep(delay)
+                delay *= 2
+        raise Exception(f"Failed to write {len(batch)} rows after {MAX_RETRIES} retries due to database lock")
+
+    def _apply(self, conn, write, params):
+        """
+        Apply one write under a savepoint, rolling back only that write if it fails.
+        A locked database is raised instead, to retry the whole batch.
+
+        Returns:
+            bool: Whether the write was applied.
+        """
+        conn.execute("SAVEPOINT row")
+        try:
+            write(conn, params)
         except sqlite3.OperationalError as e:
             if "database is locked" in str(e):
-                retries -= 1
-                logging.warning(f"Database is locked, retrying... ({MAX_RETRIES - retries}/{MAX_RETRIES})")
-                time.sleep(RETRY_DELAY)
-            else:
                 raise
+            return self._roll_back(conn, write, params, e)
+        except Exception as e:
+            return self._roll_back(conn, write, params, e)
+        conn.execute("RELEASE row")
+        return True
+
+    @staticmethod
+    def _roll_back(conn, write, params, error):
+        conn.execute("ROLLBACK TO row")
+        conn.execute("RELEASE row")
+        logging.error(f"Failed to write {write.__name__.lstrip('_')} {params!r}: {error}")
+        return False
+
+
+class AuditStats:
+    """The row counts, per-stage wall-clock times and throughput of an audit."""
+
+    def __init__(self):
+        self.total = 0  # Rows in the audited part of the database
+        self.checked = 0
+        self.removed = 0
+        self.rehashed = 0
+        self.bytes_rehashed = 0
+        self.errors = 0
+        self.stage_times = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Add the time spent in the with block to the named stage."""
+        start = time.perf_counter()
+        try:
+            yield
         finally:
-            if conn:
-                conn.close()
-    if retries == 0:
-        raise Exception(f"Failed to audit database after {MAX_RETRIES} retries due to database lock")
+            self.stage_times[name] = self.stage_times.get(name, 0) + time.perf_counter() - start
+
+    def summary(self):
+        stages = ', '.join(f"{name} {seconds:.2f}s" for name, seconds in self.stage_times.items())
+        return (f"Checked {self.checked} of {self.total} files: {self.removed} removed, "
+                f"{self.rehashed} rehashed, {self.errors} errors ({stages})")
+
+    def throughput(self):
+        """Describe the stat and hash rates, and how long a full pass would take at them."""
+        stat_time = self.stage_times.get('stat', 0)
+        hash_time = self.stage_times.get('hash', 0)
+        if not self.checked or not stat_time:
+            return "No files checked"
+        rate = self.checked / stat_time
+        message = (f"Checked {rate:.0f} files/s; a full pass over {self.total} files "
+                   f"takes about {self.total / rate:.0f}s plus rehashing")
+        if self.bytes_rehashed and hash_time:
+            message += f"; rehashed {self.bytes_rehashed / hash_time / 1024 ** 2:.1f} MB/s"
+        return message
+
+
+def stat_batch(rows, metrics=None):
+    """
+    Stat each file of a batch of database rows once and compare it with the stored values.
+
+    Args:
+        rows (list): Tuples of file path, stored size and stored last modified time.
+        metrics (Metrics): Time each stat call as the stat stage.
+
+    Returns:
+        tuple: The number of rows checked, a list of the paths that were stat'ed, a list
+        of paths that no longer exist, a list of (path, size, last_modified, st_dev,
+        st_ino) tuples for changed files, and a list of (path, error) tuples for files
+        that could not be stat'ed.
+    """
+    verified, missing, changed, errors = [], [], [], []
+    for file_path, db_size, db_last_modified in rows:
+        try:
+            with timed(metrics, 'stat'):
+                st = os.stat(file_path)
+        except FileNotFoundError:
+            missing.append(file_path)
+            continue
+        except OSError as e:
+            errors.append((file_path, str(e)))
+            continue
+        verified.append(file_path)
+        last_modified = get_stat_mtime_in_ms(st)
+        if st.st_size != db_size or last_modified != db_last_modified:
+            changed.append((file_path, st.st_size, last_modified, st.st_dev, st.st_ino))
+    return len(rows), verified, missing, changed, errors
+
+
+def rehash_batch(files, metrics=None):
+    """
+    Hash a batch of changed files. This may run in a worker process, so it never touches
+    the database.
+
+    Args:
+        files (list): Tuples of path, size, last modified time, device and inode, as
+            returned by stat_batch.
+        metrics (Metrics): Time each file as the hash stage. Only for a thread pool.
+
+    Returns:
+        tuple: A list of (path, md5sum, size, last_modified, st_dev, st_ino) tuples in the
+        argument order of store_file_info, and a list of (path, error) tuples for files
+        that could not be hashed.
+    """
+    hashed, errors = [], []
+    for file_path, size, last_modified, st_dev, st_ino in files:
+        try:
+            with timed(metrics, 'hash'):
+                md5sum = compute_md5(file_path, size=size)
+        except OSError as e:
+            errors.append((file_path, str(e)))
+            continue
+        hashed.append((file_path, md5sum, size, last_modified, st_dev, st_ino))
+    return hashed, errors
+
+
+def _check_audit_limits(budget, fraction):
+    if fraction is not None and not 0 < fraction <= 1:
+        raise ValueError(f"Invalid audit fraction: {fraction}")
+    if budget is not None and budget <= 0:
+        raise ValueError(f"Invalid audit budget: {budget}")
+
+
+def _within_budget(batches, budget):
+    """Pass the batches on until budget seconds, if not None, have passed."""
+    deadline = None if budget is None else time.monotonic() + budget
+    for batch in batches:
+        if deadline is not None and time.monotonic() >= deadline:
+            logging.info(f"Audit budget of {budget}s used up")
+            return
+        yield batch
+
+
+def audit_db(db_path, num_threads, executor='thread', batch_size=AUDIT_BATCH_SIZE,
+             budget=None, fraction=None, prefix=None, metrics=None):
+    """
+    Audit the database for file changes, removing missing files and rehashing changed ones.
+
+    The audit runs in stages. The rows are read in batches and each path is stat'ed
+    once, in a thread pool, to collect the missing and changed files. The missing files
+    are then deleted, the changed ones hashed, and the new checksums stored, each write
+    stage in bulk transactions after the rows have been read.
+
+    Every file found is stamped with the time of the audit in its last_verified column
+    as its batch is checked, so progress survives an interrupted run. Each batch is read
+    with a query of its own, so no read cursor is held open while the stamps are written.
+    A full audit reads the rows in path order. Given a budget, a fraction or a prefix,
+    the audit is incremental instead: it checks the least recently verified files first,
+    so repeated runs rotate through the whole database.
+
+    Args:
+        db_path (str): The path to the database file.
+        num_threads (int): The number of threads or processes to use for concurrent operations.
+        executor (str): 'thread' to hash changed files in a thread pool, or 'process' to
+            hash them in batches in a process pool.
+        batch_size (int): The number of rows stat'ed or files hashed per task.
+        budget (float): Stop checking further files after this many seconds. The
+            changed files already found are still rehashed.
+        fraction (float): Check at most this fraction of the files, between 0 and 1.
+        prefix (str): Only check the files whose path starts with this prefix.
+        metrics (Metrics): Record the files checked and bytes rehashed, and time each
+            stat, each hash (with the thread executor) and each write.
+
+    Returns:
+        AuditStats: The counts, stage times and throughput of the audit.
+    """
+    _check_audit_limits(budget, fraction)
+    stats = AuditStats()
+    missing, changed, rehashed = [], [], []
+    started = int(time.time() * 1000)
+
+    def log_errors(errors):
+        for file_path, error in errors:
+            logging.error(f"Error processing file {file_path}: {error}")
+        stats.errors += len(errors)
+        if metrics is not None:
+            metrics.count('errors', len(errors))
+
+    def collect_stats(result):
+        checked, verified, batch_missing, batch_changed, errors = result
+        stats.checked += checked
+        if metrics is not None:
+            metrics.count('files', checked)
+        writer.mark_verified(verified, started)
+        missing.extend(batch_missing)
+        changed.extend(batch_changed)
+        log_errors(errors)
+
+    def collect_hashes(result):
+        hashed, errors = result
+        rehashed.extend(hashed)
+        bytes_hashed = sum(row[2] for row in hashed)
+        stats.bytes_rehashed += bytes_hashed
+        if metrics is not None:
+            metrics.count('bytes', bytes_hashed)
+        log_errors(errors)
+
+    with open_index(db_path) as index:
+        with stats.stage('stat'), DatabaseWriter(db_path, metrics=metrics) as writer:
+            stats.total = index.count_files(prefix)
+            if budget is None and fraction is None and prefix is None:
+                batches = index.files_in_path_order(batch_size)
+            else:
+                limit = None if fraction is None else math.ceil(fraction * stats.total)
+                batches = index.least_recently_verified(started, prefix, limit, batch_size)
+            run_batches_in_threads(stat_batch, _within_budget(batches, budget), num_threads, collect_stats,
+                                   metrics)
+        with stats.stage('delete'):
+            for file_path in missing:
+                logging.info(f"REMOVED: {file_path} (File no longer exists)")
+            with timed(metrics, 'write'):
+                stats.removed = index.remove_files(missing)
+        with stats.stage('hash'):
+            for file_path, *_ in changed:
+                logging.info(f"REPROCESSING: {file_path} (Size or last modified time changed)")
+            if executor == 'process':
+                # Worker processes cannot record into metrics, so only the whole stage is timed
+                run_batches_in_processes(rehash_batch, iter_batches(changed, batch_size), num_threads,
+                                         collect_hashes)
+            else:
+                run_batches_in_threads(rehash_batch, iter_batches(changed, batch_size), num_threads,
+                                       collect_hashes, metrics)
+        with stats.stage('update'), timed(metrics, 'write'):
+            stats.rehashed = index.store_files(rehashed)
+
+    if metrics is not None:
+        metrics.count('removed', stats.removed)
+        metrics.count('rehashed', stats.rehashed)
+    logging.info(stats.summary())
+    logging.info(stats.throughput())
+    return stats
+
+
+class VerifyStats(AuditStats):
+    """The counts and times of a content verification, with the checksum mismatches found."""
+
+    def __init__(self):
+        super().__init__()
+        self.bytes_verified = 0
+        self.mismatches = []  # (path, stored md5sum, computed md5sum) of files whose content changed
+
+    def summary(self):
+        stages = ', '.join(f"{name} {seconds:.2f}s" for name, seconds in self.stage_times.items())
+        return (f"Verified {self.checked} of {self.total} files ({self.bytes_verified / 1024 ** 2:.1f} MB): "
+                f"{len(self.mismatches)} mismatches, {self.rehashed} modified, {self.removed} removed, "
+                f"{self.errors} errors ({stages})")
+
+    def throughput(self):
+        verify_time = self.stage_times.get('verify', 0)
+        if not self.checked or not verify_time:
+            return "No files verified"
+        rate = self.checked / verify_time
+        return (f"Verified {rate:.0f} files/s, {self.bytes_verified / verify_time / 1024 ** 2:.1f} MB/s; "
+                f"a full pass over {self.total} files takes about {self.total / rate:.0f}s")
+
+
+def verify_batch(rows, throttle=None, metrics=None):
+    """
+    Hash a batch of stored files and compare them with their recorded checksums.
+
+    Each file is stat'ed before and after it is hashed. A file whose size or last
+    modified time differs from the stored values was modified normally, and its new
+    checksum is returned to be stored. A file whose checksum differs although its
+    metadata did not is a mismatch, which points at silent corruption.
+
+    Args:
+        rows (list): Tuples of file path, stored size, stored last modified time and
+            stored MD5 checksum.
+        throttle (function): Passed to compute_md5 to limit the read rate.
+        metrics (Metrics): Time each file as the hash stage, including any wait for
+            the throttle.
+
+    Returns:
+        tuple: The number of rows checked, a list of the paths that were hashed, the
+        number of bytes hashed, a list of paths that no longer exist, a list of
+        (path, md5sum, size, last_modified, st_dev, st_ino) tuples for modified files, a
+        list of (path, stored md5sum, computed md5sum) tuples for mismatches, and a list
+        of (path, error) tuples for files that could not be verified.
+    """
+    verified, missing, modified, mismatches, errors = [], [], [], [], []
+    bytes_hashed = 0
+    for file_path, db_size, db_last_modified, db_md5sum in rows:
+        try:
+            with timed(metrics, 'hash'):
+                st = os.stat(file_path)
+                md5sum = compute_md5(file_path, size=st.st_size, throttle=throttle)
+                after = os.stat(file_path)
+        except FileNotFoundError:
+            missing.append(file_path)
+            continue
+        except OSError as e:
+            errors.append((file_path, str(e)))
+            continue
+        bytes_hashed += st.st_size
+        last_modified = get_stat_mtime_in_ms(st)
+        if (after.st_size, get_stat_mtime_in_ms(after)) != (st.st_size, last_modified):
+            errors.append((file_path, "modified while it was being verified"))
+            continue
+        verified.append(file_path)
+        if st.st_size != db_size or last_modified != db_last_modified:
+            modified.append((file_path, md5sum, st.st_size, last_modified, st.st_dev, st.st_ino))
+        elif md5sum != db_md5sum:
+            mismatches.append((file_path, db_md5sum, md5sum))
+    return len(rows), verified, bytes_hashed, missing, modified, mismatches, errors
+
+
+def verify_db(db_path, num_threads, max_rate=None, batch_size=AUDIT_BATCH_SIZE,
+              budget=None, fraction=None, prefix=None, metrics=None):
+    """
+    Verify the content of stored files by hashing them again and comparing the checksums.
+
+    The files are hashed in a thread pool, the least recently verified first, and each
+    one is stamped in its content_verified column as its batch completes. An interrupted
+    verification therefore resumes where it stopped when it is run again, and repeated
+    runs rotate through the whole database. Checksum mismatches of files whose size and
+    last modified time are unchanged are reported as errors and left as stored, while
+    files that were modified normally or removed are updated as audit_db would.
+
+    Args:
+        db_path (str): The path to the database file.
+        num_threads (int): The number of hashing threads.
+        max_rate (float): The maximum number of bytes read per second by all threads
+            together, or None for no limit.
+        batch_size (int): The number of files hashed per task.
+        budget (float): Stop verifying further files after this many seconds.
+        fraction (float): Verify at most this fraction of the files, between 0 and 1.
+        prefix (str): Only verify the files whose path starts with this prefix.
+        metrics (Metrics): Record the files verified and bytes hashed, and time each
+            hash and each write.
+
+    Returns:
+        VerifyStats: The counts, mismatches, stage times and throughput of the verification.
+    """
+    _check_audit_limits(budget, fraction)
+    throttle = RateLimiter(max_rate) if max_rate else None
+    stats = VerifyStats()
+    missing, modified = [], []
+    started = int(time.time() * 1000)
+
+    def collect_results(result):
+        checked, verified, bytes_hashed, batch_missing, batch_modified, mismatches, errors = result
+        stats.checked += checked
+        stats.bytes_verified += bytes_hashed
+        if metrics is not None:
+            metrics.count('files', checked)
+            metrics.count('bytes', bytes_hashed)
+            metrics.count('errors', len(errors))
+        writer.mark_verified(verified, started, content=True)
+        missing.extend(batch_missing)
+        modified.extend(batch_modified)
+        for file_path, stored, computed in mismatches:
+            logging.error(f"MISMATCH: {file_path} (stored {stored}, computed {computed})")
+        stats.mismatches.extend(mismatches)
+        for file_path, error in errors:
+            logging.error(f"Error verifying file {file_path}: {error}")
+        stats.errors += len(errors)
 
-    logging.info(f"Total files processed: {processed_files_count}")  # Report the total count
+    with open_index(db_path) as index:
+        with stats.stage('verify'), DatabaseWriter(db_path, metrics=metrics) as writer:
+            stats.total = index.count_files(prefix)
+            limit = None if fraction is None else math.ceil(fraction * stats.total)
+            batches = index.least_recently_verified(started, prefix, limit, batch_size, content=True)
+            run_batches_in_threads(verify_batch, _within_budget(batches, budget), num_threads,
+                                   collect_results, throttle, metrics)
+        with stats.stage('delete'):
+            for file_path in missing:
+                logging.info(f"REMOVED: {file_path} (File no longer exists)")
+            with timed(metrics, 'write'):
+                stats.removed = index.remove_files(missing)
+        with stats.stage('update'):
+            for file_path, *_ in modified:
+                logging.info(f"MODIFIED: {file_path} (Size or last modified time changed)")
+            with timed(metrics, 'write'):
+                stats.rehashed = index.store_files(modified)
 
+    if metrics is not None:
+        metrics.count('removed', stats.removed)
+        metrics.count('modified', stats.rehashed)
+        metrics.count('mismatches', len(stats.mismatches))
+    logging.info(stats.summary())
+    logging.info(stats.throughput())
+    return stats
@@ -1,85 +1,383 @@
 import logging
 import os
 import threading
-import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from queue import Queue
 
-from src.db import store_file_info, check_for_duplicates, get_file_info, remove_files_by_regex
-from src.md5sum import compute_md5
+from src.db import (
+    store_file_info, check_for_duplicates, get_file_info, get_md5_by_inode, remove_files_by_regex,
+    get_partial_hash_candidates, get_full_hash_candidates, KnownFiles, DatabaseWriter, begin_scan, finish_scan,
+    get_scan_checkpoints, open_worker_index, get_md5_by_path
+)
+from src.md5sum import compute_md5, compute_partial_md5, DEFAULT_PARTIAL_SIZE
+from src.metrics import Metrics, timed
+from src.utils import get_stat_mtime_in_ms, iter_batches, run_batches_in_processes, ScanQueue, DEFAULT_QUEUE_DEPTH
+from src.walker import walk_files, feed_files, SubtreeTracker
 
+PROCESS_BATCH_SIZE = 500  # Number of paths sent to a worker process at a time
 
-def scan(path, db_path, num_threads):
+
+def scan(path, db_path, num_threads, staged=False, partial_size=DEFAULT_PARTIAL_SIZE, executor='thread',
+         num_walkers=1, queue_depth=DEFAULT_QUEUE_DEPTH, resume=False, scan_filter=None, metrics=None):
     if os.path.isdir(path):
-        scan_dir(path, db_path, num_threads)
+        if executor == 'process':
+            scan_dir_processes(path, db_path, num_threads, staged=staged, num_walkers=num_walkers,
+                               scan_filter=scan_filter, metrics=metrics)
+        else:
+            scan_dir(path, db_path, num_threads, staged=staged, num_walkers=num_walkers,
+                     queue_depth=queue_depth, resume=resume, scan_filter=scan_filter, metrics=metrics)
     elif os.path.isfile(path):
-        scan_file(path, db_path)
+        scan_file(path, db_path, staged=staged, metrics=metrics)
     else:
         logging.error(f"Invalid path: {path}")
+        return
+    if staged:
+        resolve_staged_duplicates(db_path, num_threads, partial_size)
+
 
+def scan_file(path, db_path, staged=False, metrics=None):
+    process_file(path, db_path, staged=staged, metrics=metrics)
+
+def scan_dir(path, db_path, num_threads, staged=False, num_walkers=1, queue_depth=DEFAULT_QUEUE_DEPTH,
+             resume=False, scan_filter=None, metrics=None):
+    """
+    Scan a directory, hashing new and changed files in a pool of consumer threads.
+
+    Each directory whose whole subtree has been processed is recorded as a checkpoint
+    of the scan, through the DatabaseWriter so the checkpoints are committed in the
+    same batches as the files. With resume, the latest unfinished scan of the
+    directory is continued, and the subtrees it completed are skipped without being
+    listed or stat'ed.
+
+    Args:
+        path (str): The path to the directory.
+        db_path (str): The path to the database file.
+        num_threads (int): The number of hashing threads.
+        staged (bool): Record sizes only, as in process_file.
+        num_walkers (int): The number of threads listing directories concurrently.
+        queue_depth (int): The maximum number of files found but not yet hashed.
+        resume (bool): Continue the latest unfinished scan of the directory.
+        scan_filter (ScanFilter): Skip the directories and files it rejects. Their
+            stored rows are removed at the end of the scan, like those of deleted files.
+        metrics (Metrics): Record the counters and stage times of the scan, and the
+            depth of the file queue as the queue_depth gauge.
+    """
+    known = KnownFiles.load(db_path, path, hashed_only=not staged)
+    file_queue = ScanQueue(maxsize=queue_depth)
+    if metrics is not None:
+        metrics.add_gauge('queue_depth', file_queue.qsize)
+    generation = begin_scan(db_path, path, resume=resume)
+    checkpoints = get_scan_checkpoints(db_path, generation) if resume else ()
+    tracker = SubtreeTracker(path, lambda directory: writer.record_checkpoint(generation, directory), checkpoints)
+    if checkpoints:
+        logging.info(f"Resuming scan of {path}, skipping {len(checkpoints)} completed directories")
+    unreadable = []
+    walked = False
 
-def scan_file(path, db_path):
-    process_file(path, db_path)
+    def put(item):
+        tracker.add_file(item[0])
+        file_queue.put(item)
 
-def scan_dir(path, db_path, num_threads):
-    file_queue = Queue()
+    def on_error(error_path):
+        unreadable.append(error_path)
+        tracker.fail(error_path)
 
     def producer():
-        for root, _, files in os.walk(path):
-            for file in files:
-                file_queue.put(os.path.join(root, file))
-                logging.debug(f"Found file: {os.path.join(root, file)}")
-        for _ in range(num_threads):
-            file_queue.put("")  # Signal the consumers to stop
+        nonlocal walked
+        try:
+            if tracker.root not in tracker.completed:
+                feed_files(path, put, num_walkers, on_error, tracker.enter, tracker.leave, scan_filter, metrics)
+            walked = True
+        finally:
+            for _ in range(num_threads):
+                file_queue.put(None)  # Signal the consumers to stop
 
     def consumer():
         while True:
-            file_path = file_queue.get()
-            if file_path == "":
+            item = file_queue.get()
+            if item is None:
                 logging.debug(f"Consumer {threading.current_thread().name} exiting")
                 file_queue.task_done()  # Mark the stop signal as done
-                # DO NOT DO THIS:  file_queue.put("")  # Signal the next consumer to stop
+                # DO NOT DO THIS:  file_queue.put(None)  # Signal the next consumer to stop
                 break
+            file_path, st = item
+            ok = False
             try:
-                process_file(file_path, db_path)
+                process_file(file_path, db_path, staged=staged, st=st, known=known, writer=writer, metrics=metrics)
+                ok = True
             except Exception as e:
                 logging.error(f"Error processing file {file_path}: {e}")
+                if metrics is not None:
+                    metrics.count('errors')
             finally:
+                writer.mark_seen(file_path, generation)  # Queued after the file's own write
+                tracker.file_done(file_path, ok)
                 file_queue.task_done()
 
-    producer_thread = threading.Thread(target=producer)
-    producer_thread.start()
+    with DatabaseWriter(db_path, metrics=metrics) as writer:
+        producer_thread = threading.Thread(target=producer, name="producer")
+        producer_thread.start()
 
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-        for _ in range(num_threads):
-            executor.submit(consumer)
+        with ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="hasher") as executor:
+            for _ in range(num_threads):
+                executor.submit(consumer)
 
-    producer_thread.join()
-    logging.debug(f"Items remaining in queue: {file_queue.qsize()}")
-    file_queue.join()
+        producer_thread.join()
+        logging.debug(f"Items remaining in queue: {file_queue.qsize()}")
+        file_queue.join()
     logging.debug("All tasks completed.")
+    logging.info(f"Peak queue depth: {file_queue.peak_size} of {queue_depth}")
+    if walked:
+        remove_unseen_files(db_path, generation, path, unreadable, writer)
+
+
+def remove_unseen_files(db_path, generation, path, unreadable=(), writer=None):
+    """
+    Remove the files under a scanned directory that the scan with the given generation
+    did not see, because they were deleted from disk since an earlier scan.
+
+    Nothing is removed if some of the scan's writes failed, as a file whose generation
+    stamp was lost would look deleted.
+
+    Args:
+        db_path (str): The path to the database file.
+        generation (int): The generation returned by begin_scan.
+        path (str): The directory that was scanned.
+        unreadable (list): The directories that could not be listed and the entries
+            that could not be read, whose files are kept.
+        writer (DatabaseWriter): The closed writer of the scan, checked for failed writes.
+    """
+    if writer is not None and writer.failed:
+        logging.warning(f"Kept the files not seen under {path}, as {writer.errors} database writes failed")
+        return
+    removed = finish_scan(db_path, generation, path, unreadable)
+    if unreadable:
+        logging.warning(f"Kept the files under {len(unreadable)} paths that could not be read")
+    logging.info(f"Removed {removed} files no longer under {path}")
+
+
+def scan_dir_processes(path, db_path, num_workers, staged=False, batch_size=PROCESS_BATCH_SIZE, num_walkers=1,
+                       scan_filter=None, metrics=None):
+    """
+    Scan a directory using a process pool.
+
+    Unchanged files are skipped here using a KnownFiles snapshot. The remaining paths
+    and their stat results are sent to the workers in batches to keep the inter-process
+    overhead low. The workers hash the files, each looking up hardlinks through one
+    connection kept for its lifetime, and this process writes the results to the
+    database through a DatabaseWriter.
+
+    Args:
+        path (str): The path to the directory.
+        db_path (str): The path to the database file.
+        num_workers (int): The number of worker processes.
+        staged (bool): Record sizes only, as in process_file.
+        batch_size (int): The number of paths sent to a worker at a time.
+        num_walkers (int): The number of threads listing directories concurrently.
+        scan_filter (ScanFilter): Skip the directories and files it rejects.
+        metrics (Metrics): Record the counters and stage times of the scan, including
+            those the workers send back with their results.
+    """
+    known = KnownFiles.load(db_path, path, hashed_only=not staged)
+    generation = begin_scan(db_path, path)
+    unreadable = []
+
+    def changed_files():
+        for file_path, st in walk_files(path, num_walkers, unreadable.append, scan_filter=scan_filter,
+                                        metrics=metrics):
+            # Stamped here so a stored file is kept even if its batch fails
+            writer.mark_seen(file_path, generation)
+            with timed(metrics, 'lookup'):
+                unchanged = known.is_unchanged(file_path, st.st_size, get_stat_mtime_in_ms(st))
+            if unchanged:
+                logging.debug(f"SKIPPED: {file_path} ")
+                if metrics is None:
+                    print(".", end="", flush=True)
+                else:
+                    metrics.count('files')
+                    metrics.count('skipped')
+            else:
+                yield file_path, st
+
+    def store_results(result):
+        skipped, processed, errors, worker_metrics = result
+        if worker_metrics is not None:
+            metrics.merge(worker_metrics)
+        for file_path, status, size, last_modified, st_dev, st_ino, md5sum in processed:
+            writer.store_file_info(file_path, md5sum, size=size, last_modified=last_modified,
+                                   st_dev=st_dev, st_ino=st_ino)
+            writer.mark_seen(file_path, generation)  # Stamps the row if it is new
+            logging.info(f"{status}: {file_path}")
+        for file_path, error in errors:
+            logging.error(f"Error processing file {file_path}: {error}")
+        if skipped and metrics is None:
+            print("." * skipped, end="", flush=True)
 
+    with DatabaseWriter(db_path, metrics=metrics) as writer:
+        run_batches_in_processes(process_batch, iter_batches(changed_files(), batch_size), num_workers,
+                                 store_results, db_path, staged, metrics is not None,
+                                 initializer=open_worker_index, initargs=(db_path,))
+    remove_unseen_files(db_path, generation, path, unreadable, writer)
 
-def process_file(file_path, db_path):
-    size = os.path.getsize(file_path)
-    last_modified = int(os.path.getmtime(file_path) * 1000)  # Multiply by 1000 and convert to integer
-    file_info = get_file_info(db_path, file_path)
 
-    if file_info:
-        db_size, db_last_modified = file_info
-        db_last_modified = int(float(db_last_modified))  # Convert to integer for comparison
-        if db_size == size and db_last_modified == last_modified:
-            logging.debug(f"SKIPPED: {file_path} ")
-            print(".", end="", flush=True)
-            return
+def process_batch(files, db_path, staged=False, collect_metrics=False):
+    """
+    Hash a batch of files in a worker process, without writing to the database.
+
+    Args:
+        files (list): Tuples of the path to a file and its os.stat_result. Unchanged
+            files must already have been filtered out.
+        db_path (str): The path to the database file, used to look up hardlinks.
+        staged (bool): Record sizes only, as in process_file.
+        collect_metrics (bool): Record the counters and stage times of the batch.
+
+    Returns:
+        tuple: The number of unchanged files skipped, a list of (path, status, size,
+        last_modified, st_dev, st_ino, md5sum) tuples to store, a list of (path, error)
+        tuples, and a Metrics snapshot of the batch, or None.
+    """
+    skipped, processed, errors = 0, [], []
+    known = KnownFiles()  # The files have already been checked against the database
+    metrics = Metrics() if collect_metrics else None
+    for file_path, st in files:
+        try:
+            file_state = examine_file(file_path, db_path, staged=staged, st=st, known=known, metrics=metrics)
+            if file_state[0] == 'SKIPPED':
+                skipped += 1
+            else:
+                processed.append((file_path,) + file_state)
+        except Exception as e:
+            errors.append((file_path, str(e)))
+            if metrics is not None:
+                metrics.count('errors')
+    return skipped, processed, errors, metrics.snapshot() if metrics is not None else None
+
+
+def examine_file(file_path, db_path, staged=False, st=None, known=None, metrics=None):
+    """
+    Work out what needs to be stored for a file, without writing to the database.
+
+    Unchanged files are skipped, except outside staged mode those stored without a
+    checksum by a staged scan. A file that is a hardlink to an inode already hashed
+    with the same size and last modified time reuses that checksum without being
+    opened. Otherwise the file is hashed, or in staged mode only its size is recorded.
+
+    Args:
+        file_path (str): The path to the file.
+        db_path (str): The path to the database file. The lookups go through the
+            FileIndex open for it, such as the one open_worker_index opens in a
+            worker process, so they don't open a connection per file.
+        staged (bool): Record sizes only; resolve_staged_duplicates hashes files whose
+            size collides.
+        st (os.stat_result): The stat result for the file if already known, for example
+            from walk_files. The file is only stat'ed if it is not given.
+        known (KnownFiles): A snapshot of the stored files to decide whether the file is
+            unchanged, loaded with hashed_only unless staged. If not given, the file is
+            looked up in the database.
+        metrics (Metrics): Time the stat, lookup and hash stages, and count the file,
+            its status and the bytes hashed.
+
+    Returns:
+        tuple: The status ('SKIPPED', 'LINKED', 'RECORDED' or 'PROCESSED'), size, last
+        modified time in milliseconds, st_dev, st_ino and MD5 checksum (None when
+        skipped or recorded).
+    """
+    if st is None:
+        with timed(metrics, 'stat'):
+            st = os.stat(file_path)
+    size = st.st_size
+    last_modified = get_stat_mtime_in_ms(st)
+    with timed(metrics, 'lookup'):
+        if known is not None:
+            unchanged = known.is_unchanged(file_path, size, last_modified)
+        else:
+            file_info = get_file_info(db_path, file_path)
+            unchanged = False
+            if file_info:
+                db_size, db_last_modified = file_info
+                db_last_modified = int(float(db_last_modified))  # Convert to integer for comparison
+                unchanged = db_size == size and db_last_modified == last_modified
+                if unchanged and not staged:
+                    # A staged scan may have recorded only its size
+                    unchanged = get_md5_by_path(db_path, file_path) is not None
+        md5sum = None if unchanged else get_md5_by_inode(db_path, st.st_dev, st.st_ino, size, last_modified)
+
+    if unchanged:
+        status = 'SKIPPED'
+    elif md5sum:
+        status = 'LINKED'
+    elif staged:
+        status = 'RECORDED'
+    else:
+        with timed(metrics, 'hash'):
+            md5sum = compute_md5(file_path, size=size)
+        status = 'PROCESSED'
+        if metrics is not None:
+            metrics.count('bytes', size)
+    if metrics is not None:
+        metrics.count('files')
+        metrics.count(status.lower())
+    return status, size, last_modified, st.st_dev, st.st_ino, md5sum
+
+
+def process_file(file_path, db_path, staged=False, st=None, known=None, writer=None, metrics=None):
+    status, size, last_modified, st_dev, st_ino, md5sum = examine_file(file_path, db_path, staged=staged, st=st,
+                                                                       known=known, metrics=metrics)
+    if status == 'SKIPPED':
+        logging.debug(f"SKIPPED: {file_path} ")
+        if metrics is None:
+            print(".", end="", flush=True)  # The progress line reports skipped files instead
+        return None
+
+    if writer is not None:
+        writer.store_file_info(file_path, md5sum, size=size, last_modified=last_modified,
+                               st_dev=st_dev, st_ino=st_ino)
+    else:
+        with timed(metrics, 'write'):
+            store_file_info(db_path, file_path, md5sum, size=size, last_modified=last_modified,
+                            st_dev=st_dev, st_ino=st_ino)
+    logging.info(f"{status}: {file_path}")
+    return md5sum
+
+
+def resolve_staged_duplicates(db_path, num_threads, partial_size=DEFAULT_PARTIAL_SIZE):
+    """
+    Hash the files recorded by a staged scan, reading only as much as is needed to
+    tell duplicates apart.
+
+    Files whose size is unique in the database are never read. Files sharing a size
+    get a partial checksum of their first and last partial_size bytes, and only files
+    whose partial checksums also match are hashed in full.
+
+    Args:
+        db_path (str): The path to the database file.
+        num_threads (int): The number of threads to use for concurrent operations.
+        partial_size (int): The number of bytes hashed from each end of a file.
+    """
+    def hash_partial(file_path, size):
+        partial_md5 = compute_partial_md5(file_path, size=size, partial_size=partial_size)
+        # Small files are read in full, so their partial checksum is the full one
+        md5sum = partial_md5 if size <= 2 * partial_size else None
+        writer.store_staged_hashes(file_path, partial_md5=partial_md5, md5sum=md5sum)
 
-    start_time = time.time()
-    md5sum = compute_md5(file_path)
-    end_time = time.time()
-    duration_ms = int((end_time - start_time) * 1000)
+    def hash_full(file_path, size):
+        writer.store_staged_hashes(file_path, md5sum=compute_md5(file_path, size=size))
+        logging.info(f"PROCESSED: {file_path}")
 
-    store_file_info(db_path, file_path, md5sum)
-    logging.info(f"PROCESSED: {file_path}")
+    with DatabaseWriter(db_path) as writer:
+        for stage, get_candidates, hash_file in (
+            ("partial", get_partial_hash_candidates, hash_partial),
+            ("full", get_full_hash_candidates, hash_full),
+        ):
+            candidates = get_candidates(db_path)
+            logging.info(f"Staged hashing: {len(candidates)} files need a {stage} checksum")
+            with ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="hasher") as executor:
+                futures = {executor.submit(hash_file, file_path, size): file_path for file_path, size in candidates}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logging.error(f"Error hashing file {futures[future]}: {e}")
+            writer.flush()  # The next stage reads the checksums written by this one
 
 
 def process_files_concurrently(file_paths, db_path, num_threads):
@@ -112,6 +410,6 @@ def remove_file(db_path, regex_pattern):
         db_path (str): The path to the database file.
         regex_pattern (str): The regex pattern to match file paths.
     """
-    remove_files_by_regex(db_path, regex_pattern)
-    print(f"Records matching the pattern '{regex_pattern}' have been removed from the database.")
+    removed = remove_files_by_regex(db_path, regex_pattern)
+    print(f"{removed} records matching the pattern '{regex_pattern}' have been removed from the database.")
 
@@ -0,0 +1,151 @@
+import fnmatch
+import json
+import os
+import re
+
+GLOB_PREFIX = 'glob:'
+REGEX_PREFIX = 're:'
+_SEPARATORS = ''.join(sep for sep in (os.sep, os.altsep) if sep)
+
+
+def _compile_rules(rules):
+    """
+    Compile include or exclude rules.
+
+    A rule is a glob, optionally prefixed with 'glob:', or a regular expression prefixed
+    with 're:'. A glob without a path separator is matched against the base name, and any
+    other glob against the end of the path. Trailing separators are ignored on both, so
+    '/x/build' and '/x/build/' both match the build directory. A regular expression may
+    match anywhere in the path, like remove-record patterns. For regular expressions
+    directory paths end in a separator, so 're:/cache/' matches a cache directory as well
+    as the files in it.
+
+    Returns:
+        tuple: One regex matching base names against every name glob (or None), the list
+        of compiled path globs and the list of compiled regular expressions.
+    """
+    name_globs, path_globs, path_regexes = [], [], []
+    for rule in rules:
+        if rule.startswith(REGEX_PREFIX):
+            path_regexes.append(re.compile(rule[len(REGEX_PREFIX):]))
+            continue
+        if rule.startswith(GLOB_PREFIX):
+            rule = rule[len(GLOB_PREFIX):]
+        if any(sep in rule for sep in _SEPARATORS):
+            path_globs.append(re.compile(fnmatch.translate(rule.rstrip(_SEPARATORS) or rule)))
+        else:
+            name_globs.append(fnmatch.translate(rule))
+    # The name globs are combined into a single regex, so each entry is tested only once
+    name_regex = re.compile('|'.join(f"(?:{glob})" for glob in name_globs)) if name_globs else None
+    return name_regex, path_globs, path_regexes
+
+
+def _matches(compiled, path, name, is_dir=False):
+    name_regex, path_globs, path_regexes = compiled
+    if name_regex is not None and name_regex.match(name):
+        return True
+    if any(glob.search(path) for glob in path_globs):
+        return True
+    if is_dir:
+        path = os.path.join(path, '')
+    return any(regex.search(path) for regex in path_regexes)
+
+
+class ScanFilter:
+    """
+    Include and exclude rules, size limits and a file system boundary applied while a
+    directory is walked.
+
+    Excluded directories, and with one_file_system directories on another device than
+    the root of the walk, are pruned before they are listed. Files are kept only if no
+    exclude rule matches them, at least one include rule does (when there are any), and
+    their size is within the limits. Include rules never prune directories.
+
+    The rules are compiled once when the filter is created. A filter holds no other
+    state, so one instance is shared by every walker thread and may be sent to worker
+    processes.
+    """
+
+    def __init__(self, include=(), exclude=(), min_size=None, max_size=None, one_file_system=False):
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.one_file_system = one_file_system
+        self._include = _compile_rules(self.include)
+        self._exclude = _compile_rules(self.exclude)
+
+    def __repr__(self):
+        return (f"ScanFilter(include={self.include!r}, exclude={self.exclude!r}, min_size={self.min_size!r}, "
+                f"max_size={self.max_size!r}, one_file_system={self.one_file_system!r})")
+
+    @classmethod
+    def load(cls, config_path=None, include=(), exclude=(), min_size=None, max_size=None, one_file_system=False):
+        """
+        Build a filter from a JSON config file, extended by the given options.
+
+        The config file is an object with any of the keys include and exclude (lists of
+        rules), min_size and max_size (in bytes) and one_file_system (a boolean). The
+        include and exclude rules given here are added to those of the file, and the
+        other options override it when they are set.
+
+        Args:
+            config_path (str): The path to the config file, or None.
+
+        Returns:
+            ScanFilter: The filter, or None if it would accept every file.
+        """
+        config = {}
+        if config_path:
+            with open(config_path) as f:
+                config = json.load(f)
+            unknown = set(config) - {'include', 'exclude', 'min_size', 'max_size', 'one_file_system'}
+            if unknown:
+                raise ValueError(f"Unknown keys in filter config {config_path}: {', '.join(sorted(unknown))}")
+        scan_filter = cls(
+            include=list(config.get('include', ())) + list(include or ()),
+            exclude=list(config.get('exclude', ())) + list(exclude or ()),
+            min_size=config.get('min_size') if min_size is None else min_size,
+            max_size=config.get('max_size') if max_size is None else max_size,
+            one_file_system=bool(config.get('one_file_system')) or one_file_system,
+        )
+        return None if scan_filter.accepts_everything() else scan_filter
+
+    def accepts_everything(self):
+        return not (self.include or self.exclude or self.one_file_system
+                    or self.min_size is not None or self.max_size is not None)
+
+    def root_device(self, root):
+        """Return the device of the root of a walk if it is needed by accepts_directory."""
+        return os.stat(root).st_dev if self.one_file_system else None
+
+    def accepts_directory(self, entry, root_device=None):
+        """
+        Decide whether a subdirectory should be listed.
+
+        Args:
+            entry (os.DirEntry): The directory entry.
+            root_device (int): The device returned by root_device.
+        """
+        if _matches(self._exclude, entry.path, entry.name, is_dir=True):
+            return False
+        if root_device is not None and entry.stat(follow_symlinks=False).st_dev != root_device:
+            return False
+        return True
+
+    def accepts_file(self, path, name, st):
+        """
+        Decide whether a file should be kept.
+
+        Args:
+            path (str): The path to the file.
+            name (str): The base name of the file.
+            st (os.stat_result): The stat result of the file.
+        """
+        if self.min_size is not None and st.st_size < self.min_size:
+            return False
+        if self.max_size is not None and st.st_size > self.max_size:
+            return False
+        if _matches(self._exclude, path, name):
+            return False
+        return not self.include or _matches(self._include, path, name)
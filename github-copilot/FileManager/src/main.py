@@ -8,13 +8,20 @@ sys.path.append(
 
 import logging
 import argparse
-from src.db import initialize_db, audit_db
-from src.file_ops import scan, check_file, remove_file, process_file
+import re
+from contextlib import nullcontext
+from src.db import FileIndex, audit_db, verify_db
+from src.filters import ScanFilter
+from src.file_ops import scan, check_file, remove_file
 from src.reporting import (
-    scan_dir_report, report_duplicates, report_duplicate_sizes,
+    scan_dir_report, report_duplicates, print_duplicate_groups, report_duplicate_sizes,
     report_prefix_count, compare_directories
 )
 from src.gui import show_duplicates_gui
+from src.md5sum import configure_hashing, DEFAULT_BUFFER_SIZE, DEFAULT_PARTIAL_SIZE
+from src.metrics import Metrics, MetricsExporter, ProgressLine
+from src.profiling import SamplingProfiler, DEFAULT_PROFILE_INTERVAL
+from src.utils import DEFAULT_QUEUE_DEPTH
 
 # Configure logging
 logging.basicConfig(
@@ -22,6 +29,9 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+DEFAULT_PROFILE_PATH = 'file_manager.prof'
+METRICS_ACTIONS = ('scan', 'scan-dir-report', 'audit-db', 'verify-db')  # Actions that record Metrics
+
 def usage():
     print("""
     File Manager Application
@@ -29,6 +39,14 @@ def usage():
     Usage:
         main.py <action> <path> [--db-path <db_path>] [--threads <num_threads>]
         [--prefix <prefix>] [--dirA <dirA>] [--dirB <dirB>] [--use-gui] [--min-duplicates <min_duplicates>]
+        [--buffer-size <bytes>] [--mmap-threshold <bytes>] [--staged]
+        [--partial-size <KiB>] [--executor <thread|process>] [--walkers <num_walkers>]
+        [--queue-depth <num_files>] [--resume] [--sort <hash|wasted>]
+        [--include <rule>] [--exclude <rule>] [--min-size <bytes>] [--max-size <bytes>]
+        [--one-file-system] [--filter-config <file>]
+        [--budget <seconds>] [--fraction <fraction>] [--max-rate <bytes_per_second>]
+        [--no-progress] [--metrics-out <file>] [--metrics-format <json|prometheus>]
+        [--metrics-interval <seconds>] [--profile [<file>]] [--profile-interval <ms>]
 
     Actions:
         scan                Scan a comma-separated list of directories or files.
@@ -36,10 +54,14 @@ def usage():
         scan-dir-report     Scan a directory and report duplicates.
         report-duplicates   Report all duplicates in the database.
         audit-db            Audit the database for file changes.
+        verify-db           Hash the stored files again and report those whose content
+                            no longer matches the stored checksum although their size
+                            and last modified time did not change.
         report-duplicate-sizes Report the total size of duplicate files.
         report-prefix-count Report the number of files that match a given prefix.
-        remove-record       Remove the record associated with the specified path
-                            from the database.
+        remove-record       Remove the records whose path matches a regex pattern
+                            from the database. The pattern may match anywhere in the
+                            path; start it with ^ to match from the beginning.
         compare-directories Compare two directories and report unique files.
         help                Show this help message.
 
@@ -47,23 +69,93 @@ def usage():
         --db-path           Path to the database file or directory.
         --threads           Number of threads to use for concurrent operations.
         --prefix            Prefix to match files (required for
-                            report-prefix-count action).
+                            report-prefix-count action; limits an audit-db or
+                            verify-db action to the files under it).
         --dirA              Path to the first directory for comparison (required for
                             compare-directories action).
         --dirB              Path to the second directory for comparison (required for
                             compare-directories action).
         --use-gui           Use GUI for displaying duplicates.
         --min-duplicates    Minimum number of duplicates to search for (default: 1).
+        --sort              Print duplicate groups in checksum order, or those wasting
+                            the most space first (report-duplicates action; hash or
+                            wasted, default: hash).
+        --buffer-size       Maximum read buffer size in bytes used for hashing
+                            (default: 1048576).
+        --mmap-threshold    Hash files of at least this many bytes through a
+                            memory map (default: 0, disabled).
+        --staged            Only hash files whose size matches another file, first
+                            partially and then in full if the partial hashes match
+                            (scan action).
+        --partial-size      KiB hashed from each end of a file by --staged (default: 64).
+        --executor          Hash files in a pool of threads or of processes (scan and
+                            audit-db actions; default: thread). With process, --threads
+                            sets the number of worker processes.
+        --walkers           Number of threads listing directories concurrently, separate
+                            from --threads (scan and scan-dir-report actions; default: 1).
+        --queue-depth       Maximum number of files found but not yet hashed; traversal
+                            waits when the queue is full (default: 10000).
+        --resume            Continue the last unfinished scan of each directory,
+                            skipping the subtrees it completed (scan action with the
+                            thread executor).
+        --include           Only keep files matching this rule; may be repeated. A rule
+                            is a glob, matched against the base name unless it contains
+                            a path separator, or a regex after 're:' that may match
+                            anywhere in the path (scan and scan-dir-report actions).
+        --exclude           Skip files and directories matching this rule; may be
+                            repeated. Excluded directories are not listed at all.
+        --min-size          Skip files smaller than this many bytes.
+        --max-size          Skip files larger than this many bytes.
+        --one-file-system   Do not descend into directories on other file systems.
+        --filter-config     JSON file with include and exclude lists and min_size,
+                            max_size and one_file_system values, extended by the
+                            options above. A scan removes the stored records of the
+                            files its filters skip.
+        --budget            Stop checking files after this many seconds (audit-db and
+                            verify-db actions). The least recently verified files are
+                            checked first, so repeated runs rotate through the database.
+        --fraction          Check at most this fraction of the files, least recently
+                            verified first (audit-db and verify-db actions; between 0
+                            and 1).
+        --max-rate          Maximum bytes read per second by all hashing threads
+                            together (verify-db action; default: no limit).
+        --no-progress       Do not show the progress line. The scan, scan-dir-report,
+                            audit-db and verify-db actions rewrite a line of files/s,
+                            MB/s, skipped files and queue depth on stderr every second
+                            when it is a terminal, and always log a summary of their
+                            stage times and whether they were I/O-, CPU- or DB-bound.
+        --metrics-out       Write the metrics of those actions to this file when they
+                            finish: throughput, stage times with percentiles, error
+                            counts and database write batching. The file is replaced
+                            atomically, so a node exporter textfile collector can read it.
+        --metrics-format    json or prometheus (default: prometheus for a file ending
+                            in .prom, json otherwise).
+        --metrics-interval  Also rewrite the metrics file every this many seconds
+                            while the action runs.
+        --profile           Sample the stack of every thread while the action runs,
+                            write the merged profile to this pstats file (default:
+                            file_manager.prof) and print the top functions of each
+                            stage: traversal, hashing, workers, writer and main. Times
+                            are wall-clock, so waiting on a queue or lock is included;
+                            worker processes are not profiled.
+        --profile-interval  Milliseconds between stack samples (default: 5). Longer
+                            intervals lower the overhead on large runs.
 
     Examples:
         python main.py scan /path/to/dir1,/path/to/dir2 --db-path /path/to/db --threads 4
+        python main.py scan /path/to/dir --db-path /path/to/db --staged
+        python main.py scan /path/to/dir --db-path /path/to/db --exclude .git --exclude node_modules --min-size 1024
+        python main.py scan /path/to/dir --db-path /path/to/db --profile scan.prof --profile-interval 20
         python main.py check-file /path/to/file --db-path /path/to/db --threads 4
         python main.py scan-dir-report /path/to/dir --db-path /path/to/db --threads 4
         python main.py report-duplicates --db-path /path/to/db --threads 4 --use-gui
         python main.py audit-db --db-path /path/to/db --threads 4
+        python main.py audit-db --db-path /path/to/db --budget 3600 --prefix /path/to/dir/
+        python main.py verify-db --db-path /path/to/db --threads 4 --max-rate 50000000
+        python main.py scan /path/to/dir --db-path /path/to/db --no-progress --metrics-out /var/lib/node_exporter/filemanager.prom
         python main.py report-duplicate-sizes --db-path /path/to/db
         python main.py report-prefix-count --db-path /path/to/db --prefix <prefix>
-        python main.py remove-record /path/to/file --db-path /path/to/db
+        python main.py remove-record '^/path/to/dir/' --db-path /path/to/db
         python main.py compare-directories --dirA /path/to/dirA --dirB /path/to/dirB
     """)
 
@@ -76,7 +168,7 @@ def main():
         'action',
         choices=[
             'scan', 'check-file', 'scan-dir-report', 'report-duplicates',
-            'audit-db', 'report-duplicate-sizes', 'report-prefix-count',
+            'audit-db', 'verify-db', 'report-duplicate-sizes', 'report-prefix-count',
             'remove-record', 'compare-directories', 'help'
         ],
         help='Action to perform'
@@ -94,6 +186,10 @@ def main():
         '--min-duplicates', type=int, default=1,
         help='Minimum number of duplicates to search for'
     )
+    parser.add_argument(
+        '--sort', choices=['hash', 'wasted'], default='hash',
+        help='Order of the groups printed by report-duplicates'
+    )
     parser.add_argument(
         '--dirA', help='Path to the first directory for comparison'
     )
@@ -104,6 +200,86 @@ def main():
         '--use-gui', action='store_true',
         help='Use GUI for displaying duplicates'
     )
+    parser.add_argument(
+        '--buffer-size', type=int, default=DEFAULT_BUFFER_SIZE,
+        help='Maximum read buffer size in bytes used for hashing'
+    )
+    parser.add_argument(
+        '--mmap-threshold', type=int, default=0,
+        help='Hash files of at least this many bytes through a memory map (0 disables)'
+    )
+    parser.add_argument(
+        '--staged', action='store_true',
+        help='Only hash files whose size matches another file'
+    )
+    parser.add_argument(
+        '--partial-size', type=int, default=DEFAULT_PARTIAL_SIZE // 1024,
+        help='KiB hashed from each end of a file by --staged'
+    )
+    parser.add_argument(
+        '--executor', choices=['thread', 'process'], default='thread',
+        help='Hash files in a pool of threads or of processes'
+    )
+    parser.add_argument(
+        '--walkers', type=int, default=1,
+        help='Number of threads listing directories concurrently'
+    )
+    parser.add_argument(
+        '--queue-depth', type=int, default=DEFAULT_QUEUE_DEPTH,
+        help='Maximum number of files found but not yet hashed'
+    )
+    parser.add_argument(
+        '--include', action='append', default=[],
+        help='Only keep files matching this glob or re: rule'
+    )
+    parser.add_argument(
+        '--exclude', action='append', default=[],
+        help='Skip files and directories matching this glob or re: rule'
+    )
+    parser.add_argument('--min-size', type=int, help='Skip files smaller than this many bytes')
+    parser.add_argument('--max-size', type=int, help='Skip files larger than this many bytes')
+    parser.add_argument(
+        '--one-file-system', action='store_true',
+        help='Do not descend into directories on other file systems'
+    )
+    parser.add_argument('--filter-config', help='JSON file of filter rules')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='Continue the last unfinished scan of each directory'
+    )
+    parser.add_argument(
+        '--budget', type=float,
+        help='Seconds an audit-db or verify-db action spends checking files'
+    )
+    parser.add_argument(
+        '--fraction', type=float,
+        help='Fraction of the files an audit-db or verify-db action checks'
+    )
+    parser.add_argument(
+        '--max-rate', type=float,
+        help='Maximum bytes read per second by a verify-db action'
+    )
+    parser.add_argument(
+        '--no-progress', action='store_true',
+        help='Do not show the progress line on stderr'
+    )
+    parser.add_argument('--metrics-out', help='File the metrics of the run are written to')
+    parser.add_argument(
+        '--metrics-format', choices=['json', 'prometheus'],
+        help='Format of the metrics file (default: from its extension)'
+    )
+    parser.add_argument(
+        '--metrics-interval', type=float,
+        help='Seconds between rewrites of the metrics file during the run'
+    )
+    parser.add_argument(
+        '--profile', nargs='?', const=DEFAULT_PROFILE_PATH,
+        help='Sample every thread and write the merged profile to this pstats file'
+    )
+    parser.add_argument(
+        '--profile-interval', type=float, default=DEFAULT_PROFILE_INTERVAL * 1000,
+        help='Milliseconds between stack samples of --profile'
+    )
 
     try:
         args = parser.parse_args()
@@ -130,47 +306,82 @@ def main():
         usage()
         return
 
+    configure_hashing(buffer_size=args.buffer_size, mmap_threshold=args.mmap_threshold)
+
+    try:
+        scan_filter = ScanFilter.load(args.filter_config, include=args.include, exclude=args.exclude,
+                                      min_size=args.min_size, max_size=args.max_size,
+                                      one_file_system=args.one_file_system)
+    except (OSError, ValueError, re.error) as e:
+        print(f"Error: invalid filter rules: {e}")
+        return
+
     db_path = args.db_path if args.db_path else 'file_manager.db'
     if os.path.isdir(db_path):
         db_path = os.path.join(db_path, 'file_manager.db')
-    initialize_db(db_path)
-
-    logging.info(
-        f"ACTION: {args.action}; PATH(s): {args.path}; DB: {db_path}; "
-        f"THREADS: {args.threads}"
-    )
-
-    if args.action == 'scan':
-        paths = args.path.split(',') if args.path else []
-        for path in paths:
-            scan(path.strip(), db_path, args.threads)
-    elif args.action == 'check-file':
-        check_file(args.path, db_path)
-    elif args.action == 'scan-dir-report':
-        scan_dir_report(args.path, db_path, args.threads)
-    elif args.action == 'report-duplicates':
-        duplicates = report_duplicates(db_path, args.min_duplicates)
-        print(f"Found {len(duplicates)} duplicates")
-        if args.use_gui:
-            # Truncate the duplicates dictionary to the first 100 items for debugging
-            truncated_duplicates = dict(list(duplicates.items())[:100])
-            show_duplicates_gui(truncated_duplicates)
-        else:
-            for md5sum, paths in duplicates.items():
-                if len(paths) > 1:
-                    print(f"MD5: {md5sum}")
-                    for path in paths:
-                        print(f"  {path}")
-    elif args.action == 'audit-db':
-        audit_db(db_path, args.threads, process_file)
-    elif args.action == 'report-duplicate-sizes':
-        report_duplicate_sizes(db_path)
-    elif args.action == 'report-prefix-count':
-        report_prefix_count(db_path, args.prefix)
-    elif args.action == 'remove-file':
-        remove_file(db_path, args.path)
-    elif args.action == 'compare-directories':
-        compare_directories(args.dirA, args.dirB)
+    # Every database access below shares this index's per-thread connections
+    with FileIndex(db_path) as index:
+        index.initialize()
+
+        logging.info(
+            f"ACTION: {args.action}; PATH(s): {args.path}; DB: {db_path}; "
+            f"THREADS: {args.threads}"
+        )
+
+        metrics = Metrics() if args.action in METRICS_ACTIONS else None
+        progress = exporter = nullcontext()
+        if metrics is not None and not args.no_progress and sys.stderr.isatty():
+            progress = ProgressLine(metrics)
+        if metrics is not None and args.metrics_out:
+            exporter = MetricsExporter(metrics, args.metrics_out, args.metrics_format, {'action': args.action},
+                                       args.metrics_interval)
+        profiler = SamplingProfiler(args.profile_interval / 1000) if args.profile else nullcontext()
+        with profiler, exporter, progress:
+            if args.action == 'scan':
+                paths = args.path.split(',') if args.path else []
+                for path in paths:
+                    scan(path.strip(), db_path, args.threads, staged=args.staged,
+                         partial_size=args.partial_size * 1024, executor=args.executor,
+                         num_walkers=args.walkers, queue_depth=args.queue_depth, resume=args.resume,
+                         scan_filter=scan_filter, metrics=metrics)
+            elif args.action == 'check-file':
+                check_file(args.path, db_path)
+            elif args.action == 'scan-dir-report':
+                scan_dir_report(args.path, db_path, args.threads, num_walkers=args.walkers,
+                                queue_depth=args.queue_depth, scan_filter=scan_filter, metrics=metrics)
+            elif args.action == 'report-duplicates':
+                if args.use_gui:
+                    duplicates = report_duplicates(db_path, args.min_duplicates)
+                    print(f"Found {len(duplicates)} duplicates")
+                    # Truncate the duplicates dictionary to the first 100 items for debugging
+                    truncated_duplicates = dict(list(duplicates.items())[:100])
+                    show_duplicates_gui(truncated_duplicates)
+                else:
+                    count = print_duplicate_groups(db_path, args.min_duplicates, order_by=args.sort)
+                    print(f"Found {count} duplicates")
+            elif args.action == 'audit-db':
+                audit_db(db_path, args.threads, executor=args.executor, budget=args.budget,
+                         fraction=args.fraction, prefix=args.prefix, metrics=metrics)
+            elif args.action == 'verify-db':
+                stats = verify_db(db_path, args.threads, max_rate=args.max_rate, budget=args.budget,
+                                  fraction=args.fraction, prefix=args.prefix, metrics=metrics)
+                print(f"Found {len(stats.mismatches)} checksum mismatches")
+                for file_path, stored, computed in stats.mismatches:
+                    print(f"{file_path}: stored {stored}, computed {computed}")
+            elif args.action == 'report-duplicate-sizes':
+                report_duplicate_sizes(db_path)
+            elif args.action == 'report-prefix-count':
+                report_prefix_count(db_path, args.prefix)
+            elif args.action == 'remove-record':
+                remove_file(db_path, args.path)
+            elif args.action == 'compare-directories':
+                compare_directories(args.dirA, args.dirB)
+        if metrics is not None:
+            logging.info(f"Metrics: {metrics.summary()}")
+        if args.profile:
+            profiler.dump(args.profile)
+            print(profiler.report())
+            logging.info(f"Profile written to {args.profile}")
 
 if __name__ == "__main__":
     main()
@@ -1,18 +1,182 @@
 import hashlib
+import mmap
+import os
+import stat
+import threading
 
-def compute_md5(file_path):
+SMALL_FILE_THRESHOLD = 256 * 1024  # Files up to this size are hashed with a single read
+MIN_BUFFER_SIZE = 64 * 1024  # Smallest read buffer used for streamed hashing
+DEFAULT_BUFFER_SIZE = 1024 * 1024  # Largest read buffer used for streamed hashing
+DEFAULT_PARTIAL_SIZE = 64 * 1024  # Bytes hashed from each end of a file by compute_partial_md5
+
+_buffer_size = DEFAULT_BUFFER_SIZE
+_mmap_threshold = None  # Files at least this large are hashed through mmap; None disables it
+_local = threading.local()
+
+
+def configure_hashing(buffer_size=None, mmap_threshold=None):
+    """
+    Configure the hashing engine used by compute_md5.
+
+    Args:
+        buffer_size (int): The maximum read buffer size in bytes. Smaller files use a
+            smaller buffer, but never less than MIN_BUFFER_SIZE.
+        mmap_threshold (int): Hash regular files of at least this many bytes through a
+            memory map. Zero disables memory-mapped hashing.
+    """
+    global _buffer_size, _mmap_threshold
+    if buffer_size is not None:
+        if buffer_size <= 0:
+            raise ValueError(f"Invalid buffer size: {buffer_size}")
+        _buffer_size = buffer_size
+    if mmap_threshold is not None:
+        if mmap_threshold < 0:
+            raise ValueError(f"Invalid mmap threshold: {mmap_threshold}")
+        _mmap_threshold = mmap_threshold or None
+
+
+def hashing_config():
+    """
+    Return the current hashing configuration, in the order accepted by configure_hashing.
+
+    Returns:
+        tuple: The maximum buffer size and the mmap threshold (0 when disabled).
+    """
+    return _buffer_size, _mmap_threshold or 0
+
+
+def choose_buffer_size(file_size, buffer_size=None):
+    """
+    Pick a read buffer size suited to the size of the file being hashed.
+
+    Args:
+        file_size (int): The size of the file in bytes.
+        buffer_size (int): The maximum buffer size, or None to use the configured one.
+
+    Returns:
+        int: The buffer size in bytes.
+    """
+    max_size = buffer_size or _buffer_size
+    return max(min(file_size, max_size), min(MIN_BUFFER_SIZE, max_size))
+
+
+def _get_buffer(size):
+    """
+    Return a per-thread reusable buffer of at least the requested size.
+
+    The buffer is kept for the lifetime of the thread so that hashing many files does
+    not allocate a new bytes object for every read.
+    """
+    buf = getattr(_local, 'buffer', None)
+    if buf is None or len(buf) < size:
+        buf = bytearray(size)
+        _local.buffer = buf
+        _local.view = memoryview(buf)
+    return _local.view[:size]
+
+
+def _update_from_mmap(hash_md5, f):
+    """
+    Feed an open file to the hash through a read-only memory map.
+
+    The mapped region is handed to hashlib directly, so the kernel pages the file in
+    without any copy into a user-space buffer.
+
+    Returns:
+        bool: True if the file was hashed, False if it cannot be mapped (empty or not a
+        regular file) and must be read instead.
+    """
+    st = os.fstat(f.fileno())
+    if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+        return False
+    try:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return False
+    with mm:
+        if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        hash_md5.update(mm)
+        mapped = len(mm)
+    # Anything appended after the map was created is picked up by the read loop
+    f.seek(mapped)
+    return True
+
+
+def compute_md5(file_path, size=None, buffer_size=None, mmap_threshold=None, throttle=None):
     """
     Compute the MD5 checksum of a file.
 
+    Small files are read in a single call. Files at or above the mmap threshold are
+    hashed straight from a memory map. Everything else is read with readinto into a
+    reusable buffer, so no per-chunk bytes objects are created.
+
     Args:
         file_path (str): The path to the file for which the MD5 checksum is to be computed.
+        size (int): The size of the file in bytes if already known, used to size the buffer.
+        buffer_size (int): The maximum read buffer size, or None to use the configured one.
+        mmap_threshold (int): The memory-map threshold in bytes, or None to use the
+            configured one.
+        throttle (function): Called with the number of bytes after every read, and may
+            sleep to limit the read rate. Files are never memory-mapped when it is given.
 
     Returns:
         str: The computed MD5 checksum as a hexadecimal string.
     """
     hash_md5 = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
+    with open(file_path, "rb", buffering=0) as f:
+        if size is None:
+            size = os.fstat(f.fileno()).st_size
+        threshold = None if throttle else mmap_threshold or _mmap_threshold
+        if threshold and size >= threshold and _update_from_mmap(hash_md5, f):
+            size = 0
+        elif 0 < size <= SMALL_FILE_THRESHOLD:
+            # Fast path: one read, then drain anything appended since the size was taken
+            data = f.read(size)
+            hash_md5.update(data)
+            if throttle:
+                throttle(len(data))
+            size = 0
+        view = _get_buffer(choose_buffer_size(size, buffer_size))
+        while True:
+            n = f.readinto(view)
+            if not n:
+                break
+            hash_md5.update(view[:n])
+            if throttle:
+                throttle(n)
     return hash_md5.hexdigest()
 
+
+def compute_partial_md5(file_path, size=None, partial_size=DEFAULT_PARTIAL_SIZE):
+    """
+    Compute the MD5 checksum of the first and last partial_size bytes of a file.
+
+    Files no larger than twice partial_size are hashed in full, so for them the partial
+    checksum is the same as the one returned by compute_md5.
+
+    Args:
+        file_path (str): The path to the file.
+        size (int): The size of the file in bytes if already known.
+        partial_size (int): The number of bytes to hash from each end of the file.
+
+    Returns:
+        str: The partial MD5 checksum as a hexadecimal string.
+    """
+    with open(file_path, "rb", buffering=0) as f:
+        if size is None:
+            size = os.fstat(f.fileno()).st_size
+        if size <= 2 * partial_size:
+            return compute_md5(file_path, size=size)
+        hash_md5 = hashlib.md5()
+        view = _get_buffer(partial_size)
+        for offset in (0, size - partial_size):
+            f.seek(offset)
+            remaining = partial_size
+            while remaining:
+                n = f.readinto(view[:remaining])
+                if not n:
+                    break
+                hash_md5.update(view[:n])
+                remaining -= n
+    return hash_md5.hexdigest()
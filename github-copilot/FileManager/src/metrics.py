@@ -0,0 +1,518 @@
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager, nullcontext
+
+SECONDS = 1e-6  # Unit of the histograms of stage times: their smallest bucket ends at a microsecond
+COUNT = 1  # Unit of the histograms of counts, such as rows per batch or queue depth
+PROGRESS_INTERVAL = 1.0  # Seconds between updates of the progress line
+QUANTILES = (0.5, 0.9, 0.99)  # Percentiles of each histogram written by write_metrics
+PROMETHEUS_PREFIX = 'filemanager_'
+
+FILE_STATUSES = ('skipped', 'linked', 'recorded', 'processed')  # Counted per file by a scan
+DB_STAGES = ('lookup', 'write')  # Stages spent waiting on the database rather than the file system
+WRITER_SATURATION = 0.9  # Share of the run the single writer thread must be busy for a run to be DB-bound
+
+
+class Histogram:
+    """
+    A histogram of positive values, such as the times of a stage, in buckets whose
+    bounds double.
+
+    Bucket e holds the values from unit * 2 ** (e - 1) up to unit * 2 ** e, and bucket 0
+    every value up to unit, so a percentile is estimated to within a factor of two from a
+    few dozen counters however many values are observed.
+    """
+
+    def __init__(self, unit=SECONDS):
+        self.unit = unit
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = {}
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        exponent = math.frexp(value / self.unit)[1] if value > self.unit else 0
+        self.buckets[exponent] = self.buckets.get(exponent, 0) + 1
+
+    def merge(self, other):
+        """Add the values of another histogram with the same unit."""
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        for exponent, count in list(other.buckets.items()):
+            self.buckets[exponent] = self.buckets.get(exponent, 0) + count
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, q):
+        """
+        Estimate the value below which a fraction q of the values fall, as the upper
+        bound of the bucket holding it, capped at the largest value observed.
+        """
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for exponent in sorted(self.buckets):
+            seen += self.buckets[exponent]
+            if seen >= rank:
+                break
+        return min(self.unit * 2 ** exponent, self.max)
+
+
+class _Shard:
+    """The counters, histograms and CPU times recorded by one thread."""
+
+    __slots__ = ('counters', 'histograms', 'cpu')
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.cpu = {}  # Seconds of CPU time spent in each stage
+
+
+class Metrics:
+    """
+    Counters, histograms and stage times of a scan or audit, shared by all its threads.
+
+    Each thread records into a shard of its own, so the hot paths take no lock; reading
+    the metrics adds up the shards. Stage times are wall-clock times, and stages timed
+    with stage also record the CPU time of the thread, which tells hashing that waits
+    on the disk apart from hashing that keeps a core busy.
+
+    The stages of a scan are stat (listing directories and stat'ing files), lookup
+    (checking the database for unchanged files and hardlinks), hash and write
+    (committing a batch in the DatabaseWriter). The counters are files, bytes (hashed),
+    skipped, linked, recorded, processed, errors and lock_retries, and for audits
+    removed and rehashed, or modified and mismatches.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self._local = threading.local()
+        self._shards = []
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def count(self, name, amount=1):
+        counters = self._shard().counters
+        counters[name] = counters.get(name, 0) + amount
+
+    def observe(self, name, value, unit=SECONDS):
+        """Add a value to the named histogram, created with unit on first use."""
+        histograms = self._shard().histograms
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram(unit)
+        histogram.observe(value)
+
+    @contextmanager
+    def stage(self, name):
+        """Record the wall-clock and CPU time of the with block in the named stage."""
+        start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            cpu = self._shard().cpu
+            cpu[name] = cpu.get(name, 0) + time.thread_time() - cpu_start
+            self.observe(name, time.perf_counter() - start)
+
+    def add_gauge(self, name, read):
+        """Sample read() as the named value, such as a queue depth, whenever the gauges are sampled."""
+        self._gauges[name] = read
+
+    def sample_gauges(self):
+        """Read every gauge, add each value to the histogram of the same name and return them."""
+        values = {name: read() for name, read in list(self._gauges.items())}
+        for name, value in values.items():
+            self.observe(name, value, unit=COUNT)
+        return values
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def _merged_shards(self):
+        with self._lock:
+            shards = list(self._shards)
+        counters, histograms, cpu = {}, {}, {}
+        for shard in shards:
+            for name, value in list(shard.counters.items()):
+                counters[name] = counters.get(name, 0) + value
+            for name, value in list(shard.cpu.items()):
+                cpu[name] = cpu.get(name, 0) + value
+            for name, histogram in list(shard.histograms.items()):
+                if name not in histograms:
+                    histograms[name] = Histogram(histogram.unit)
+                histograms[name].merge(histogram)
+        return counters, histograms, cpu
+
+    def counters(self):
+        return self._merged_shards()[0]
+
+    def histograms(self):
+        return self._merged_shards()[1]
+
+    def snapshot(self):
+        """
+        Return the merged counters, histograms and CPU times as a picklable dict, for
+        example to send the metrics of a worker process back to be merged.
+        """
+        counters, histograms, cpu = self._merged_shards()
+        return {'counters': counters, 'histograms': histograms, 'cpu': cpu}
+
+    def merge(self, snapshot):
+        """Add the metrics of a snapshot to those of the calling thread."""
+        shard = self._shard()
+        for name, value in snapshot['counters'].items():
+            shard.counters[name] = shard.counters.get(name, 0) + value
+        for name, value in snapshot['cpu'].items():
+            shard.cpu[name] = shard.cpu.get(name, 0) + value
+        for name, histogram in snapshot['histograms'].items():
+            if name not in shard.histograms:
+                shard.histograms[name] = Histogram(histogram.unit)
+            shard.histograms[name].merge(histogram)
+
+    def busy_times(self):
+        """
+        Split the time spent in all stages by every thread into the seconds spent on
+        the file system (I/O), computing (CPU) and waiting on the database (DB).
+
+        Database stages count as DB. In the other stages the recorded CPU time counts
+        as CPU and the rest as I/O, and stages timed without CPU time count as I/O.
+        """
+        counters, histograms, cpu = self._merged_shards()
+        times = {'I/O': 0, 'CPU': 0, 'DB': 0}
+        for name, histogram in histograms.items():
+            if histogram.unit != SECONDS:
+                continue
+            if name in DB_STAGES:
+                times['DB'] += histogram.total
+            else:
+                cpu_time = min(cpu.get(name, 0), histogram.total)
+                times['CPU'] += cpu_time
+                times['I/O'] += histogram.total - cpu_time
+        return times
+
+    def bottleneck(self):
+        """
+        Return what limited the run: 'I/O', 'CPU' or 'DB', or None if no stage was timed.
+
+        A run whose single writer thread was busy committing for most of it is DB-bound.
+        Otherwise the resource on which the threads spent the most time wins.
+        """
+        elapsed = self.elapsed()
+        write = self.histograms().get('write')
+        if write is not None and elapsed and write.total >= WRITER_SATURATION * elapsed:
+            return 'DB'
+        times = self.busy_times()
+        if not any(times.values()):
+            return None
+        return max(times, key=times.get)
+
+    def summary(self):
+        counters, histograms, _ = self._merged_shards()
+        elapsed = self.elapsed() or 1e-9
+        files = counters.get('files', 0)
+        megabytes = counters.get('bytes', 0) / 1024 ** 2
+        message = (f"{files} files in {elapsed:.2f}s ({files / elapsed:.0f} files/s), {megabytes:.1f} MB hashed "
+                   f"({megabytes / elapsed:.1f} MB/s)")
+        message += _skipped_share(counters)
+        message += f", {counters.get('errors', 0)} errors, {counters.get('lock_retries', 0)} lock retries"
+        stages = ', '.join(
+            f"{name} {histogram.total:.2f}s (p50 {_format_seconds(histogram.percentile(0.5))}, "
+            f"p99 {_format_seconds(histogram.percentile(0.99))})"
+            for name, histogram in sorted(histograms.items()) if histogram.unit == SECONDS
+        )
+        if stages:
+            message += f"; {stages}"
+        bottleneck = self.bottleneck()
+        if bottleneck is not None:
+            times = self.busy_times()
+            busy = sum(times.values())
+            shares = ', '.join(f"{name} {seconds / busy:.0%}" for name, seconds in times.items())
+            message += f"; {bottleneck}-bound ({shares} of busy time)"
+        return message
+
+
+def timed(metrics, name):
+    """Time a with block as the named stage of metrics, or do nothing if metrics is None."""
+    return nullcontext() if metrics is None else metrics.stage(name)
+
+
+def _skipped_share(counters):
+    """Describe the share of files a scan skipped as unchanged, or return '' for other runs."""
+    files = counters.get('files', 0)
+    if not files or not any(status in counters for status in FILE_STATUSES):
+        return ''
+    return f", {counters.get('skipped', 0) / files:.0%} skipped"
+
+
+def _format_seconds(seconds):
+    return f"{seconds * 1000:.1f}ms" if seconds < 1 else f"{seconds:.2f}s"
+
+
+class _PeriodicThread(ABC):
+    """
+    Call tick from a background thread every interval seconds while used as a context
+    manager, and finish with the outcome of the with block once it exits. Subclasses
+    implement tick and may override finish.
+    """
+
+    def __init__(self, interval, name):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def __enter__(self):
+        if self.interval:
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.interval:
+            self._stop.set()
+            self._thread.join()
+        self.finish(exc_type is None)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.tick()
+
+    @abstractmethod
+    def tick(self):
+        """Report once, from the background thread."""
+
+    def finish(self, completed):
+        pass
+
+
+class ProgressLine(_PeriodicThread):
+    """
+    Rewrite a one-line progress report on stderr from a background thread, at most
+    once per interval seconds.
+
+    The line shows the files and bytes per second over the last interval, the totals,
+    the share of files skipped as unchanged and the gauges, such as the queue depth.
+    Use it as a context manager around the run.
+    """
+
+    def __init__(self, metrics, interval=PROGRESS_INTERVAL, stream=None):
+        super().__init__(interval, "progress")
+        self.metrics = metrics
+        self.stream = stream or sys.stderr
+        self._width = 0
+        self._last = (0, 0, time.monotonic())  # Files, bytes and time of the previous line
+
+    def tick(self):
+        counters = self.metrics.counters()
+        gauges = self.metrics.sample_gauges()
+        now = time.monotonic()
+        files, size = counters.get('files', 0), counters.get('bytes', 0)
+        last_files, last_bytes, last_time = self._last
+        seconds = now - last_time or 1e-9
+        line = (f"{files} files ({(files - last_files) / seconds:.0f}/s), {size / 1024 ** 2:.1f} MB hashed "
+                f"({(size - last_bytes) / seconds / 1024 ** 2:.1f} MB/s)")
+        line += _skipped_share(counters)
+        for name, value in gauges.items():
+            line += f", {name.replace('_', ' ')} {value}"
+        self._write(line)
+        self._last = (files, size, now)
+
+    def finish(self, completed):
+        if self._width:
+            self.stream.write('\n')
+            self.stream.flush()
+
+    def _write(self, line):
+        self.stream.write('\r' + line.ljust(self._width))
+        self.stream.flush()
+        self._width = len(line)
+
+
+def _histogram_report(histogram, cpu_seconds=None):
+    report = {
+        'count': histogram.count,
+        'sum': histogram.total,
+        'mean': histogram.mean(),
+        'max': histogram.max,
+        'quantiles': {str(q): histogram.percentile(q) for q in QUANTILES},
+    }
+    if cpu_seconds is not None:
+        report['cpu_seconds'] = cpu_seconds
+    return report
+
+
+def metrics_report(metrics, completed=True):
+    """
+    Describe metrics as a dict of plain values, as written by write_metrics.
+
+    Stage times are in seconds, with their estimated percentiles, and the write stage
+    is summarized again under db_writes with the rows per committed batch.
+
+    Args:
+        metrics (Metrics): The metrics of the run.
+        completed (bool): Whether the run has finished, rather than still being in
+            progress or having failed.
+    """
+    counters, histograms, cpu = metrics._merged_shards()
+    elapsed = metrics.elapsed()
+    batches = histograms.get('write_batch_rows', Histogram(COUNT))
+    write = histograms.get('write', Histogram())
+    return {
+        'timestamp': time.time(),
+        'elapsed_seconds': elapsed,
+        'completed': completed,
+        'counters': counters,
+        'throughput': {
+            'files_per_second': counters.get('files', 0) / elapsed if elapsed else 0,
+            'bytes_per_second': counters.get('bytes', 0) / elapsed if elapsed else 0,
+        },
+        'stages': {name: _histogram_report(histogram, cpu.get(name, 0))
+                   for name, histogram in sorted(histograms.items()) if histogram.unit == SECONDS},
+        'histograms': {name: _histogram_report(histogram)
+                       for name, histogram in sorted(histograms.items()) if histogram.unit != SECONDS},
+        'db_writes': {
+            'batches': batches.count,
+            'rows': batches.total,
+            'rows_per_batch': batches.mean(),
+            'commit_seconds': write.total,
+            'lock_retries': counters.get('lock_retries', 0),
+        },
+        'busy_seconds': metrics.busy_times(),
+        'bottleneck': metrics.bottleneck(),
+    }
+
+
+def _prometheus_labels(labels):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}' if labels else ''
+
+
+def format_prometheus(report, labels=None):
+    """
+    Render a metrics_report in the Prometheus text exposition format, with the given
+    labels, such as the action, on every sample.
+
+    Counters become <prefix><name>_total, the stage times a summary named
+    <prefix>stage_seconds with a stage label, and other histograms summaries of their
+    own. Percentiles are the estimates of Histogram.percentile.
+    """
+    labels = dict(labels or {})
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        name = PROMETHEUS_PREFIX + name
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for suffix, extra, value in samples:
+            lines.append(f"{name}{suffix}{_prometheus_labels({**labels, **extra})} {value!r}")
+
+    def summary_samples(histogram, extra):
+        samples = [('', {**extra, 'quantile': q}, value) for q, value in histogram['quantiles'].items()]
+        return samples + [('_sum', extra, histogram['sum']), ('_count', extra, histogram['count'])]
+
+    metric('completed', 'gauge', "Whether the run had finished when the metrics were written.",
+           [('', {}, int(report['completed']))])
+    metric('last_update_timestamp_seconds', 'gauge', "When the metrics were written.",
+           [('', {}, report['timestamp'])])
+    metric('elapsed_seconds', 'gauge', "Seconds since the run started.", [('', {}, report['elapsed_seconds'])])
+    for name, value in sorted(report['counters'].items()):
+        metric(f"{name}_total", 'counter', f"The {name.replace('_', ' ')} counter of the run.", [('', {}, value)])
+    for name, value in report['throughput'].items():
+        metric(name, 'gauge', f"Average {name.replace('_', ' ')} over the run.", [('', {}, value)])
+    if report['stages']:
+        metric('stage_seconds', 'summary', "Seconds spent in each call of a stage.",
+               [sample for stage, histogram in report['stages'].items()
+                for sample in summary_samples(histogram, {'stage': stage})])
+        metric('stage_cpu_seconds', 'gauge', "CPU seconds spent in a stage by the threads timing it.",
+               [('', {'stage': stage}, histogram['cpu_seconds']) for stage, histogram in report['stages'].items()])
+    for name, histogram in report['histograms'].items():
+        metric(name, 'summary', f"Distribution of the {name.replace('_', ' ')} of the run.",
+               summary_samples(histogram, {}))
+    for name, value in report['db_writes'].items():
+        if name != 'lock_retries':  # Already written as a counter
+            metric(f"db_write_{name}", 'gauge', f"Database writer {name.replace('_', ' ')}.", [('', {}, value)])
+    metric('busy_seconds', 'gauge', "Seconds of stage time spent on each resource.",
+           [('', {'resource': resource}, value) for resource, value in report['busy_seconds'].items()])
+    metric('bottleneck', 'gauge', "1 for the resource that limited the run.",
+           [('', {'resource': resource}, int(resource == report['bottleneck']))
+            for resource in report['busy_seconds']])
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(metrics, path, output_format=None, labels=None, completed=True):
+    """
+    Write metrics to a file as JSON or in the Prometheus text format.
+
+    The file is written next to its final path and renamed over it, so a reader such
+    as the node exporter textfile collector never sees a partial file.
+
+    Args:
+        metrics (Metrics): The metrics of the run.
+        path (str): The path to the file.
+        output_format (str): 'json' or 'prometheus', or None to use prometheus for a
+            path ending in .prom and JSON otherwise.
+        labels (dict): Labels, such as the action, added to every Prometheus sample
+            and stored under labels in JSON.
+        completed (bool): Whether the run has finished.
+    """
+    output_format = output_format or ('prometheus' if path.endswith('.prom') else 'json')
+    report = metrics_report(metrics, completed)
+    if output_format == 'prometheus':
+        text = format_prometheus(report, labels)
+    elif output_format == 'json':
+        text = json.dumps({'labels': dict(labels or {}), **report}, indent=2) + '\n'
+    else:
+        raise ValueError(f"Invalid metrics format: {output_format}")
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+
+class MetricsExporter(_PeriodicThread):
+    """
+    Write metrics to a file with write_metrics when the with block exits, and every
+    interval seconds before that if interval is set, marking the file completed only
+    if the block finished without an exception.
+    """
+
+    def __init__(self, metrics, path, output_format=None, labels=None, interval=None):
+        super().__init__(interval, "metrics-exporter")
+        self.metrics = metrics
+        self.path = path
+        self.output_format = output_format
+        self.labels = labels
+
+    def tick(self):
+        self.metrics.sample_gauges()
+        self._write(completed=False)
+
+    def finish(self, completed):
+        self._write(completed)
+
+    def _write(self, completed):
+        try:
+            write_metrics(self.metrics, self.path, self.output_format, self.labels, completed)
+        except OSError as e:
+            logging.error(f"Error writing metrics to {self.path}: {e}")
@@ -0,0 +1,137 @@
+import io
+import pstats
+import sys
+import threading
+import time
+
+DEFAULT_PROFILE_INTERVAL = 0.005  # Seconds between samples of every thread's stack
+PROFILE_TOP = 15  # Functions printed per stage
+
+# The stage of a thread, by the prefix of its name
+THREAD_STAGES = (
+    ('walker', 'traversal'),
+    ('walk-files', 'traversal'),
+    ('producer', 'traversal'),
+    ('hasher', 'hashing'),
+    ('batch-worker', 'workers'),
+    ('db-writer', 'writer'),
+    ('MainThread', 'main'),
+)
+
+
+def thread_stage(name):
+    """Return the stage of a thread from its name, or 'other'."""
+    for prefix, stage in THREAD_STAGES:
+        if name.startswith(prefix):
+            return stage
+    return 'other'
+
+
+def _function_key(code):
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+class _SampledProfile:
+    """Stats in the layout of cProfile, which pstats.Stats loads through create_stats."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class SamplingProfiler:
+    """
+    Profile every thread of the process by sampling their stacks from a background
+    thread, and attribute each sample to a stage by the name of its thread: the
+    traversal producer and walkers, the hashing consumers, the audit batch workers, the
+    database writer and the main thread.
+
+    Unlike cProfile, which only sees the thread that enabled it and slows down every
+    call, sampling costs the same however busy the threads are, and interval trades
+    precision for overhead. The samples are wall-clock, so a thread blocked on a queue
+    or a lock shows the time in the function that waits. Worker processes are not
+    sampled.
+
+    The stats use the layout of cProfile. Each sample stands for the time since the
+    previous one, which may be longer than interval while busy threads hold the GIL,
+    and the time of a function adds up the samples it was seen in. Its call count is
+    the number of those samples. Use it as a context manager around the run.
+    """
+
+    def __init__(self, interval=DEFAULT_PROFILE_INTERVAL):
+        if interval <= 0:
+            raise ValueError(f"Invalid profile interval: {interval}")
+        self.interval = interval
+        self.samples = {}  # Stage: {stack: [samples, seconds]}, with stacks as function keys innermost first
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            seconds, last = now - last, now
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_function_key(frame.f_code))
+                    frame = frame.f_back
+                stage = thread_stage(names.get(ident, ''))
+                totals = self.samples.setdefault(stage, {}).setdefault(tuple(stack), [0, 0])
+                totals[0] += 1
+                totals[1] += seconds
+
+    def stats(self, stage=None):
+        """
+        Return the pstats.Stats of one stage, or of all stages merged, or None if there
+        are no samples.
+        """
+        stages = [stage] if stage is not None else list(self.samples)
+        profile = {}
+        for stack, (count, seconds) in (item for name in stages for item in self.samples.get(name, {}).items()):
+            seen = set()
+            for depth, function in enumerate(stack):
+                cc, nc, tt, ct, callers = profile.get(function, (0, 0, 0, 0, {}))
+                own_time = seconds if depth == 0 else 0
+                if function not in seen:  # Recursive functions count once per sample
+                    seen.add(function)
+                    cc, nc, ct = cc + count, nc + count, ct + seconds
+                if depth + 1 < len(stack):
+                    caller = stack[depth + 1]
+                    c_nc, c_cc, c_tt, c_ct = callers.get(caller, (0, 0, 0, 0))
+                    callers[caller] = (c_nc + count, c_cc + count, c_tt + own_time, c_ct + seconds)
+                profile[function] = (cc, nc, tt + own_time, ct, callers)
+        return pstats.Stats(_SampledProfile(profile)) if profile else None
+
+    def dump(self, path):
+        """Write the stats of all stages merged to a file readable by pstats."""
+        stats = self.stats()
+        if stats is None:
+            stats = pstats.Stats(_SampledProfile({}))
+        stats.dump_stats(path)
+
+    def report(self, limit=PROFILE_TOP):
+        """Describe the functions with the most samples of their own in each stage."""
+        output = io.StringIO()
+        for stage in sorted(self.samples):
+            count = sum(totals[0] for totals in self.samples[stage].values())
+            seconds = sum(totals[1] for totals in self.samples[stage].values())
+            output.write(f"Stage {stage}: {count} samples, {seconds:.2f}s of thread time\n")
+            stats = self.stats(stage)
+            stats.stream = output
+            stats.sort_stats('tottime').print_stats(limit)
+        return output.getvalue()
@@ -1,26 +1,26 @@
 import logging
 import os
-import sqlite3
 import threading
 from concurrent.futures import ThreadPoolExecutor
 from queue import Queue
 
-from src.db import check_for_duplicates, find_duplicates_with_min_count
+from src.db import check_for_duplicates, find_duplicates_with_min_count, iter_duplicate_groups, open_index
 from src.file_ops import process_file
 from src.md5sum import compute_md5
 from src.utils import get_files_with_md5
 
 
 import logging
-import os
 import threading
 from concurrent.futures import ThreadPoolExecutor
-from queue import Queue
-from src.db import check_for_duplicates
+from src.db import check_for_duplicates, get_md5_by_path, KnownFiles, DatabaseWriter
 from src.file_ops import process_file
-from src.md5sum import compute_md5
+from src.metrics import timed
+from src.utils import ScanQueue, DEFAULT_QUEUE_DEPTH
+from src.walker import feed_files
 
-def scan_dir_report(path, db_path, num_threads):
+def scan_dir_report(path, db_path, num_threads, num_walkers=1, queue_depth=DEFAULT_QUEUE_DEPTH, scan_filter=None,
+                    metrics=None):
     """
     Scan a directory, process files concurrently, and report duplicates using a producer-consumer model.
 
@@ -28,54 +28,74 @@ def scan_dir_report(path, db_path, num_threads):
         path (str): The path to the directory.
         db_path (str): The path to the database file.
         num_threads (int): The number of threads to use for concurrent operations.
+        num_walkers (int): The number of threads listing directories concurrently.
+        queue_depth (int): The maximum number of files waiting to be processed.
+        scan_filter (ScanFilter): Skip the directories and files it rejects.
+        metrics (Metrics): Record the counters and stage times of the scan, as scan_dir.
     """
-    file_queue = Queue()
+    known = KnownFiles.load(db_path, path, hashed_only=True)
+    file_queue = ScanQueue(maxsize=queue_depth)
+    if metrics is not None:
+        metrics.add_gauge('queue_depth', file_queue.qsize)
+    # The files this run has hashed, by checksum, as their rows may still be queued in the writer
+    hashed, hashed_lock = {}, threading.Lock()
 
     def producer():
-        for root, _, files in os.walk(path):
-            for file in files:
-                file_queue.put(os.path.join(root, file))
-                logging.debug(f"Found file: {os.path.join(root, file)}")
+        feed_files(path, file_queue.put, num_walkers, scan_filter=scan_filter, metrics=metrics)
         for _ in range(num_threads):
             file_queue.put(None)  # Signal the consumers to stop
 
-    def process_and_report(file_path):
+    def process_and_report(file_path, st):
         try:
-            process_file(file_path, db_path)
-            md5sum = compute_md5(file_path)
-            duplicates = check_for_duplicates(db_path, md5sum)
+            md5sum = process_file(file_path, db_path, st=st, known=known, writer=writer, metrics=metrics)
+            with timed(metrics, 'lookup'):
+                if md5sum is None:
+                    # Unchanged since the last scan, so reuse the stored checksum instead of rehashing
+                    md5sum = get_md5_by_path(db_path, file_path)
+                    queued = []
+                else:
+                    with hashed_lock:
+                        queued = list(hashed.setdefault(md5sum, []))
+                        hashed[md5sum].append(file_path)
+                stored = [d[0] for d in check_for_duplicates(db_path, md5sum) if d[0] != file_path]
+                duplicates = [file_path] + stored + [d for d in queued if d not in stored]
             if len(duplicates) > 1:
                 logging.info(f"Duplicate found for {file_path}")
                 print(f"Duplicate found for {file_path}:")
                 for duplicate in duplicates:
-                    print(duplicate[0])
-                    logging.info(f"Duplicate: {duplicate[0]}")
+                    print(duplicate)
+                    logging.info(f"Duplicate: {duplicate}")
         except Exception as e:
             logging.error(f"Error processing file {file_path}: {e}")
+            if metrics is not None:
+                metrics.count('errors')
         finally:
             file_queue.task_done()
 
     def consumer():
         while True:
-            file_path = file_queue.get()
-            if file_path is None:
+            item = file_queue.get()
+            if item is None:
+                file_queue.task_done()  # Mark the stop signal as done
                 break
-            process_and_report(file_path)
+            process_and_report(*item)
 
     def start_producer():
-        producer_thread = threading.Thread(target=producer)
+        producer_thread = threading.Thread(target=producer, name="producer")
         producer_thread.start()
         return producer_thread
 
     def start_consumers():
-        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        with ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="hasher") as executor:
             for _ in range(num_threads):
                 executor.submit(consumer)
 
-    producer_thread = start_producer()
-    start_consumers()
-    producer_thread.join()
-    file_queue.join()
+    with DatabaseWriter(db_path, metrics=metrics) as writer:
+        producer_thread = start_producer()
+        start_consumers()
+        producer_thread.join()
+        file_queue.join()
+    logging.info(f"Peak queue depth: {file_queue.peak_size} of {queue_depth}")
 
 def report_duplicates(db_path, min_duplicates=1):
     duplicates = find_duplicates_with_min_count(db_path, min_duplicates)
@@ -84,6 +104,30 @@ def report_duplicates(db_path, min_duplicates=1):
     else:
         return {}
 
+def print_duplicate_groups(db_path, min_duplicates=1, order_by='hash'):
+    """
+    Print each group of duplicates as it is streamed from the database.
+
+    Args:
+        db_path (str): The path to the database file.
+        min_duplicates (int): Only groups of more than this many files are printed.
+        order_by (str): 'hash' for checksum order, or 'wasted' to print the groups
+            wasting the most space first, with the space each one wastes.
+
+    Returns:
+        int: The number of groups printed.
+    """
+    count = 0
+    for group in iter_duplicate_groups(db_path, min_duplicates, order_by):
+        if order_by == 'wasted':
+            print(f"MD5: {group.md5sum} ({format_size(group.wasted_bytes)} wasted)")
+        else:
+            print(f"MD5: {group.md5sum}")
+        for path in group.paths:
+            print(f"  {path}")
+        count += 1
+    return count
+
 def report_files_with_more_than_1_duplicate(db_path):
     """
     Report files that have more than 1 duplicate.
@@ -91,18 +135,13 @@ def report_files_with_more_than_1_duplicate(db_path):
     Args:
         db_path (str): The path to the database file.
     """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT path, COUNT(*) as duplicate_count FROM files
-        WHERE md5sum IN (
-            SELECT md5sum FROM files
-            GROUP BY md5sum HAVING COUNT(*) > 1
-        )
-        GROUP BY path
-    ''')
-    results = cursor.fetchall()
-    conn.close()
+    with open_index(db_path) as index:
+        cursor = index.connection().execute('''
+            SELECT path, COUNT(*) as duplicate_count FROM file_paths
+            WHERE md5sum IN (SELECT md5sum FROM dup_groups WHERE member_count > 1)
+            GROUP BY path
+        ''')
+        results = cursor.fetchall()
 
     if results:
         print("Files with more than 1 duplicate:")
@@ -112,41 +151,43 @@ def report_files_with_more_than_1_duplicate(db_path):
         print("No files with more than 1 duplicate found.")
 
 
+def format_size(size):
+    """Format a size in bytes as TB, GB or MB."""
+    if size >= 1024 ** 4:  # Check if size is in terabytes
+        return f"{size / (1024 ** 4):.2f} TB"
+    elif size >= 1024 ** 3:  # Check if size is in gigabytes
+        return f"{size / (1024 ** 3):.2f} GB"
+    else:  # Otherwise, report in megabytes
+        return f"{size / (1024 ** 2):.2f} MB"
+
+
 def report_duplicate_sizes(db_path):
     """
-    Sum the file sizes of duplicates and report the total.
+    Report the space used by duplicate files, telling hardlinks apart from true copies.
+
+    Paths that are hardlinks to the same inode share their storage, so only each
+    additional inode holding the same contents counts towards the space that could be
+    saved by removing duplicates. The totals are read from dup_groups, so the cost
+    depends on the number of duplicate groups rather than the number of files.
 
     Args:
         db_path (str): The path to the database file.
     """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT SUM(size) FROM files
-        WHERE md5sum IN (
-            SELECT md5sum FROM files
-            GROUP BY md5sum HAVING COUNT(*) > 1
-        )
-    ''')
-    total_size = cursor.fetchone()[0]
-    conn.close()
-
-    #  total_size is the total of all files.  We'd really like to know what we would save if we
-    #  deleted all but one of each duplicate file.  So we assume there is one copy of each file
-    # and device by 2.  This should be mostly accurate.
-    total_size = total_size / 2
+    with open_index(db_path) as index:
+        cursor = index.connection().execute('''
+            SELECT COALESCE(SUM(wasted_bytes), 0), COALESCE(SUM(member_count - inode_count), 0),
+                   COALESCE(SUM((member_count - inode_count) * size), 0)
+            FROM dup_groups
+            WHERE member_count > 1
+        ''')
+        total_size, hardlinked_paths, hardlinked_size = cursor.fetchone()
+
     if total_size:
-        if total_size >= 1024 ** 4:  # Check if size is in terabytes
-            total_size_tb = total_size / (1024 ** 4)
-            print(f"Total size of duplicate files: {total_size_tb:.2f} TB")
-        elif total_size >= 1024 ** 3:  # Check if size is in gigabytes
-            total_size_gb = total_size / (1024 ** 3)
-            print(f"Total size of duplicate files: {total_size_gb:.2f} GB")
-        else:  # Otherwise, report in megabytes
-            total_size_mb = total_size / (1024 ** 2)
-            print(f"Total size of duplicate files: {total_size_mb:.2f} MB")
+        print(f"Total size of duplicate files: {format_size(total_size)}")
     else:
         print("No duplicate files found.")
+    if hardlinked_paths:
+        print(f"Already hardlinked: {hardlinked_paths} paths sharing {format_size(hardlinked_size)}")
 
 
 def report_prefix_count(db_path, prefix):
@@ -157,13 +198,11 @@ def report_prefix_count(db_path, prefix):
         db_path (str): The path to the database file.
         prefix (str): The prefix to match files.
     """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT COUNT(*) FROM files WHERE path LIKE ?
-    ''', (f'{prefix}%',))
-    count = cursor.fetchone()[0]
-    conn.close()
+    with open_index(db_path) as index:
+        cursor = index.connection().execute('''
+            SELECT COUNT(*) FROM file_paths WHERE path LIKE ?
+        ''', (f'{prefix}%',))
+        count = cursor.fetchone()[0]
 
     print(f"Number of files that match the prefix '{prefix}': {count}")
 
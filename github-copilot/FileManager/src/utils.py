@@ -1,6 +1,14 @@
+import logging
+import multiprocessing
 import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
+from queue import Queue
 
-from src.md5sum import compute_md5
+from src.md5sum import compute_md5, configure_hashing, hashing_config
+from src.walker import walk_files
 
 
 def get_file_mtime_in_ms(file_path):
@@ -15,11 +23,142 @@ def get_file_mtime_in_ms(file_path):
     """
     return int(os.path.getmtime(file_path) * 1000)
 
+def get_stat_mtime_in_ms(st):
+    """
+    Get the last modified time in milliseconds from a stat result.
+
+    Args:
+        st (os.stat_result): The stat result of a file.
+
+    Returns:
+        int: The last modified time in milliseconds, computed the same way as
+        get_file_mtime_in_ms.
+    """
+    return int(st.st_mtime * 1000)
+
 def get_files_with_md5(directory):
     """Get a dictionary of files and their MD5 checksums in a directory."""
     files_md5 = {}
-    for root, _, files in os.walk(directory):
-        for file in files:
-            file_path = os.path.join(root, file)
-            files_md5[file_path] = compute_md5(file_path)
+    for file_path, st in walk_files(directory):
+        files_md5[file_path] = compute_md5(file_path, size=st.st_size)
     return files_md5
+
+
+class RateLimiter:
+    """
+    Limit the average rate of an amount, such as bytes read, shared by several threads.
+
+    Calling the limiter with an amount that has just been used sleeps for as long as
+    needed to keep the total at or below rate per second since the limiter was last idle.
+    """
+
+    def __init__(self, rate):
+        if rate <= 0:
+            raise ValueError(f"Invalid rate: {rate}")
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()  # When the amounts used so far have been paid for
+
+    def __call__(self, amount):
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now) + amount / self.rate
+            delay = self._next - now
+        time.sleep(delay)
+
+
+DEFAULT_QUEUE_DEPTH = 10000  # Files buffered between traversal and hashing in a scan
+
+
+class ScanQueue(Queue):
+    """
+    A bounded queue between the traversal producer and the hashing consumers of a scan.
+
+    Once maxsize items are waiting, put blocks, so traversal can never get more than
+    maxsize files ahead of hashing and memory stays flat however large the tree is.
+    The largest number of items held at once is recorded in peak_size.
+    """
+
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self.peak_size = 0
+
+    def _put(self, item):
+        super()._put(item)
+        if len(self.queue) > self.peak_size:
+            self.peak_size = len(self.queue)
+
+
+def iter_batches(iterable, batch_size):
+    """Yield lists of up to batch_size items from an iterable."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def run_batches_in_processes(func, batches, num_workers, handle_result, *args, initializer=None, initargs=()):
+    """
+    Run func(batch, *args) for each batch in a process pool and pass each result to
+    handle_result in the calling process.
+
+    At most two batches per worker are in flight, so batches may come from a lazy
+    generator without being queued in memory. Worker processes inherit the hashing
+    configuration of the calling process. Where available they are started from a fork
+    server rather than forked from the caller, since forking a process with open SQLite
+    connections leaves the children with a corrupt view of the database locks.
+
+    Args:
+        func (function): A module-level function to run in the worker processes.
+        batches (iterable): The batches to process.
+        num_workers (int): The number of worker processes.
+        handle_result (function): Called with the return value of each func call.
+        initializer (function): A module-level function called with initargs once in
+            each worker process, for example to open a database connection that every
+            batch of the worker reuses.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else None)
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=context, initializer=_init_worker,
+                             initargs=(hashing_config(), initializer, initargs)) as executor:
+        _run_batches(executor, func, batches, 2 * num_workers, handle_result, args)
+
+
+def _init_worker(hashing, initializer, initargs):
+    configure_hashing(*hashing)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def run_batches_in_threads(func, batches, num_threads, handle_result, *args):
+    """
+    Run func(batch, *args) for each batch in a thread pool and pass each result to
+    handle_result in the calling thread, with at most two batches per thread in flight.
+
+    Args:
+        func (function): The function to run in the worker threads.
+        batches (iterable): The batches to process.
+        num_threads (int): The number of worker threads.
+        handle_result (function): Called with the return value of each func call.
+    """
+    with ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="batch-worker") as executor:
+        _run_batches(executor, func, batches, 2 * num_threads, handle_result, args)
+
+
+def _run_batches(executor, func, batches, max_in_flight, handle_result, args):
+    def drain(futures):
+        for future in futures:
+            try:
+                handle_result(future.result())
+            except Exception as e:
+                logging.error(f"Error processing batch: {e}")
+
+    pending = set()
+    for batch in batches:
+        pending.add(executor.submit(func, batch, *args))
+        if len(pending) >= max_in_flight:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            drain(done)
+    drain(pending)
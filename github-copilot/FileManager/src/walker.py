@@ -0,0 +1,291 @@
+import logging
+import os
+import threading
+import time
+from queue import Queue, Full
+
+WALK_QUEUE_SIZE = 10000  # Files buffered between parallel walkers and a walk_files caller
+WALK_STOP_POLL = 0.1  # Seconds a walker blocked on a full queue waits between checks for an abandoned walk
+
+
+def _scan_directory(directory, on_error=None, scan_filter=None, root_device=None, metrics=None):
+    """
+    List a single directory, stat'ing each regular file once. If the directory cannot
+    be listed, or one of its entries cannot be read, on_error is called with the path
+    of the directory or entry. Subdirectories and files rejected by
+    scan_filter are left out. The time spent listing and stat'ing, but not the time
+    the caller holds each entry, is recorded as the stat stage of metrics.
+
+    Yields:
+        tuple: The path to an entry and its os.stat_result, or None for the stat result
+        of a subdirectory that should be walked.
+    """
+    busy, start = 0, time.perf_counter()
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                item = None
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if scan_filter is None or scan_filter.accepts_directory(entry, root_device):
+                            item = entry.path, None
+                    elif entry.is_file():
+                        st = entry.stat()
+                        if scan_filter is None or scan_filter.accepts_file(entry.path, entry.name, st):
+                            item = entry.path, st
+                except OSError as e:
+                    logging.error(f"Error reading {entry.path}: {e}")
+                    if on_error is not None:
+                        on_error(entry.path)
+                if item is not None:
+                    busy += time.perf_counter() - start
+                    yield item
+                    start = time.perf_counter()
+    except OSError as e:
+        logging.error(f"Error listing directory {directory}: {e}")
+        if on_error is not None:
+            on_error(directory)
+    finally:
+        if metrics is not None:
+            metrics.observe('stat', busy + time.perf_counter() - start)
+
+
+def walk_files(path, num_walkers=1, on_error=None, enter=None, leave=None, scan_filter=None, metrics=None):
+    """
+    Recursively find the regular files under a directory using os.scandir.
+
+    Each file is stat'ed exactly once, and the stat result is yielded alongside its path
+    so that the size, modification time and inode can be used by later stages without
+    another system call. Symbolic links to files are followed, but symbolic links to
+    directories are not descended into, matching os.walk. Special files such as FIFOs
+    and sockets are skipped.
+
+    Args:
+        path (str): The path to the directory.
+        num_walkers (int): The number of threads listing directories concurrently.
+        on_error (function): Called with the path of each directory that cannot be
+            listed and each entry that cannot be read, which are therefore missing
+            from the walk.
+        enter (function): Called with the path of each subdirectory found, before it
+            is listed. If it returns false, the subdirectory is skipped.
+        leave (function): Called with the path of each directory, including path
+            itself, once it has been listed and all its files have been yielded.
+        scan_filter (ScanFilter): Prune the directories and drop the files it rejects.
+        metrics (Metrics): Record the time spent listing each directory as its stat stage.
+
+    Yields:
+        tuple: The path to a file and its os.stat_result.
+    """
+    if num_walkers > 1:
+        yield from _walk_files_parallel(path, num_walkers, on_error, enter, leave, scan_filter, metrics)
+        return
+
+    root_device = scan_filter.root_device(path) if scan_filter is not None else None
+    stack = [path]
+    while stack:
+        directory = stack.pop()
+        for entry_path, st in _scan_directory(directory, on_error, scan_filter, root_device, metrics):
+            if st is None:
+                if enter is None or enter(entry_path):
+                    stack.append(entry_path)
+            else:
+                yield entry_path, st
+        if leave is not None:
+            leave(directory)
+
+
+def feed_files(path, put, num_walkers=1, on_error=None, enter=None, leave=None, scan_filter=None, metrics=None):
+    """
+    Walk a directory and pass every regular file to put, listing directories in parallel.
+
+    Directories waiting to be listed are kept on a shared work queue, and each walker
+    thread takes a directory from it, lists it, queues its subdirectories and passes its
+    files to put. If put blocks, for example on a full bounded queue, the walker that
+    called it waits until there is room.
+
+    Args:
+        path (str): The path to the directory.
+        put (function): Called with a (file path, os.stat_result) tuple for each file.
+            It must be safe to call from several threads at once.
+        num_walkers (int): The number of threads listing directories concurrently.
+        on_error (function): Called with the path of each directory that cannot be
+            listed and each entry that cannot be read. It must be safe to call from
+            several threads at once.
+        enter (function): Called with the path of each subdirectory found, before it
+            is queued to be listed; if it returns false, the subdirectory is skipped.
+            It must be safe to call from several threads at once.
+        leave (function): Called with the path of each directory, including path
+            itself, once it has been listed and all its files passed to put. It must be
+            safe to call from several threads at once.
+        scan_filter (ScanFilter): Prune the directories and drop the files it rejects.
+            The one filter is shared by all the walker threads.
+        metrics (Metrics): Record the time spent listing each directory as its stat stage.
+    """
+    if num_walkers <= 1:
+        for item in walk_files(path, on_error=on_error, enter=enter, leave=leave, scan_filter=scan_filter,
+                               metrics=metrics):
+            put(item)
+        return
+
+    root_device = scan_filter.root_device(path) if scan_filter is not None else None
+    dir_queue = Queue()
+
+    def walker():
+        while True:
+            directory = dir_queue.get()
+            if directory is None:
+                dir_queue.task_done()  # Mark the stop signal as done
+                break
+            try:
+                for entry_path, st in _scan_directory(directory, on_error, scan_filter, root_device, metrics):
+                    if st is None:
+                        if enter is None or enter(entry_path):
+                            dir_queue.put(entry_path)
+                    else:
+                        put((entry_path, st))
+            except Exception as e:
+                logging.error(f"Error walking directory {directory}: {e}")
+                if on_error is not None:
+                    on_error(directory)
+            finally:
+                if leave is not None:
+                    leave(directory)
+                dir_queue.task_done()
+
+    dir_queue.put(path)
+    threads = [threading.Thread(target=walker, name=f"walker-{i}", daemon=True) for i in range(num_walkers)]
+    for thread in threads:
+        thread.start()
+    dir_queue.join()  # Every queued directory has been listed
+    for _ in threads:
+        dir_queue.put(None)  # Signal the walkers to stop
+    for thread in threads:
+        thread.join()
+
+
+def _walk_files_parallel(path, num_walkers, on_error=None, enter=None, leave=None, scan_filter=None, metrics=None):
+    """
+    Run feed_files in a background thread and yield the files it finds.
+
+    If the caller stops iterating early, the walkers drop the files they find instead of
+    waiting on the full queue, descend no further and soon exit. The directories they
+    were listing are not passed to leave, as some of their files were dropped.
+    """
+    file_queue = Queue(maxsize=WALK_QUEUE_SIZE)
+    done = object()
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                file_queue.put(item, timeout=WALK_STOP_POLL)
+                return
+            except Full:
+                pass
+
+    def enter_unless_stopped(directory):
+        return not stopped.is_set() and (enter is None or enter(directory))
+
+    def leave_unless_stopped(directory):
+        if not stopped.is_set() and leave is not None:
+            leave(directory)
+
+    def run():
+        try:
+            feed_files(path, put, num_walkers, on_error, enter_unless_stopped, leave_unless_stopped, scan_filter,
+                       metrics)
+        finally:
+            put(done)
+
+    threading.Thread(target=run, name="walk-files", daemon=True).start()
+    try:
+        while True:
+            item = file_queue.get()
+            if item is done:
+                return
+            yield item
+    finally:
+        stopped.set()  # Unblock the walkers if the caller stopped early
+
+
+class SubtreeTracker:
+    """
+    Work out when whole subtrees of a walk have been processed.
+
+    A directory's subtree is complete once the directory has been listed, every file in
+    it has been processed and the subtrees of all its subdirectories are complete. Pass
+    enter and leave to feed_files, and call add_file before a file is queued for
+    processing and file_done after it has been processed. on_complete is then called
+    with each directory whose subtree completes, deepest first, unless something in
+    the subtree failed.
+
+    Subdirectories in the completed set are skipped by enter without being listed.
+    Directories are keyed by their path without trailing separators. All methods are
+    safe to call from several threads at once.
+    """
+
+    def __init__(self, root, on_complete, completed=()):
+        self.root = self._key(root)
+        self.on_complete = on_complete
+        self.completed = frozenset(self._key(directory) for directory in completed)
+        self._pending = {self.root: 1}  # Unprocessed files and subtrees, plus 1 until listed
+        self._failed = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(directory):
+        return directory.rstrip(os.sep) or directory
+
+    def enter(self, directory):
+        """Count a subdirectory found by the walk, or return False to skip it."""
+        directory = self._key(directory)
+        if directory in self.completed:
+            return False
+        with self._lock:
+            self._pending[directory] = 1
+            self._pending[os.path.dirname(directory)] += 1
+        return True
+
+    def leave(self, directory):
+        """Record that a directory has been listed."""
+        self._done(self._key(directory))
+
+    def fail(self, path):
+        """
+        Keep the subtrees containing a file or directory from completing, for example
+        because it could not be read. A directory that was entered but could not be
+        listed fails itself; any other path fails the directory containing it.
+        """
+        path = self._key(path)
+        with self._lock:
+            self._failed.add(path if path in self._pending else os.path.dirname(path))
+
+    def add_file(self, file_path):
+        """Count a file that is about to be queued for processing."""
+        with self._lock:
+            self._pending[os.path.dirname(file_path)] += 1
+
+    def file_done(self, file_path, ok=True):
+        """Record that a file has been processed, successfully or not."""
+        if not ok:
+            self.fail(file_path)
+        self._done(os.path.dirname(file_path))
+
+    def _done(self, directory):
+        completed = []
+        with self._lock:
+            while directory is not None:
+                self._pending[directory] -= 1
+                if self._pending[directory]:
+                    break
+                del self._pending[directory]
+                parent = None if directory == self.root else os.path.dirname(directory)
+                if directory in self._failed:
+                    self._failed.discard(directory)
+                    if parent is not None:
+                        self._failed.add(parent)
+                else:
+                    completed.append(directory)
+                directory = parent
+        for directory in completed:
+            self.on_complete(directory)
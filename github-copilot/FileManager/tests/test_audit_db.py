@@ -5,7 +5,7 @@ import tempfile
 import shutil
 from unittest.mock import patch
 from src.main import audit_db
-from src.db import initialize_db, remove_file_info, store_file_info
+from src.db import initialize_db, get_file_info, store_file_info
 from src.md5sum import compute_md5
 
 
@@ -42,9 +42,9 @@ class TestAuditDB(unittest.TestCase):
 
         os.remove(file_path)  # Remove the file to simulate a missing file
 
-        with patch('src.db.remove_file_info') as mock_remove_file_info:
-            audit_db(self.db_path, 2)
-            mock_remove_file_info.assert_called_once_with(self.db_path, file_path)
+        stats = audit_db(self.db_path, 2)
+        self.assertEqual(stats.removed, 1)
+        self.assertIsNone(get_file_info(self.db_path, file_path))
 
     # def test_audit_db_file_reprocessed(self):
     #     file_path = os.path.join(self.test_data_dir, 'test-file.txt')
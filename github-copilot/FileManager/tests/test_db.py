@@ -1,10 +1,15 @@
 import os
 import sqlite3
+import threading
 import unittest
+from unittest.mock import patch
 from src.db import (
+    store_staged_hashes,
     initialize_db, get_file_info, get_all_files_info, store_file_info,
     remove_file_info, remove_files_by_regex, get_md5_by_path,
-    check_for_duplicates, find_duplicates_with_min_count, audit_db
+    check_for_duplicates, find_duplicates_with_min_count, audit_db, KnownFiles, DatabaseWriter,
+    FileIndex, SCHEMA_VERSION, regex_literal_prefix, iter_duplicate_groups, verify_db, begin_scan,
+    get_scan_checkpoints, open_worker_index, _open_indexes
 )
 from src.md5sum import compute_md5
 from src.utils import get_file_mtime_in_ms
@@ -38,14 +43,61 @@ class TestDBFunctions(unittest.TestCase):
         self.assertIsNotNone(result)
         self.assertEqual(result[0], 'files')
 
+    def test_initialize_db_upgrades_old_schema(self):
+        db_path = 'test_upgrade.db'
+        conn = sqlite3.connect(db_path)
+        conn.execute('''
+            CREATE TABLE files (
+                id INTEGER PRIMARY KEY, md5sum TEXT, size INTEGER, last_modified INTEGER, path TEXT UNIQUE
+            )
+        ''')
+        md5sum = 'd41d8cd98f00b204e9800998ecf8427e'
+        conn.execute("INSERT INTO files (md5sum, size, last_modified, path) VALUES (?, 0, 1, 'a')", (md5sum,))
+        conn.execute("INSERT INTO files (md5sum, size, last_modified, path) VALUES ('bad', 0, 1, 'b')")
+        conn.commit()
+        conn.close()
+        try:
+            initialize_db(db_path)
+            initialize_db(db_path)  # Already up to date
+            self.assertEqual(get_md5_by_path(db_path, 'a'), md5sum)
+            self.assertEqual(get_file_info(db_path, 'b'), (0, None))
+            conn = sqlite3.connect(db_path)
+            self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], SCHEMA_VERSION)
+            self.assertEqual(conn.execute("SELECT typeof(md5sum) FROM file_paths WHERE path = 'a'").fetchone()[0], 'blob')
+            indexes = {row[1] for row in conn.execute("PRAGMA index_list(files)")}
+            self.assertTrue({'idx_files_md5sum', 'idx_files_size', 'idx_files_inode'} <= indexes)
+            conn.close()
+        finally:
+            os.remove(db_path)
+
     def test_store_file_info(self):
         file_name = 'test-file.txt'
         file_path = os.path.join(self.test_data_dir, file_name)
         store_file_info(self.db_path, file_path, compute_md5(file_path))
-        self.cursor.execute('SELECT * FROM files WHERE path = ?', (file_path,))
+        self.cursor.execute('SELECT * FROM file_paths WHERE path = ?', (file_path,))
         result = self.cursor.fetchone()
         self.assertIsNotNone(result)
-        self.assertEqual(result[1], compute_md5(file_path))
+        self.assertEqual(result[1], bytes.fromhex(compute_md5(file_path)))
+
+    def test_directories(self):
+        paths = ['/data/a/one.txt', '/data/a/two.txt', '/data/b/one.txt', 'relative.txt']
+        for i, path in enumerate(paths):
+            store_file_info(self.db_path, path, None, size=i, last_modified=i, st_dev=0, st_ino=i)
+        self.assertEqual(get_file_info(self.db_path, '/data/a/two.txt'), (1, 1))
+        self.cursor.execute('SELECT path FROM file_paths ORDER BY path')
+        self.assertEqual([row[0] for row in self.cursor.fetchall()], sorted(paths))
+        self.cursor.execute('''
+            SELECT d.path, p.path FROM directories d LEFT JOIN directories p ON p.id = d.parent_id
+        ''')
+        parents = dict(self.cursor.fetchall())
+        self.assertEqual(parents['/data/a/'], '/data/')
+        self.assertEqual(parents['/data/'], '/')
+        self.assertIsNone(parents['/'])
+        self.cursor.execute('SELECT COUNT(*) FROM files WHERE name = ?', ('one.txt',))
+        self.assertEqual(self.cursor.fetchone()[0], 2)
+        remove_file_info(self.db_path, '/data/a/one.txt')
+        self.assertIsNone(get_file_info(self.db_path, '/data/a/one.txt'))
+        self.assertEqual(get_file_info(self.db_path, '/data/b/one.txt'), (2, 2))
 
     def test_get_file_info(self):
         file_name = 'test-file.txt'
@@ -56,6 +108,20 @@ class TestDBFunctions(unittest.TestCase):
         self.assertEqual(file_info[0], os.path.getsize(file_path))
         self.assertEqual(file_info[1], get_file_mtime_in_ms(file_path))
 
+    def test_known_files(self):
+        file_name = 'test-file.txt'
+        file_path = os.path.join(self.test_data_dir, file_name)
+        other_path = os.path.join(self.duplicate_data_dir, 'test-file-01.txt')
+        store_file_info(self.db_path, file_path, compute_md5(file_path))
+        store_file_info(self.db_path, other_path, compute_md5(other_path))
+        known = KnownFiles.load(self.db_path, self.test_data_dir)
+        self.assertEqual(len(known), 1)
+        size = os.path.getsize(file_path)
+        last_modified = get_file_mtime_in_ms(file_path)
+        self.assertTrue(known.is_unchanged(file_path, size, last_modified))
+        self.assertFalse(known.is_unchanged(file_path, size + 1, last_modified))
+        self.assertFalse(known.is_unchanged(other_path, os.path.getsize(other_path), get_file_mtime_in_ms(other_path)))
+
     def test_get_all_files_info(self):
         file_name = 'test-file.txt'
         file_path = os.path.join(self.test_data_dir, file_name)
@@ -64,12 +130,23 @@ class TestDBFunctions(unittest.TestCase):
         self.assertEqual(len(files_info), 1)
         self.assertIn((file_path, os.path.getsize(file_path), get_file_mtime_in_ms(file_path)), files_info)
 
+    def test_files_in_path_order(self):
+        paths = ['/data/b/one.txt', '/data/a/two.txt', 'relative.txt', '/data/ab/one.txt', '/data/a/one.txt', '/z']
+        for i, path in enumerate(paths):
+            store_file_info(self.db_path, path, None, size=i, last_modified=i, st_dev=0, st_ino=i)
+        with FileIndex(self.db_path) as index:
+            batches = list(index.files_in_path_order(batch_size=2))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 2])
+        self.assertEqual([row[0] for batch in batches for row in batch],
+                         ['relative.txt', '/z', '/data/a/one.txt', '/data/a/two.txt', '/data/ab/one.txt',
+                          '/data/b/one.txt'])
+
     def test_remove_file_info(self):
         file_name = 'test-file.txt'
         file_path = os.path.join(self.test_data_dir, file_name)
         store_file_info(self.db_path, file_path, compute_md5(file_path))
         remove_file_info(self.db_path, file_path)
-        self.cursor.execute('SELECT * FROM files WHERE path = ?', (file_path,))
+        self.cursor.execute('SELECT * FROM file_paths WHERE path = ?', (file_path,))
         result = self.cursor.fetchone()
         self.assertIsNone(result)
 
@@ -78,10 +155,115 @@ class TestDBFunctions(unittest.TestCase):
         file_path = os.path.join(self.test_data_dir, file_name)
         store_file_info(self.db_path, file_path, compute_md5(file_path))
         remove_files_by_regex(self.db_path, r'test-file\.txt')
-        self.cursor.execute('SELECT * FROM files WHERE path = ?', (file_path,))
+        self.cursor.execute('SELECT * FROM file_paths WHERE path = ?', (file_path,))
         result = self.cursor.fetchone()
         self.assertIsNone(result)
 
+    def test_remove_files_by_regex_prefix(self):
+        paths = ['/data/a/one.txt', '/data/a/two.log', '/data/ab/one.txt', '/data/b/one.txt', '/other/data/a/x.txt']
+        for i, path in enumerate(paths):
+            store_file_info(self.db_path, path, None, size=i, last_modified=i, st_dev=0, st_ino=i)
+        self.assertEqual(remove_files_by_regex(self.db_path, r'^/data/a.*\.txt$'), 2)
+        self.assertEqual(remove_files_by_regex(self.db_path, r'^/data/a.*\.txt$'), 0)
+        self.cursor.execute('SELECT path FROM file_paths ORDER BY path')
+        self.assertEqual([row[0] for row in self.cursor.fetchall()],
+                         ['/data/a/two.log', '/data/b/one.txt', '/other/data/a/x.txt'])
+        with FileIndex(self.db_path) as index:
+            self.assertEqual(index.remove_files_by_regex(r'data/[ab]/', chunk_size=1), 3)
+
+    def test_regex_literal_prefix(self):
+        self.assertEqual(regex_literal_prefix(r'^/data/photos/'), '/data/photos/')
+        self.assertEqual(regex_literal_prefix(r'\A/a/b\.txt$'), '/a/b.txt')
+        self.assertEqual(regex_literal_prefix(r'^/a/bc*'), '/a/b')
+        self.assertEqual(regex_literal_prefix(r'^/a/b+'), '/a/b')
+        self.assertEqual(regex_literal_prefix(r'^/a/\d'), '/a/')
+        self.assertEqual(regex_literal_prefix(r'/data/'), '')
+        self.assertEqual(regex_literal_prefix(r'^/a|^/b'), '')
+
+    def test_database_writer(self):
+        file_name = 'test-file.txt'
+        file_path = os.path.join(self.test_data_dir, file_name)
+        other_path = os.path.join(self.test_data_dir, 'test-file-01.txt')
+        store_file_info(self.db_path, other_path, compute_md5(other_path))
+        with DatabaseWriter(self.db_path, batch_size=2, max_latency=60) as writer:
+            writer.store_file_info(file_path, compute_md5(file_path))
+            writer.remove_file_info(other_path)
+            writer.flush()
+            self.assertEqual(get_md5_by_path(self.db_path, file_path), compute_md5(file_path))
+            self.assertIsNone(get_file_info(self.db_path, other_path))
+            writer.store_file_info(other_path, '0' * 32)
+        self.assertEqual(get_md5_by_path(self.db_path, other_path), '0' * 32)
+        self.assertEqual(writer.rows_written, 3)
+        self.assertFalse(writer.failed)
+
+    def test_database_writer_errors(self):
+        good_path = os.path.join(self.test_data_dir, 'good.txt')
+        bad_path = os.path.join(self.test_data_dir, 'bad\udcff.txt')  # An undecodable file name
+        with DatabaseWriter(self.db_path, max_latency=60) as writer:
+            writer.store_file_info(bad_path, '0' * 32, size=1, last_modified=1, st_dev=0, st_ino=1)
+            writer.store_file_info(good_path, '1' * 32, size=1, last_modified=1, st_dev=0, st_ino=2)
+        self.assertEqual((writer.rows_written, writer.errors), (1, 1))  # The rest of the batch is kept
+        self.assertTrue(writer.failed)
+        self.assertEqual(get_md5_by_path(self.db_path, good_path), '1' * 32)
+
+        writer = DatabaseWriter(os.path.join(self.test_data_dir, 'missing', 'test.db'))
+        writer.start()
+        writer.store_file_info(good_path, '1' * 32, size=1, last_modified=1, st_dev=0, st_ino=2)
+        with self.assertRaises(Exception):
+            writer.flush()  # Rather than waiting for a writer that has stopped
+        with self.assertRaises(Exception):
+            writer.close()
+        self.assertTrue(writer.failed)
+
+    def test_database_writer_checkpoints(self):
+        generation = begin_scan(self.db_path, self.test_data_dir)
+        done, failed = os.path.join(self.test_data_dir, 'done'), os.path.join(self.test_data_dir, 'failed')
+        with DatabaseWriter(self.db_path, max_latency=60) as writer:
+            writer.record_checkpoint(generation, done)
+            writer.flush()
+            writer.store_file_info(os.path.join(failed, 'bad\udcff.txt'), None, size=1, last_modified=1,
+                                   st_dev=0, st_ino=1)
+            writer.record_checkpoint(generation, failed)  # Its file was not stored
+        self.assertEqual(get_scan_checkpoints(self.db_path, generation), {done})
+
+    def test_file_index(self):
+        file_path1 = os.path.join(self.test_data_dir, 'test-file-02.txt')
+        file_path2 = os.path.join(self.duplicate_data_dir, 'test-file-02.txt')
+        md5sum = compute_md5(file_path1)
+        with FileIndex(self.db_path) as index:
+            conn = index.connection()
+            self.assertIs(index.connection(), conn)
+            index.store_file_info(file_path1, md5sum)
+            store_file_info(self.db_path, file_path2, md5sum)  # Goes through the open index
+            self.assertEqual(sorted(index.check_for_duplicates(md5sum)), sorted([(file_path1,), (file_path2,)]))
+            duplicates = index.find_duplicates_with_min_count(1)
+            self.assertNotIsInstance(duplicates, list)
+            self.assertEqual(dict(duplicates)[md5sum], [file_path1, file_path2])
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+            self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 1)  # NORMAL
+            thread_connections = []
+            for _ in range(3):  # Like the short-lived threads of a pool
+                thread = threading.Thread(target=lambda: thread_connections.append(index.connection()))
+                thread.start()
+                thread.join()
+            self.assertEqual(index._connections, [conn])
+            with self.assertRaises(sqlite3.ProgrammingError):
+                thread_connections[0].execute("SELECT 1")  # Closed when its thread exited
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")  # Closed with the index
+
+    def test_open_worker_index(self):
+        file_path = os.path.join(self.test_data_dir, 'test-file.txt')
+        store_file_info(self.db_path, file_path, compute_md5(file_path))
+        open_worker_index(self.db_path)
+        try:
+            with patch('src.db.sqlite3.connect', wraps=sqlite3.connect) as mock_connect:
+                for _ in range(3):
+                    self.assertEqual(get_md5_by_path(self.db_path, file_path), compute_md5(file_path))
+            self.assertEqual(mock_connect.call_count, 1)  # Kept for the calls that follow
+        finally:
+            _open_indexes.pop(self.db_path).close()
+
     def test_get_md5_by_path(self):
         file_name = 'test-file.txt'
         file_path = os.path.join(self.test_data_dir, file_name)
@@ -111,16 +293,120 @@ class TestDBFunctions(unittest.TestCase):
         self.assertIn(file_path1, duplicates[compute_md5(file_path1)])
         self.assertIn(file_path2, duplicates[compute_md5(file_path1)])
 
+    def test_iter_duplicate_groups(self):
+        rows = [('/a/x,1.txt', 'a' * 32, 10, 1), ('/b/x.txt', 'a' * 32, 10, 2), ('/c/x.txt', 'a' * 32, 10, 2),
+                ('/a/y.txt', 'b' * 32, 100, 3), ('/b/y.txt', 'b' * 32, 100, 4), ('/a/z.txt', 'c' * 32, 5, 5)]
+        for path, md5sum, size, st_ino in rows:
+            store_file_info(self.db_path, path, md5sum, size=size, last_modified=0, st_dev=0, st_ino=st_ino)
+        groups = iter_duplicate_groups(self.db_path)
+        self.assertNotIsInstance(groups, list)
+        groups = list(groups)
+        self.assertEqual([group.md5sum for group in groups], ['a' * 32, 'b' * 32])
+        self.assertEqual(sorted(groups[0].paths), ['/a/x,1.txt', '/b/x.txt', '/c/x.txt'])
+        self.assertEqual((groups[0].size, groups[0].inodes, groups[0].wasted_bytes), (10, 2, 10))
+        by_waste = list(iter_duplicate_groups(self.db_path, order_by='wasted'))
+        self.assertEqual([group.md5sum for group in by_waste], ['b' * 32, 'a' * 32])
+        self.assertEqual([group.md5sum for group in iter_duplicate_groups(self.db_path, min_count=2)], ['a' * 32])
+        self.assertIn('/a/x,1.txt', find_duplicates_with_min_count(self.db_path)['a' * 32])
+
+    def test_dup_groups(self):
+        def stored_groups():
+            self.cursor.execute('SELECT md5sum, size, member_count, inode_count, wasted_bytes FROM dup_groups')
+            return sorted(self.cursor.fetchall())
+
+        def recomputed_groups():
+            self.cursor.execute('''
+                SELECT md5sum, MAX(size), COUNT(*), COUNT(DISTINCT COALESCE(st_dev || ':' || st_ino, 'file:' || id)),
+                       (COUNT(DISTINCT COALESCE(st_dev || ':' || st_ino, 'file:' || id)) - 1) * MAX(size)
+                FROM files WHERE md5sum IS NOT NULL GROUP BY md5sum
+            ''')
+            return sorted(self.cursor.fetchall())
+
+        a, b = 'a' * 32, 'b' * 32
+        store_file_info(self.db_path, '/x/1', a, size=10, last_modified=0, st_dev=0, st_ino=1)
+        store_file_info(self.db_path, '/x/2', a, size=10, last_modified=0, st_dev=0, st_ino=1)  # Hardlink
+        store_file_info(self.db_path, '/x/3', a, size=10, last_modified=0, st_dev=0, st_ino=2)
+        store_file_info(self.db_path, '/x/4', None, size=10, last_modified=0, st_dev=0, st_ino=3)
+        self.assertEqual(stored_groups(), [(bytes.fromhex(a), 10, 3, 2, 10)])
+        store_staged_hashes(self.db_path, '/x/4', md5sum=a)
+        store_file_info(self.db_path, '/x/1', b, size=10, last_modified=1, st_dev=0, st_ino=1)
+        self.assertEqual(stored_groups(), recomputed_groups())
+        remove_file_info(self.db_path, '/x/2')
+        remove_file_info(self.db_path, '/x/3')
+        self.assertEqual(stored_groups(), recomputed_groups())
+        self.cursor.execute('DELETE FROM files')
+        self.conn.commit()
+        self.assertEqual(stored_groups(), [])
+
     def test_audit_db(self):
         file_name = 'test-file.txt'
         file_path = os.path.join(self.test_data_dir, file_name)
         store_file_info(self.db_path, file_path, compute_md5(file_path))
-        def mock_process_file(file_path, db_path):
-            pass
-        audit_db(self.db_path, num_threads=2, process_file=mock_process_file)
-        self.cursor.execute('SELECT * FROM files WHERE path = ?', (file_path,))
+        audit_db(self.db_path, num_threads=2)
+        self.cursor.execute('SELECT * FROM file_paths WHERE path = ?', (file_path,))
         result = self.cursor.fetchone()
         self.assertIsNotNone(result)
 
+    def test_audit_db_stats(self):
+        unchanged_path = os.path.join(self.test_data_dir, 'test-file.txt')
+        store_file_info(self.db_path, unchanged_path, compute_md5(unchanged_path))
+        changed_path = os.path.join(self.duplicate_data_dir, 'test-file-02.txt')
+        store_file_info(self.db_path, changed_path, '0' * 32, size=0)
+        missing_path = os.path.join(self.test_data_dir, 'missing-file.txt')
+        store_file_info(self.db_path, missing_path, '1' * 32, size=1, last_modified=1, st_dev=0, st_ino=0)
+        stats = audit_db(self.db_path, num_threads=2)
+        self.assertEqual((stats.checked, stats.removed, stats.rehashed, stats.errors), (3, 1, 1, 0))
+        self.assertEqual(set(stats.stage_times), {'stat', 'delete', 'hash', 'update'})
+        self.assertEqual(get_md5_by_path(self.db_path, changed_path), compute_md5(changed_path))
+        self.assertIsNone(get_file_info(self.db_path, missing_path))
+
+    def test_audit_db_incremental(self):
+        names = sorted(os.listdir(self.test_data_dir))
+        for name in names:
+            file_path = os.path.join(self.test_data_dir, name)
+            store_file_info(self.db_path, file_path, compute_md5(file_path))
+        half = (len(names) + 1) // 2
+        first = audit_db(self.db_path, num_threads=2, batch_size=3, fraction=0.5)
+        self.assertEqual((first.total, first.checked), (len(names), half))
+        second = audit_db(self.db_path, num_threads=2, batch_size=3, fraction=0.5)
+        self.assertEqual(second.checked, half)
+        self.cursor.execute('SELECT COUNT(DISTINCT last_verified), MIN(last_verified) FROM files')
+        distinct, oldest = self.cursor.fetchone()
+        self.assertEqual(distinct, 2)  # The second run checked the files the first one left
+        self.assertGreater(oldest, 0)
+        prefix = os.path.join(self.test_data_dir, 'test-file-1')
+        third = audit_db(self.db_path, num_threads=2, prefix=prefix)
+        self.assertEqual((third.total, third.checked), (10, 10))
+
+    def test_verify_db(self):
+        intact_path = os.path.join(self.test_data_dir, 'test-file-01.txt')
+        store_file_info(self.db_path, intact_path, compute_md5(intact_path))
+        corrupt_path = os.path.join(self.test_data_dir, 'test-file-02.txt')
+        store_file_info(self.db_path, corrupt_path, '0' * 32)  # Size and time match the file
+        modified_path = os.path.join(self.test_data_dir, 'test-file-03.txt')
+        store_file_info(self.db_path, modified_path, '0' * 32, size=0)
+        missing_path = os.path.join(self.test_data_dir, 'missing-file.txt')
+        store_file_info(self.db_path, missing_path, '1' * 32, size=1, last_modified=1, st_dev=0, st_ino=0)
+        stats = verify_db(self.db_path, num_threads=2, max_rate=10 ** 9)
+        self.assertEqual(stats.mismatches, [(corrupt_path, '0' * 32, compute_md5(corrupt_path))])
+        self.assertEqual((stats.checked, stats.rehashed, stats.removed, stats.errors), (4, 1, 1, 0))
+        self.assertEqual(get_md5_by_path(self.db_path, corrupt_path), '0' * 32)  # Kept for inspection
+        self.assertEqual(get_md5_by_path(self.db_path, modified_path), compute_md5(modified_path))
+        self.assertIsNone(get_file_info(self.db_path, missing_path))
+        resumed = verify_db(self.db_path, num_threads=2, fraction=0.5)
+        self.assertEqual(resumed.checked, 2)
+        self.cursor.execute('SELECT COUNT(*) FROM files WHERE content_verified = 0')
+        self.assertEqual(self.cursor.fetchone()[0], 0)
+
+    def test_audit_db_process_executor(self):
+        file_name = 'test-file.txt'
+        file_path = os.path.join(self.test_data_dir, file_name)
+        store_file_info(self.db_path, file_path, '0' * 32, size=0)
+        missing_path = os.path.join(self.test_data_dir, 'missing-file.txt')
+        store_file_info(self.db_path, missing_path, '1' * 32, size=1, last_modified=1, st_dev=0, st_ino=0)
+        audit_db(self.db_path, num_threads=2, executor='process')
+        self.assertEqual(get_md5_by_path(self.db_path, file_path), compute_md5(file_path))
+        self.assertIsNone(get_file_info(self.db_path, missing_path))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
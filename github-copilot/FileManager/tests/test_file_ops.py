@@ -0,0 +1,313 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from contextlib import contextmanager
+from unittest.mock import patch
+from src.db import (
+    initialize_db, find_duplicates_with_min_count, open_worker_index, _open_indexes, store_file_info
+)
+from src.file_ops import scan, process_file, process_batch
+from src.md5sum import compute_md5
+
+
+class TestScan(unittest.TestCase):
+
+    def setUp(self):
+        self.test_data_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.test_data_dir, 'test_file_ops.db')
+        self.scan_dir = os.path.join(self.test_data_dir, 'files')
+        os.mkdir(self.scan_dir)
+        initialize_db(self.db_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_data_dir)
+
+    def write_file(self, name, data):
+        file_path = os.path.join(self.scan_dir, name)
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        return file_path
+
+    def fetch_hashes(self):
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute('SELECT path, partial_md5, md5sum FROM file_paths').fetchall()
+        conn.close()
+        return {path: (partial_md5 and partial_md5.hex(), md5sum and md5sum.hex())
+                for path, partial_md5, md5sum in rows}
+
+    def test_staged_scan(self):
+        partial_size = 1024
+        unique = self.write_file('unique.bin', b'u' * 5000)
+        head = b'h' * partial_size
+        tail = b't' * partial_size
+        # Same size and same ends, but different middles: needs a full hash to tell apart
+        same_ends_a = self.write_file('same-ends-a.bin', head + b'a' * 100 + tail)
+        same_ends_b = self.write_file('same-ends-b.bin', head + b'b' * 100 + tail)
+        # Same size, different ends: the partial hash is enough
+        diff_ends = self.write_file('diff-ends.bin', b'x' * (2 * partial_size + 100))
+        copy_a = self.write_file('copy-a.bin', head + b'a' * 100 + tail)
+
+        scan(self.scan_dir, self.db_path, 2, staged=True, partial_size=partial_size)
+
+        hashes = self.fetch_hashes()
+        self.assertEqual(hashes[unique], (None, None))
+        self.assertIsNotNone(hashes[diff_ends][0])
+        self.assertIsNone(hashes[diff_ends][1])
+        for file_path in (same_ends_a, same_ends_b, copy_a):
+            self.assertEqual(hashes[file_path][1], compute_md5(file_path))
+
+        duplicates = find_duplicates_with_min_count(self.db_path, min_count=1)
+        self.assertEqual(list(duplicates), [compute_md5(copy_a)])
+        self.assertCountEqual(duplicates[compute_md5(copy_a)], [same_ends_a, copy_a])
+
+    def test_staged_scan_small_files(self):
+        # Files within twice the partial size are fully hashed by the partial stage
+        file_a = self.write_file('a.txt', b'same')
+        file_b = self.write_file('b.txt', b'same')
+        scan(self.scan_dir, self.db_path, 2, staged=True, partial_size=1024)
+        hashes = self.fetch_hashes()
+        self.assertEqual(hashes[file_a], (compute_md5(file_a), compute_md5(file_a)))
+        self.assertEqual(hashes[file_b][1], compute_md5(file_b))
+
+    def test_scan_hashes_files_left_unhashed_by_staged_scan(self):
+        original = self.write_file('x.bin', b'unique size')
+        for executor in ('thread', 'process'):
+            scan(self.scan_dir, self.db_path, 2, staged=True)
+            self.assertEqual(self.fetch_hashes()[original], (None, None))
+            copy = self.write_file(f'copy-{executor}.bin', b'unique size')
+            scan(self.scan_dir, self.db_path, 2, executor=executor)
+            hashes = self.fetch_hashes()
+            self.assertEqual(hashes[original][1], compute_md5(original))
+            duplicates = find_duplicates_with_min_count(self.db_path, min_count=1)
+            self.assertCountEqual(duplicates[compute_md5(original)], [original, copy])
+            os.remove(copy)
+            scan(self.scan_dir, self.db_path, 2)
+            store_file_info(self.db_path, original, None)  # As recorded by a staged scan
+        self.assertEqual(process_file(original, self.db_path), compute_md5(original))
+
+    def test_scan_with_small_queue(self):
+        file_paths = [self.write_file(f'file-{i}.bin', bytes([i])) for i in range(20)]
+        with self.assertLogs(level='INFO') as logs:
+            scan(self.scan_dir, self.db_path, 2, queue_depth=3)
+        self.assertCountEqual(self.fetch_hashes(), file_paths)
+        peak = [line for line in logs.output if 'Peak queue depth' in line]
+        self.assertEqual(len(peak), 1)
+        self.assertTrue(peak[0].endswith('of 3'))
+
+    def test_rescan_uses_known_files(self):
+        self.write_file('a.bin', b'a')
+        scan(self.scan_dir, self.db_path, 2)
+        with patch('src.file_ops.get_file_info') as mock_get_file_info, \
+                patch('src.file_ops.compute_md5') as mock_compute_md5:
+            scan(self.scan_dir, self.db_path, 2)
+            mock_get_file_info.assert_not_called()
+            mock_compute_md5.assert_not_called()
+
+    def test_rescan_removes_deleted_files(self):
+        kept = self.write_file('kept.bin', b'k')
+        deleted = self.write_file('deleted.bin', b'd')
+        os.mkdir(os.path.join(self.scan_dir, 'sub'))
+        deleted_sub = self.write_file(os.path.join('sub', 'deleted.bin'), b's')
+        outside = os.path.join(self.test_data_dir, 'outside.bin')
+        with open(outside, 'wb') as f:
+            f.write(b'o')
+        scan(self.scan_dir, self.db_path, 2)
+        scan(outside, self.db_path, 2)
+        os.remove(deleted)
+        shutil.rmtree(os.path.join(self.scan_dir, 'sub'))
+        with self.assertLogs(level='INFO') as logs:
+            scan(self.scan_dir, self.db_path, 2)
+        self.assertCountEqual(self.fetch_hashes(), [kept, outside])
+        self.assertIn('Removed 2 files no longer under', '\n'.join(logs.output))
+        self.assertNotIn(deleted_sub, self.fetch_hashes())
+
+    def test_rescan_keeps_files_when_writes_fail(self):
+        for executor in ('thread', 'process'):
+            deleted = self.write_file(f'deleted-{executor}.bin', b'd')
+            scan(self.scan_dir, self.db_path, 2, executor=executor)
+            os.remove(deleted)
+            bad = os.path.join(os.fsencode(self.scan_dir), f'bad-{executor}\xff.bin'.encode('latin-1'))
+            with open(bad, 'wb') as f:  # Its undecodable name can't be stored
+                f.write(b'b')
+            with self.assertLogs(level='WARNING') as logs:
+                scan(self.scan_dir, self.db_path, 2, executor=executor)
+            self.assertIn(deleted, self.fetch_hashes())
+            self.assertIn('database writes failed', '\n'.join(logs.output))
+            os.remove(bad)
+
+    def test_rescan_keeps_unlisted_directories(self):
+        os.mkdir(os.path.join(self.scan_dir, 'sub'))
+        hidden = self.write_file(os.path.join('sub', 'hidden.bin'), b'h')
+        scan(self.scan_dir, self.db_path, 2, executor='process')
+        real_scandir = os.scandir
+
+        def failing_scandir(path):
+            if path.endswith('sub'):
+                raise PermissionError(13, 'Permission denied', path)
+            return real_scandir(path)
+
+        with patch('src.walker.os.scandir', side_effect=failing_scandir):
+            scan(self.scan_dir, self.db_path, 2, executor='process')
+        self.assertIn(hidden, self.fetch_hashes())
+
+    def test_resume_after_unlisted_directory(self):
+        os.mkdir(os.path.join(self.scan_dir, 'sub'))
+        hidden = self.write_file(os.path.join('sub', 'hidden.bin'), b'h')
+        scan(self.scan_dir, self.db_path, 2)
+        real_scandir = os.scandir
+
+        def failing_scandir(path):
+            if path.endswith('sub'):
+                raise PermissionError(13, 'Permission denied', path)
+            return real_scandir(path)
+
+        # An interrupted scan that could not list sub
+        with patch('src.walker.os.scandir', side_effect=failing_scandir), \
+                patch('src.file_ops.remove_unseen_files'):
+            scan(self.scan_dir, self.db_path, 2)
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM scan_checkpoints').fetchone()[0], 0)
+        conn.close()
+        scan(self.scan_dir, self.db_path, 2, resume=True)
+        self.assertIn(hidden, self.fetch_hashes())
+
+    def test_rescan_keeps_unreadable_entries(self):
+        unreadable = self.write_file('unreadable.bin', b'u')
+        real_scandir = os.scandir
+
+        class UnreadableEntry:
+            def __init__(self, entry):
+                self.path, self.name = entry.path, entry.name
+
+            def is_dir(self, follow_symlinks=True):
+                raise PermissionError(13, 'Permission denied', self.path)
+
+        @contextmanager
+        def failing_scandir(path):
+            with real_scandir(path) as entries:
+                yield [UnreadableEntry(entry) if entry.path == unreadable else entry for entry in entries]
+
+        for executor in ('thread', 'process'):
+            scan(self.scan_dir, self.db_path, 2, executor=executor)
+            with patch('src.walker.os.scandir', side_effect=failing_scandir):
+                scan(self.scan_dir, self.db_path, 2, executor=executor)
+            self.assertIn(unreadable, self.fetch_hashes())
+
+    def test_resume_skips_completed_directories(self):
+        for name in ('done', 'failed'):
+            os.mkdir(os.path.join(self.scan_dir, name))
+            self.write_file(os.path.join(name, 'file.bin'), name.encode())
+        failed_file = os.path.join(self.scan_dir, 'failed', 'file.bin')
+
+        def failing_process_file(file_path, *args, **kwargs):
+            if file_path == failed_file:
+                raise OSError('Simulated crash')
+            return process_file(file_path, *args, **kwargs)
+
+        # An interrupted scan: one file fails and the scan never finishes
+        with patch('src.file_ops.process_file', side_effect=failing_process_file), \
+                patch('src.file_ops.remove_unseen_files'):
+            scan(self.scan_dir, self.db_path, 2)
+        listed = []
+        real_scandir = os.scandir
+
+        def recording_scandir(path):
+            listed.append(path)
+            return real_scandir(path)
+
+        with patch('src.walker.os.scandir', side_effect=recording_scandir):
+            scan(self.scan_dir, self.db_path, 2, resume=True)
+        self.assertCountEqual(listed, [self.scan_dir, os.path.join(self.scan_dir, 'failed')])
+        self.assertIn(failed_file, self.fetch_hashes())
+        self.assertEqual(len(self.fetch_hashes()), 2)  # The skipped files were not removed
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM scan_checkpoints').fetchone()[0], 0)
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM scans WHERE finished IS NULL').fetchone()[0], 0)
+        conn.close()
+
+
+class TestHardlinkScan(unittest.TestCase):
+
+    def setUp(self):
+        self.test_data_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.test_data_dir, 'test_file_ops.db')
+        initialize_db(self.db_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_data_dir)
+
+    def test_hardlink_reuses_hash(self):
+        original = os.path.join(self.test_data_dir, 'original.txt')
+        with open(original, 'w') as f:
+            f.write('linked content')
+        link = os.path.join(self.test_data_dir, 'link.txt')
+        os.link(original, link)
+
+        process_file(original, self.db_path)
+        with patch('src.file_ops.compute_md5') as mock_compute_md5:
+            md5sum = process_file(link, self.db_path)
+            mock_compute_md5.assert_not_called()
+        self.assertEqual(md5sum, compute_md5(original))
+
+        conn = sqlite3.connect(self.db_path)
+        inodes = conn.execute('SELECT DISTINCT st_dev, st_ino FROM files').fetchall()
+        conn.close()
+        st = os.stat(original)
+        self.assertEqual(inodes, [(st.st_dev, st.st_ino)])
+
+    def test_process_batch_reuses_connection(self):
+        original = os.path.join(self.test_data_dir, 'original.txt')
+        with open(original, 'w') as f:
+            f.write('linked content')
+        process_file(original, self.db_path)
+        links = []
+        for i in range(3):
+            links.append(os.path.join(self.test_data_dir, f'link-{i}.txt'))
+            os.link(original, links[-1])
+
+        open_worker_index(self.db_path)  # As in the initializer of a worker process
+        try:
+            with patch('src.db.sqlite3.connect', wraps=sqlite3.connect) as mock_connect, \
+                    patch('src.file_ops.compute_md5') as mock_compute_md5:
+                _, processed, errors, _ = process_batch([(link, os.stat(link)) for link in links], self.db_path)
+            mock_compute_md5.assert_not_called()
+            self.assertEqual(mock_connect.call_count, 1)
+        finally:
+            _open_indexes.pop(self.db_path).close()
+        self.assertEqual(errors, [])
+        self.assertEqual({(status, md5sum) for _, status, *_, md5sum in processed},
+                         {('LINKED', compute_md5(original))})
+
+
+class TestProcessExecutorScan(unittest.TestCase):
+
+    def setUp(self):
+        self.test_data_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.test_data_dir, 'test_file_ops.db')
+        self.scan_dir = os.path.join(self.test_data_dir, 'files')
+        os.mkdir(self.scan_dir)
+        initialize_db(self.db_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_data_dir)
+
+    def test_scan_with_process_executor(self):
+        file_paths = []
+        for i in range(5):
+            file_path = os.path.join(self.scan_dir, f'file-{i}.txt')
+            with open(file_path, 'w') as f:
+                f.write(f'content {i % 2}')
+            file_paths.append(file_path)
+
+        scan(self.scan_dir, self.db_path, 2, executor='process')
+
+        conn = sqlite3.connect(self.db_path)
+        rows = dict(conn.execute('SELECT path, md5sum FROM file_paths').fetchall())
+        conn.close()
+        self.assertEqual(rows, {file_path: bytes.fromhex(compute_md5(file_path)) for file_path in file_paths})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from src.filters import ScanFilter
+from src.walker import walk_files, feed_files
+
+
+class TestScanFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.test_data_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.test_data_dir, 'root')
+        for relative_path, size in (
+            ('a.txt', 10),
+            ('tiny.txt', 1),
+            ('big.bin', 1000),
+            (os.path.join('.git', 'objects', 'x'), 10),
+            (os.path.join('src', 'main.py'), 10),
+            (os.path.join('src', 'main.pyc'), 10),
+            (os.path.join('src', 'cache', 'data.txt'), 10),
+        ):
+            file_path = os.path.join(self.root, relative_path)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, 'wb') as f:
+                f.write(b'x' * size)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_data_dir)
+
+    def walk(self, scan_filter, num_walkers=1):
+        found = []
+        feed_files(self.root, lambda item: found.append(os.path.relpath(item[0], self.root)), num_walkers,
+                   scan_filter=scan_filter)
+        return sorted(found)
+
+    def test_exclude_prunes_directories(self):
+        scan_filter = ScanFilter(exclude=['.git', '*.pyc', 're:/cache/'])
+        listed = []
+        real_scandir = os.scandir
+
+        def recording_scandir(path):
+            listed.append(os.path.relpath(path, self.root))
+            return real_scandir(path)
+
+        with patch('src.walker.os.scandir', side_effect=recording_scandir):
+            found = self.walk(scan_filter)
+        self.assertEqual(found, ['a.txt', 'big.bin', os.path.join('src', 'main.py'), 'tiny.txt'])
+        self.assertCountEqual(listed, ['.', 'src'])
+        self.assertEqual(self.walk(scan_filter, num_walkers=3), found)
+
+    def test_exclude_directory_path(self):
+        cache = os.path.join(self.root, 'src', 'cache')
+        for rule in (cache, os.path.join(cache, ''), os.path.join('*', 'src', 'cache')):
+            listed = []
+            real_scandir = os.scandir
+
+            def recording_scandir(path):
+                listed.append(path)
+                return real_scandir(path)
+
+            with patch('src.walker.os.scandir', side_effect=recording_scandir):
+                found = self.walk(ScanFilter(exclude=[rule]))
+            self.assertNotIn(os.path.join('src', 'cache', 'data.txt'), found)
+            self.assertNotIn(cache, listed)  # Pruned rather than listed and filtered
+
+    def test_include_and_sizes(self):
+        scan_filter = ScanFilter(include=['*.txt', 'glob:*/src/*.py'], min_size=5, max_size=100)
+        self.assertEqual(self.walk(scan_filter), [
+            'a.txt',
+            os.path.join('src', 'cache', 'data.txt'),
+            os.path.join('src', 'main.py'),
+        ])
+
+    def test_one_file_system(self):
+        scan_filter = ScanFilter(one_file_system=True)
+        self.assertEqual(len(self.walk(scan_filter)), 7)
+        # Every subdirectory is on another device than a root on device -1
+        with patch.object(scan_filter, 'root_device', return_value=-1):
+            self.assertEqual(self.walk(scan_filter), ['a.txt', 'big.bin', 'tiny.txt'])
+
+    def test_load_config(self):
+        config_path = os.path.join(self.test_data_dir, 'filters.json')
+        with open(config_path, 'w') as f:
+            json.dump({'exclude': ['.git'], 'min_size': 5}, f)
+        scan_filter = ScanFilter.load(config_path, exclude=['src'], max_size=100)
+        self.assertEqual(scan_filter.exclude, ('.git', 'src'))
+        self.assertEqual((scan_filter.min_size, scan_filter.max_size), (5, 100))
+        self.assertEqual([file_path for file_path, _ in walk_files(self.root, scan_filter=scan_filter)],
+                         [os.path.join(self.root, 'a.txt')])
+        self.assertIsNone(ScanFilter.load(None))
+        with open(config_path, 'w') as f:
+            json.dump({'exclude_dirs': ['.git']}, f)
+        with self.assertRaises(ValueError):
+            ScanFilter.load(config_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
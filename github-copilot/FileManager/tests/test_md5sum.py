@@ -1,6 +1,7 @@
+import hashlib
 import unittest
 import os
-from src.md5sum import compute_md5
+from src.md5sum import compute_md5, compute_partial_md5, choose_buffer_size, SMALL_FILE_THRESHOLD, MIN_BUFFER_SIZE
 
 class TestComputeMD5(unittest.TestCase):
 
@@ -34,5 +35,82 @@ class TestComputeMD5(unittest.TestCase):
         with self.assertRaises(FileNotFoundError):
             compute_md5('nonexistent_file.txt')
 
+    def test_compute_md5_large_file(self):
+        # Test a file that is streamed through the reusable buffer in several reads
+        large_file_path = 'large_file.bin'
+        data = os.urandom(SMALL_FILE_THRESHOLD * 3 + 17)
+        with open(large_file_path, 'wb') as f:
+            f.write(data)
+        try:
+            expected_md5 = hashlib.md5(data).hexdigest()
+            self.assertEqual(compute_md5(large_file_path), expected_md5)
+            self.assertEqual(compute_md5(large_file_path, buffer_size=4096), expected_md5)
+            self.assertEqual(compute_md5(large_file_path, size=len(data)), expected_md5)
+        finally:
+            os.remove(large_file_path)
+
+    def test_compute_md5_stale_size(self):
+        # A size hint smaller than the file must not truncate the checksum
+        expected_md5 = '3de8f8b0dc94b8c2230fab9ec0ba0506'
+        self.assertEqual(compute_md5(self.test_file_path, size=4), expected_md5)
+
+    def test_compute_md5_mmap(self):
+        # Files above the threshold are hashed through a memory map
+        large_file_path = 'large_file.bin'
+        data = os.urandom(MIN_BUFFER_SIZE * 5 + 3)
+        with open(large_file_path, 'wb') as f:
+            f.write(data)
+        try:
+            expected_md5 = hashlib.md5(data).hexdigest()
+            self.assertEqual(compute_md5(large_file_path, mmap_threshold=1), expected_md5)
+            self.assertEqual(compute_md5(large_file_path, size=10, mmap_threshold=1), expected_md5)
+        finally:
+            os.remove(large_file_path)
+
+    def test_compute_md5_mmap_falls_back(self):
+        # Empty files cannot be mapped and are read instead
+        empty_file_path = 'empty_file.txt'
+        open(empty_file_path, 'w').close()
+        try:
+            self.assertEqual(compute_md5(empty_file_path, size=1, mmap_threshold=1),
+                             'd41d8cd98f00b204e9800998ecf8427e')
+        finally:
+            os.remove(empty_file_path)
+
+    def test_compute_md5_throttle(self):
+        # The throttle is told about every byte read, and disables memory-mapped hashing
+        large_file_path = 'large_file.bin'
+        data = os.urandom(SMALL_FILE_THRESHOLD * 2 + 5)
+        with open(large_file_path, 'wb') as f:
+            f.write(data)
+        try:
+            reads = []
+            self.assertEqual(compute_md5(large_file_path, buffer_size=65536, mmap_threshold=1, throttle=reads.append),
+                             hashlib.md5(data).hexdigest())
+            self.assertEqual(sum(reads), len(data))
+            self.assertGreater(len(reads), 1)
+        finally:
+            os.remove(large_file_path)
+
+    def test_compute_partial_md5(self):
+        # Only the first and last partial_size bytes contribute to the partial checksum
+        large_file_path = 'large_file.bin'
+        data = b'a' * 100 + os.urandom(1000) + b'z' * 100
+        with open(large_file_path, 'wb') as f:
+            f.write(data)
+        try:
+            expected_md5 = hashlib.md5(b'a' * 100 + b'z' * 100).hexdigest()
+            self.assertEqual(compute_partial_md5(large_file_path, partial_size=100), expected_md5)
+            self.assertEqual(compute_partial_md5(large_file_path, partial_size=1000),
+                             compute_md5(large_file_path))
+        finally:
+            os.remove(large_file_path)
+
+    def test_choose_buffer_size(self):
+        self.assertEqual(choose_buffer_size(10), MIN_BUFFER_SIZE)
+        self.assertEqual(choose_buffer_size(10 * 1024 * 1024, buffer_size=MIN_BUFFER_SIZE * 2), MIN_BUFFER_SIZE * 2)
+        self.assertEqual(choose_buffer_size(MIN_BUFFER_SIZE * 3), MIN_BUFFER_SIZE * 3)
+        self.assertEqual(choose_buffer_size(10 * 1024 * 1024, buffer_size=4096), 4096)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
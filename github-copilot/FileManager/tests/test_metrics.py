@@ -0,0 +1,170 @@
+import io
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+from src.db import initialize_db
+from src.file_ops import scan
+from src.metrics import Histogram, Metrics, MetricsExporter, ProgressLine, write_metrics, COUNT
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_percentiles(self):
+        histogram = Histogram(unit=COUNT)
+        for value in range(1, 101):
+            histogram.observe(value)
+        self.assertEqual((histogram.count, histogram.total, histogram.max), (100, 5050, 100))
+        # Estimates are bucket upper bounds, within a factor of two of the exact values
+        self.assertEqual(histogram.percentile(0.5), 64)
+        self.assertEqual(histogram.percentile(0.99), 100)
+        other = Histogram(unit=COUNT)
+        other.observe(1000)
+        histogram.merge(other)
+        self.assertEqual((histogram.count, histogram.percentile(1)), (101, 1000))
+
+    def test_threads_and_snapshots(self):
+        metrics = Metrics()
+
+        def work():
+            for _ in range(1000):
+                metrics.count('files')
+                metrics.observe('hash', 0.001)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(metrics.counters(), {'files': 4000})
+        self.assertEqual(metrics.histograms()['hash'].count, 4000)
+
+        # A snapshot survives pickling, as when a worker process sends it back
+        worker = Metrics()
+        worker.count('files', 5)
+        with worker.stage('hash'):
+            pass
+        metrics.merge(pickle.loads(pickle.dumps(worker.snapshot())))
+        self.assertEqual(metrics.counters(), {'files': 4005})
+        self.assertEqual(metrics.histograms()['hash'].count, 4001)
+
+    def test_bottleneck(self):
+        metrics = Metrics()
+        self.assertIsNone(metrics.bottleneck())
+        with metrics.stage('hash'):
+            time.sleep(0.05)  # Waiting rather than computing
+        self.assertEqual(metrics.bottleneck(), 'I/O')
+        with metrics.stage('hash'):
+            deadline = time.thread_time() + 0.2
+            while time.thread_time() < deadline:
+                pass
+        self.assertEqual(metrics.bottleneck(), 'CPU')
+        metrics.observe('write', 10 * metrics.elapsed())  # The writer was busy all along
+        self.assertEqual(metrics.bottleneck(), 'DB')
+        self.assertIn('DB-bound', metrics.summary())
+
+    def test_progress_line(self):
+        metrics = Metrics()
+        metrics.count('files', 10)
+        metrics.count('skipped', 5)
+        metrics.add_gauge('queue_depth', lambda: 7)
+        stream = io.StringIO()
+        with ProgressLine(metrics, interval=0.01, stream=stream):
+            time.sleep(0.1)
+        output = stream.getvalue()
+        self.assertTrue(output.startswith('\r10 files'))
+        self.assertIn('50% skipped, queue depth 7', output)
+        self.assertTrue(output.endswith('\n'))
+        self.assertEqual(metrics.histograms()['queue_depth'].max, 7)
+
+
+class TestWriteMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.test_data_dir = tempfile.mkdtemp()
+        self.metrics = Metrics()
+        self.metrics.count('files', 3)
+        self.metrics.count('errors')
+        self.metrics.observe('hash', 0.002)
+        self.metrics.observe('write_batch_rows', 4, unit=COUNT)
+        self.metrics.observe('write_batch_rows', 2, unit=COUNT)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_data_dir)
+
+    def test_json(self):
+        path = os.path.join(self.test_data_dir, 'metrics.json')
+        write_metrics(self.metrics, path, labels={'action': 'scan'})
+        with open(path) as f:
+            report = json.load(f)
+        self.assertEqual(report['labels'], {'action': 'scan'})
+        self.assertEqual(report['counters'], {'files': 3, 'errors': 1})
+        self.assertEqual(report['stages']['hash']['count'], 1)
+        self.assertEqual(set(report['stages']['hash']['quantiles']), {'0.5', '0.9', '0.99'})
+        self.assertEqual((report['db_writes']['batches'], report['db_writes']['rows_per_batch']), (2, 3))
+        self.assertTrue(report['completed'])
+        self.assertEqual(os.listdir(self.test_data_dir), ['metrics.json'])
+
+    def test_prometheus(self):
+        path = os.path.join(self.test_data_dir, 'metrics.prom')
+        write_metrics(self.metrics, path, labels={'action': 'audit-db'})
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertIn('# TYPE filemanager_files_total counter', lines)
+        self.assertIn('filemanager_files_total{action="audit-db"} 3', lines)
+        self.assertIn('filemanager_stage_seconds_count{action="audit-db",stage="hash"} 1', lines)
+        self.assertIn('filemanager_stage_seconds{action="audit-db",stage="hash",quantile="0.99"} 0.002', lines)
+        self.assertIn('filemanager_db_write_batches{action="audit-db"} 2', lines)
+        self.assertIn('filemanager_bottleneck{action="audit-db",resource="I/O"} 1', lines)
+
+    def test_exporter(self):
+        path = os.path.join(self.test_data_dir, 'metrics.json')
+        with MetricsExporter(self.metrics, path, interval=0.01):
+            time.sleep(0.1)
+            with open(path) as f:
+                self.assertFalse(json.load(f)['completed'])  # Written at intervals while running
+        with open(path) as f:
+            self.assertTrue(json.load(f)['completed'])
+        with self.assertRaises(RuntimeError):
+            with MetricsExporter(self.metrics, path):
+                raise RuntimeError("scan failed")
+        with open(path) as f:
+            self.assertFalse(json.load(f)['completed'])
+
+
+class TestScanMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.test_data_dir = tempfile.mkdtemp()
+        self.scan_dir = os.path.join(self.test_data_dir, 'files')
+        os.makedirs(os.path.join(self.scan_dir, 'sub'))
+        for name in ('a.txt', os.path.join('sub', 'b.txt'), os.path.join('sub', 'c.txt')):
+            with open(os.path.join(self.scan_dir, name), 'w') as f:
+                f.write(name * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_data_dir)
+
+    def test_scan_metrics(self):
+        for executor in ('thread', 'process'):
+            db_path = os.path.join(self.test_data_dir, f'test_metrics_{executor}.db')
+            initialize_db(db_path)
+            metrics = Metrics()
+            with patch('builtins.print') as mock_print:
+                scan(self.scan_dir, db_path, 2, executor=executor, metrics=metrics)
+                scan(self.scan_dir, db_path, 2, executor=executor, metrics=metrics)
+            counters = metrics.counters()
+            self.assertEqual(counters['files'], 6)
+            self.assertEqual(counters['skipped'], 3)
+            mock_print.assert_not_called()  # No progress dots when metrics are recorded
+            self.assertEqual(counters['bytes'], 500 + 900 + 900)
+            self.assertTrue({'stat', 'lookup', 'hash', 'write'} <= set(metrics.histograms()))
+
+
+if __name__ == '__main__':
+    unittest.main()
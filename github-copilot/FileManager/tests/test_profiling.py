@@ -0,0 +1,56 @@
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from src.profiling import SamplingProfiler, thread_stage
+
+
+def busy_hashing(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+class TestSamplingProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.test_data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_data_dir)
+
+    def test_thread_stage(self):
+        self.assertEqual(thread_stage('walker-3'), 'traversal')
+        self.assertEqual(thread_stage('hasher_0'), 'hashing')
+        self.assertEqual(thread_stage('db-writer'), 'writer')
+        self.assertEqual(thread_stage('Thread-7'), 'other')
+
+    def test_profile_by_stage(self):
+        with SamplingProfiler(interval=0.001) as profiler:
+            thread = threading.Thread(target=busy_hashing, args=(0.2,), name="hasher_0")
+            thread.start()
+            thread.join()
+        self.assertIn('hashing', profiler.samples)
+        functions = {function[2]: values for function, values in profiler.stats('hashing').stats.items()}
+        self.assertIn('busy_hashing', functions)
+        self.assertNotIn('test_profile_by_stage', functions)  # Sampled in the main stage instead
+        cc, nc, tt, ct, callers = functions['busy_hashing']
+        self.assertGreater(tt, 0.05)
+        self.assertEqual(tt, ct)  # Only its own time, as it calls no Python function
+        self.assertEqual([caller[2] for caller in callers], ['run'])
+
+        path = os.path.join(self.test_data_dir, 'scan.prof')
+        profiler.dump(path)
+        merged = pstats.Stats(path)
+        self.assertTrue(any(function[2] == 'test_profile_by_stage' for function in merged.stats))
+        self.assertTrue(any(function[2] == 'busy_hashing' for function in merged.stats))
+        report = profiler.report(limit=5)
+        self.assertIn('Stage hashing:', report)
+        self.assertIn('busy_hashing', report)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from src.db import initialize_db
+from src.reporting import scan_dir_report
+
+
+class TestScanDirReport(unittest.TestCase):
+
+    def setUp(self):
+        self.test_data_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.test_data_dir, 'test_reporting.db')
+        self.scan_dir = os.path.join(self.test_data_dir, 'files')
+        os.mkdir(self.scan_dir)
+        initialize_db(self.db_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_data_dir)
+
+    def test_reports_new_duplicates(self):
+        copies = []
+        for name in ('a.txt', 'b.txt'):
+            copies.append(os.path.join(self.scan_dir, name))
+            with open(copies[-1], 'w') as f:
+                f.write('same content')
+        with open(os.path.join(self.scan_dir, 'unique.txt'), 'w') as f:
+            f.write('other content')
+        with patch('builtins.print') as mock_print:
+            scan_dir_report(self.scan_dir, self.db_path, 2)  # Neither copy is in the database yet
+        printed = [call.args[0] for call in mock_print.call_args_list]
+        self.assertEqual(len([line for line in printed if line.startswith('Duplicate found for')]), 1)
+        self.assertCountEqual([line for line in printed if line in copies], copies)
+
+
+if __name__ == '__main__':
+    unittest.main()
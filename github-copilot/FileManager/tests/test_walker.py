@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+from src.db import initialize_db, get_file_info
+from src.file_ops import process_file
+from src.walker import walk_files, feed_files, SubtreeTracker
+
+
+class TestWalkFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.test_data_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.test_data_dir, 'root')
+        os.makedirs(os.path.join(self.root, 'sub', 'deeper'))
+        self.files = []
+        for relative_path in ('a.txt', os.path.join('sub', 'b.txt'), os.path.join('sub', 'deeper', 'c.txt')):
+            file_path = os.path.join(self.root, relative_path)
+            with open(file_path, 'w') as f:
+                f.write(relative_path)
+            self.files.append(file_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_data_dir)
+
+    def test_walk_files(self):
+        found = dict(walk_files(self.root))
+        self.assertCountEqual(found, self.files)
+        for file_path, st in found.items():
+            self.assertEqual(st.st_size, os.path.getsize(file_path))
+            self.assertEqual(st.st_ino, os.stat(file_path).st_ino)
+
+    def test_walk_files_parallel(self):
+        found = dict(walk_files(self.root, num_walkers=3))
+        self.assertCountEqual(found, self.files)
+
+    def test_abandoned_parallel_walk(self):
+        for i in range(20):
+            with open(os.path.join(self.root, 'sub', f'more-{i}.txt'), 'w') as f:
+                f.write(str(i))
+        with patch('src.walker.WALK_QUEUE_SIZE', 1):
+            files = walk_files(self.root, num_walkers=3)
+            next(files)
+            files.close()  # As when the caller fails while the walkers wait on the full queue
+        deadline = time.monotonic() + 5
+        while any(thread.name.startswith(('walk-files', 'walker-')) for thread in threading.enumerate()):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_feed_files_parallel(self):
+        found = []
+        feed_files(self.root, found.append, num_walkers=4)
+        self.assertCountEqual([file_path for file_path, _ in found], self.files)
+
+    def test_walk_files_skips_special_files_and_directory_links(self):
+        os.mkfifo(os.path.join(self.root, 'fifo'))
+        os.symlink(os.path.join(self.root, 'sub'), os.path.join(self.root, 'sub-link'))
+        file_link = os.path.join(self.root, 'a-link.txt')
+        os.symlink(self.files[0], file_link)
+        found = dict(walk_files(self.root))
+        self.assertCountEqual(found, self.files + [file_link])
+
+    def test_stat_result_is_reused(self):
+        db_path = os.path.join(self.test_data_dir, 'test_walker.db')
+        initialize_db(db_path)
+        for file_path, st in walk_files(self.root):
+            with patch('os.stat') as mock_stat:
+                process_file(file_path, db_path, st=st)
+                mock_stat.assert_not_called()
+            self.assertEqual(get_file_info(db_path, file_path)[0], st.st_size)
+
+    def test_subtree_tracker(self):
+        for num_walkers in (1, 3):
+            completed = []
+            tracker = SubtreeTracker(self.root + os.sep, completed.append)
+            found = []
+
+            def put(item):
+                tracker.add_file(item[0])
+                found.append(item[0])
+
+            feed_files(self.root + os.sep, put, num_walkers, enter=tracker.enter, leave=tracker.leave)
+            self.assertEqual(completed, [])  # No file has been processed yet
+            for file_path in found:
+                tracker.file_done(file_path, ok=not file_path.endswith('b.txt'))
+            # sub failed, so neither it nor the root are complete
+            self.assertEqual(completed, [os.path.join(self.root, 'sub', 'deeper')])
+
+    def test_subtree_tracker_skips_completed(self):
+        sub = os.path.join(self.root, 'sub')
+        tracker = SubtreeTracker(self.root, lambda directory: None, completed=[sub])
+        found = [file_path for file_path, _ in walk_files(self.root, enter=tracker.enter)]
+        self.assertEqual(found, [self.files[0]])
+
+
+if __name__ == '__main__':
+    unittest.main()